@@ -0,0 +1,65 @@
+"""
+Benchmark of loading augmented training batches from `RandomTileDataset`: per-sample augmentation collated by the
+default `DataLoader` against `batch_dataloader`, which draws the centers and transforms of a whole batch, warps
+image and mask of every tile with shared geometry and normalizes the batch at once.
+
+Run from the repository root:
+    python -m benchmarks.bench_batch_augmentation
+"""
+import argparse
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from benchmarks.synthetic import write_monuseg_like
+from utils.data import RandomTileDataset, batch_dataloader
+
+
+def main(n_images=4, size=1000, batch_size=32, n_batches=8, workers=0, repeat=3, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        write_monuseg_like(tmp, n_images, size=size, rng=np.random.default_rng(seed))
+        files = sorted(Path(tmp, 'train', 'images').glob('*.tif'))
+        ds = RandomTileDataset(files, label_fn=lambda f: Path(tmp, 'train', 'masks', f'{f.stem}_mask.png'),
+                               tile_shape=(256, 256), verbose=0, sample_mult=batch_size*n_batches,
+                               preproc_dir=str(Path(tmp, 'preproc.zarr')))
+
+        # Without random flips and rotations, both loaders give the same tiles for the same centers
+        def deterministic():
+            return RandomTileDataset(files[:1], label_fn=ds.label_fn, tile_shape=(256, 256), verbose=0,
+                                     albumentations_tfms=[], flip=False, rotation_range_deg=(0, 0), stats=ds.stats,
+                                     preproc_dir=ds.preproc_dir, sampling_seed=seed)
+        single = deterministic()
+        per_sample = [single[0] for _ in range(batch_size)]
+        images, masks = deterministic()[[0] * batch_size]
+        assert torch.equal(images, torch.stack([s[0] for s in per_sample]))
+        assert torch.equal(masks, torch.stack([s[1] for s in per_sample]))
+
+        loaders = {'per sample + collate (before)': DataLoader(ds, batch_size=batch_size, shuffle=True, drop_last=True,
+                                                               num_workers=workers),
+                   'batch_dataloader': batch_dataloader(ds, batch_size, drop_last=True, num_workers=workers)}
+        baseline = None
+        for name, loader in loaders.items():
+            def load():
+                for _, (images, masks) in zip(range(n_batches), loader):
+                    pass
+            t = min(timeit.repeat(load, number=1, repeat=repeat)) / (n_batches*batch_size)
+            baseline = baseline or t
+            print(f'{name}: {1/t:,.0f} samples/s ({baseline/t:.1f}x)')
+        print(f'(batches of {batch_size} tiles of 256x256 from {n_images} images of {size}x{size}, {workers} worker(s))')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--n_images', type=int, default=4, help='Number of synthetic MoNuSeg-like images')
+    parser.add_argument('--size', type=int, default=1000, help='Height and width of the synthetic images')
+    parser.add_argument('--batch_size', type=int, default=32, help='Tiles per batch')
+    parser.add_argument('--n_batches', type=int, default=8, help='Batches loaded per timing')
+    parser.add_argument('--workers', type=int, default=0, help='DataLoader worker processes')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    main(n_images=args.n_images, size=args.size, batch_size=args.batch_size, n_batches=args.n_batches,
+         workers=args.workers, repeat=args.repeat)
@@ -0,0 +1,88 @@
+"""
+Benchmark of drawing tile centers in `RandomTileDataset`: the former linear scan of the CDF (`np.argmax(cdf > u)`,
+reading the CDF from the zarr store on every draw) against the `CenterSampler` binary search and alias table, one
+center at a time and in batches, and the resulting `__getitem__` throughput.
+
+Run from the repository root:
+    python -m benchmarks.bench_center_sampling
+"""
+import argparse
+import random
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.synthetic import write_monuseg_like
+from utils.data import CenterSampler, RandomTileDataset
+
+
+def legacy_random_center(pdf, orig_shape, reshape=512):
+    "The former `RandomTileDataset._random_center`."
+    reshape_y = int((orig_shape[1]/orig_shape[0])*reshape)
+    cx, cy = np.unravel_index(np.argmax(pdf > random.random()), (reshape, reshape_y))
+    cx = int(cx*orig_shape[0]/reshape)
+    cy = int(cy*orig_shape[1]/reshape_y)
+    return cx, cy
+
+
+class LegacyRandomTileDataset(RandomTileDataset):
+    "`RandomTileDataset` drawing its centers like before `CenterSampler`."
+    def _random_center(self, pdf, orig_shape, reshape=512, key=None):
+        return legacy_random_center(pdf(), orig_shape, reshape=reshape)
+
+
+def main(n_images=4, size=1000, n_draws=2000, n_items=200, repeat=3, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        write_monuseg_like(tmp, n_images, size=size, rng=np.random.default_rng(seed))
+        files = sorted(Path(tmp, 'train', 'images').glob('*.tif'))
+        kwargs = dict(label_fn=lambda f: Path(tmp, 'train', 'masks', f'{f.stem}_mask.png'), tile_shape=(256, 256),
+                      verbose=0, albumentations_tfms=[], preproc_dir=str(Path(tmp, 'preproc.zarr')))
+        datasets = {'linear scan (before)': LegacyRandomTileDataset(files, **kwargs)}
+        for method in ['search', 'alias']:
+            datasets[method] = RandomTileDataset(files, sampling=method, sampling_seed=seed, **kwargs,
+                                                 stats=datasets['linear scan (before)'].stats)
+        names = [f.name for f in files]
+        shape = datasets['search'].labels[names[0]].shape
+
+        # The binary search must draw the same centers as the linear scan for the same random numbers
+        cdf = datasets['search'].pdfs[names[0]][:]
+        u = np.random.default_rng(seed).random(n_draws)
+        expected = np.array([np.argmax(cdf > x) for x in u])
+        assert np.array_equal(CenterSampler('search', seed=seed).indices(cdf, n=n_draws), expected)
+
+        def draws(ds):
+            if isinstance(ds, LegacyRandomTileDataset):
+                return lambda: [legacy_random_center(ds.pdfs[names[i % n_images]][:], shape) for i in range(n_draws)]
+            return lambda: [ds._random_center(lambda: ds.pdfs[names[i % n_images]][:], shape, key=names[i % n_images])
+                            for i in range(n_draws)]
+
+        print(f'Center draws ({n_images} images of {size}x{size}):')
+        baseline = None
+        for name, ds in datasets.items():
+            t = min(timeit.repeat(draws(ds), number=1, repeat=repeat)) / n_draws
+            baseline = baseline or t
+            print(f'  {name}: {1/t:,.0f} centers/s ({baseline/t:.0f}x)')
+            if name != 'linear scan (before)':
+                t = min(timeit.repeat(lambda: [ds.random_centers(n, n_draws // n_images) for n in names], number=1,
+                                      repeat=repeat)) / n_draws
+                print(f'  {name}, batches of {n_draws // n_images}: {1/t:,.0f} centers/s ({baseline/t:.0f}x)')
+
+        print('RandomTileDataset.__getitem__ (tiles of 256x256):')
+        baseline = None
+        for name, ds in datasets.items():
+            t = min(timeit.repeat(lambda: [ds[i] for i in range(n_items)], number=1, repeat=repeat)) / n_items
+            baseline = baseline or t
+            print(f'  {name}: {1/t:,.0f} samples/s ({baseline/t:.1f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--n_images', type=int, default=4, help='Number of synthetic MoNuSeg-like images')
+    parser.add_argument('--size', type=int, default=1000, help='Height and width of the synthetic images')
+    parser.add_argument('--n_draws', type=int, default=2000, help='Number of centers drawn per timing')
+    parser.add_argument('--n_items', type=int, default=200, help='Number of dataset items loaded per timing')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    main(n_images=args.n_images, size=args.size, n_draws=args.n_draws, n_items=args.n_items, repeat=args.repeat)
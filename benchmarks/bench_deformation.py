@@ -0,0 +1,138 @@
+"""
+Benchmark of the random tile augmentation of `RandomTileDataset`: a `DeformationField` with a random flip and
+rotation applied to an image and its mask, as a full float64 coordinate field interpolated with `cv2.remap` (the
+former implementation) and as a composed affine matrix warped with `cv2.warpAffine`.
+
+Square tiles match the former implementation up to interpolation rounding. Non-square tiles do not: the former
+coordinate grids were built transposed and reshaped into the tile shape, scrambling the tile, whereas the affine
+warp returns the actual crop. Both are checked before timing.
+
+Run from the repository root:
+    python -m benchmarks.bench_deformation
+"""
+import argparse
+import random
+import timeit
+
+import albumentations as A
+import cv2
+import numpy as np
+
+from benchmarks.synthetic import synthetic_he_image, synthetic_instance_map
+from utils.data import DeformationField
+
+
+class LegacyDeformationField:
+    "The former `DeformationField`, building and interpolating a full float64 coordinate field."
+    def __init__(self, shape=(540, 540), scale=1, scale_range=(0, 0), p_scale=1.):
+        self.shape = shape
+        self.default_scale = self.scale = scale
+        if random.random() < p_scale and sum(scale_range) != 0:
+            self.scale = random.uniform(*np.array(scale_range)*scale)
+        grid_range = [np.linspace(-(d*self.scale)/2, ((d*self.scale)/2)-1, d) for d in shape]
+        self.deformationField = np.meshgrid(*grid_range)[::-1]
+
+    def rotate(self, theta=0):
+        self.deformationField = [self.deformationField[0]*np.cos(theta) + self.deformationField[1]*np.sin(theta),
+                                 -self.deformationField[0]*np.sin(theta) + self.deformationField[1]*np.cos(theta)]
+
+    def add_random_rotation(self, rotation_range_deg, p=0.5):
+        if random.random() < p:
+            self.rotate(theta=np.pi*(random.random()*(rotation_range_deg[1] - rotation_range_deg[0])
+                                     + rotation_range_deg[0])/180.0)
+
+    def mirror(self, dims):
+        for d in range(len(self.shape)):
+            if dims[d]:
+                self.deformationField[d] = -self.deformationField[d]
+
+    def add_random_flip(self, p=0.5):
+        if random.random() < p:
+            self.mirror(np.random.choice((True, False), 2))
+
+    def get(self, offset=(0, 0), pad=(0, 0)):
+        sliceDef = tuple(slice(int(p / 2), int(-p / 2)) if p > 0 else None for p in pad)
+        deform = [d[sliceDef] for d in self.deformationField]
+        return [d + offs for (d, offs) in zip(deform, offset)]
+
+    def apply(self, data, offset=(0, 0), pad=(0, 0), order=1):
+        outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
+        coords = [np.squeeze(d).astype('float32').reshape(*outshape) for d in self.get(offset, pad)]
+        sl = []
+        for i in range(len(coords)):
+            cmin, cmax = int(coords[i].min()), int(coords[i].max())
+            dmax = data.shape[i]
+            if cmin < 0:
+                cmax = max(-cmin, cmax)
+                cmin = 0
+            elif cmax > dmax:
+                cmin = min(cmin, 2*dmax-cmax)
+                cmax = dmax
+                coords[i] -= cmin
+            else:
+                coords[i] -= cmin
+            sl.append(slice(cmin, cmax))
+        remap_fn = A.augmentations.functional._maybe_process_in_chunks(
+            cv2.remap, map1=coords[1], map2=coords[0], interpolation=order, borderMode=cv2.BORDER_REFLECT)
+        return remap_fn(data[tuple(sl)])
+
+
+def augment(img, msk, center, tile_shape, field_cls, flip_rotate=True):
+    field = field_cls(tile_shape)
+    if flip_rotate:
+        field.add_random_flip(0.5)
+        field.add_random_rotation((0, 360))
+    return field.apply(img, center), field.apply(msk, center)
+
+
+def crop(img, center, tile_shape):
+    "The tile of `tile_shape` around `center`, i.e. what a field without flip or rotation should give."
+    return img[tuple(slice(c - t//2, c - t//2 + t) for c, t in zip(center, tile_shape))]
+
+
+def main(size=1000, tile_size=256, n_tiles=200, repeat=3, seed=0):
+    rng = np.random.default_rng(seed)
+    msk = synthetic_instance_map(rng, size, 600).astype(np.uint16)
+    img = synthetic_he_image(rng, msk)
+    tile_shape = (tile_size, tile_size)
+    centers = [tuple(int(c) for c in rng.integers(0, size, 2)) for _ in range(n_tiles)]
+
+    # Square tiles, same random flips and rotations: the tiles only differ by interpolation rounding
+    outputs = {}
+    for field_cls in [LegacyDeformationField, DeformationField]:
+        random.seed(seed)
+        np.random.seed(seed)
+        outputs[field_cls] = [augment(img, msk, c, tile_shape, field_cls) for c in centers]
+    diff = max(np.abs(a[0].astype(int) - b[0]).max()
+               for a, b in zip(outputs[LegacyDeformationField], outputs[DeformationField]))
+    assert diff <= 1, diff
+
+    # Non-square tiles, no flip or rotation: the tile is the crop around the center (both implementations
+    # reflect the last row and column at the border of the source slice, which is left out of the comparison)
+    wide = (tile_size, tile_size*3//4)
+    center = (size//2, size//2)
+    expected = crop(img, center, wide)[:-1, :-1]
+    new = augment(img, msk, center, wide, DeformationField, flip_rotate=False)[0][:-1, :-1]
+    old = augment(img, msk, center, wide, LegacyDeformationField, flip_rotate=False)[0][:-1, :-1]
+    assert np.array_equal(new, expected)
+    legacy_wrong = np.mean(old != expected)
+
+    baseline = None
+    for name, field_cls in [('float64 field + remap (before)', LegacyDeformationField),
+                            ('affine matrix + warpAffine', DeformationField)]:
+        t = min(timeit.repeat(lambda: [augment(img, msk, c, tile_shape, field_cls) for c in centers],
+                              number=1, repeat=repeat)) / n_tiles
+        baseline = baseline or t
+        print(f'{name}: {t*1e3:.2f} ms/tile ({baseline/t:.1f}x)')
+    print(f'(image and mask tiles of {tile_size}x{tile_size} from a {size}x{size} image, max pixel difference {diff})')
+    print(f'Non-square {wide[0]}x{wide[1]} tiles: the crop exactly, where the former implementation got '
+          f'{legacy_wrong:.0%} of the values wrong')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=1000, help='Height and width of the synthetic image')
+    parser.add_argument('--tile_size', type=int, default=256, help='Height and width of the tiles')
+    parser.add_argument('--n_tiles', type=int, default=200, help='Number of tiles per timing')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    main(size=args.size, tile_size=args.tile_size, n_tiles=args.n_tiles, repeat=args.repeat)
@@ -0,0 +1,72 @@
+"""
+Benchmark of the whole-image instance erosion used by `load_and_process_mask` (`utils.masks.erode_instances`
+plus `channel_index_map`) against the per-channel erosion and argmax it replaced.
+
+Run from the repository root:
+    python -m benchmarks.bench_erosion
+"""
+import argparse
+import timeit
+
+import numpy as np
+from skimage.draw import ellipse
+from skimage.morphology import disk, erosion
+
+from utils.masks import channel_index_map, erode_instances
+
+
+def instance_map_to_channels(instance_map, background_channel=False):
+    "The one-channel-per-instance stack of the ConSep (no background channel) and MoNuSeg scripts."
+    ids = np.unique(instance_map)
+    channels = np.zeros((len(ids), *instance_map.shape), dtype=np.uint8)
+    for index, cell in enumerate(ids):
+        if cell != 0:
+            channels[index] = instance_map == cell
+    return channels if background_channel else channels[ids != 0]
+
+
+def legacy_erosion(instance_map, background_channel=False):
+    instance_maps = instance_map_to_channels(instance_map, background_channel)
+    for i in range(instance_maps.shape[0]):
+        instance_maps[i] = erosion(instance_maps[i], disk(1))
+    return np.argmax(instance_maps, axis=0)
+
+
+def fast_erosion(instance_map, background_channel=False):
+    return channel_index_map(erode_instances(instance_map, disk(1)), instance_map, background_channel)
+
+
+def synthetic_instance_map(rng, size, n_cells):
+    "Random touching elliptical cells, some cut by the image border, stored as float64 like loadmat output."
+    inst_map = np.zeros((size, size), dtype=np.float64)
+    for i in range(1, n_cells + 1):
+        rr, cc = ellipse(rng.integers(0, size), rng.integers(0, size), rng.integers(3, 12), rng.integers(3, 12),
+                         shape=(size, size), rotation=rng.uniform(0, np.pi))
+        inst_map[rr, cc] = i
+    return inst_map
+
+
+def main(size=512, n_cells=300, repeat=3, seed=0):
+    rng = np.random.default_rng(seed)
+    inst_map = synthetic_instance_map(rng, size, n_cells)
+    n_found = len(np.unique(inst_map)) - 1
+
+    for name, background_channel in [('ConSep/CPM17', False), ('MoNuSeg', True)]:
+        legacy = lambda: legacy_erosion(inst_map, background_channel)
+        fast = lambda: fast_erosion(inst_map, background_channel)
+        a, b = legacy(), fast()
+        assert a.dtype == b.dtype and np.array_equal(a, b), f'{name}: outputs differ'
+        t_legacy = min(timeit.repeat(legacy, number=1, repeat=repeat))
+        t_fast = min(timeit.repeat(fast, number=1, repeat=repeat))
+        stack_mb = (n_found + background_channel) * inst_map.size / 2 ** 20
+        print(f'{name} ({size}x{size}, {n_found} cells): legacy {t_legacy*1e3:.0f} ms '
+              f'(+{stack_mb:.0f} MB channel stack), whole-image {t_fast*1e3:.1f} ms ({t_legacy/t_fast:.0f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=512, help='Height and width of the synthetic instance map')
+    parser.add_argument('--n_cells', type=int, default=300, help='Number of synthetic cells')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    main(size=args.size, n_cells=args.n_cells, repeat=args.repeat)
@@ -0,0 +1,76 @@
+"""
+Benchmark of loading the `inst_map` of ConSep/CPM17-style .mat labels: full `loadmat` parsing (the former loader),
+decoding `inst_map` only, and cold versus warm loads through the persistent `utils.labels.LabelCache`.
+
+Run from the repository root:
+    python -m benchmarks.bench_label_loading
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.io import loadmat, savemat
+
+from benchmarks.bench_erosion import synthetic_instance_map
+from utils.labels import LabelCache, load_mat_variable
+
+
+def synthetic_mat(rng, path, size, n_cells):
+    "A HoVer-Net style label file: float64 `inst_map` and `type_map` plus per-instance types and centroids."
+    inst_map = synthetic_instance_map(rng, size, n_cells)
+    ids = np.unique(inst_map)[1:]
+    type_map = np.where(inst_map > 0, inst_map % 5 + 1, 0)
+    centroids = np.array(ndi.center_of_mass(inst_map > 0, inst_map, ids))[:, ::-1]
+    savemat(path, {"inst_map": inst_map, "type_map": type_map, "inst_type": (ids % 5 + 1)[:, None],
+                   "inst_centroid": centroids})
+
+
+def main(size=1000, n_cells=1500, n_files=8, repeat=3, seed=0):
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f'label_{k}.mat') for k in range(n_files)]
+        for path in paths:
+            synthetic_mat(rng, path, size, n_cells)
+        cache_dir = os.path.join(tmp, 'cache')
+        cache = LabelCache(cache_dir)
+
+        # Every loader must give the same array
+        expected = [loadmat(p)['inst_map'] for p in paths]
+        for loader in [load_mat_variable, cache.load, cache.load]:
+            assert all(np.array_equal(loader(p), e) for p, e in zip(paths, expected))
+
+        def clear_cache():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        cases = {
+            'loadmat, all variables': (lambda: [loadmat(p)['inst_map'] for p in paths], None),
+            'loadmat, inst_map only': (lambda: [load_mat_variable(p) for p in paths], None),
+            'cache cold (decode + write)': (lambda: [cache.load(p) for p in paths], clear_cache),
+            'cache warm (memory map)': (lambda: [cache.load(p) for p in paths], None),
+            'cache warm, all pages read': (lambda: [np.array(cache.load(p)) for p in paths], None),
+        }
+        baseline = None
+        for name, (load, setup) in cases.items():
+            times = []
+            for _ in range(repeat):
+                if setup is not None:
+                    setup()
+                times.append(timeit.timeit(load, number=1))
+            t = min(times) / n_files
+            baseline = baseline or t
+            print(f'{name}: {t*1e3:.2f} ms/file ({baseline/t:.1f}x)')
+        print(f'({n_files} files of {size}x{size}, {os.path.getsize(paths[0]) / 2 ** 20:.1f} MB each)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=1000, help='Height and width of the synthetic label maps (ConSep: 1000)')
+    parser.add_argument('--n_cells', type=int, default=1500, help='Number of synthetic cells per map')
+    parser.add_argument('--n_files', type=int, default=8, help='Number of synthetic .mat files')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    main(size=args.size, n_cells=args.n_cells, n_files=args.n_files, repeat=args.repeat)
@@ -0,0 +1,83 @@
+"""
+Throughput benchmark of the batched PanNuke channel splitting (`utils.pannuke.split_batch`) against
+the per-sample loop it replaced in `save_images_and_masks`.
+
+Run from the repository root:
+    python -m benchmarks.bench_pannuke_split
+"""
+import argparse
+import os
+import tempfile
+import timeit
+
+import numpy as np
+
+from utils.pannuke import CLASS_NAMES, create_fold_store, save_images_and_masks, split_batch, write_store_batch
+
+
+def legacy_split(images, masks):
+    "Per-sample splitting of the original `save_images_and_masks` loop, without the file writes."
+    outputs = []
+    for i in range(masks.shape[0]):
+        tissue = masks[i, :, :, :]
+        mask = np.max(masks[i, :, :, :5], axis=-1, keepdims=True)
+        classes = [masks[i, :, :, c] for c in range(len(CLASS_NAMES))]
+        outputs.append((images[i] / 255.0, mask, tissue, classes))
+    return outputs
+
+
+def legacy_save(images, masks, out_dir):
+    "Per-sample splitting and saving of the original loop (eight .npy files per sample)."
+    for i, (image, mask, tissue, classes) in enumerate(legacy_split(images, masks)):
+        for name, array in [('image', image), ('mask', mask), ('tissue', tissue)] + list(zip(CLASS_NAMES, classes)):
+            np.save(os.path.join(out_dir, f'{name}_{i}.npy'), array)
+
+
+def synthetic_fold(rng, n_samples):
+    "Random PanNuke-like block: float64 pixels and sparse float64 instance ids in 5 class channels."
+    images = rng.integers(0, 256, (n_samples, 256, 256, 3)).astype(np.float64)
+    masks = np.zeros((n_samples, 256, 256, 6), dtype=np.float64)
+    masks[..., :5] = rng.integers(0, 40, (n_samples, 256, 256, 5)) * (rng.random((n_samples, 256, 256, 5)) < 0.05)
+    masks[..., 5] = masks[..., :5].max(-1) == 0
+    return images, masks
+
+
+def main(n_samples=64, repeat=3, seed=0):
+    rng = np.random.default_rng(seed)
+    images, masks = synthetic_fold(rng, n_samples)
+    types = np.array(['Breast'] * n_samples)
+
+    # Both paths must produce the same arrays
+    fast = split_batch(images, masks)
+    for i, (image, mask, tissue, classes) in enumerate(legacy_split(images, masks)):
+        assert np.array_equal(image, fast['images'][i]) and np.array_equal(mask, fast['masks'][i])
+        assert np.array_equal(tissue, fast['tissues'][i])
+        assert all(np.array_equal(c, fast[name][i]) for name, c in zip(CLASS_NAMES, classes))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dirs = [os.path.join(tmp, 'npy', name) for name in ['images', 'masks', 'tissues'] + CLASS_NAMES]
+        legacy_dir = os.path.join(tmp, 'legacy')
+        os.makedirs(legacy_dir)
+        store = create_fold_store(n_samples, images.shape[1:], masks.shape[1:], masks.dtype, types,
+                                  os.path.join(tmp, 'store'), 1)
+        # Splitting alone is not compared: the loop returns strided views that are only copied by np.save
+        cases = {
+            'split + .npy files': (lambda: legacy_save(images, masks, legacy_dir),
+                                   lambda: save_images_and_masks(images, masks, types, *dirs, 1)),
+            'split + memmap store': (None, lambda: write_store_batch(store, images, masks)),
+        }
+        for name, (legacy, batched) in cases.items():
+            t_batched = min(timeit.repeat(batched, number=1, repeat=repeat))
+            line = f'{name}: batched {n_samples/t_batched:.0f} samples/s'
+            if legacy is not None:
+                t_legacy = min(timeit.repeat(legacy, number=1, repeat=repeat))
+                line += f', per-sample loop {n_samples/t_legacy:.0f} samples/s ({t_legacy/t_batched:.1f}x)'
+            print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--n_samples', type=int, default=64, help='Number of synthetic 256x256 samples per block')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    main(n_samples=args.n_samples, repeat=args.repeat)
@@ -0,0 +1,229 @@
+"""
+Benchmark suite of the preprocessing hot functions and of whole-pipeline throughput on synthetic ConSep-, MoNuSeg-
+and PanNuke-shaped data (see `benchmarks.synthetic`), with the results stored per commit to compare them.
+
+Run from the repository root:
+    python -m benchmarks.suite                      # writes benchmarks/results/<commit>.json
+    python -m benchmarks.suite --quick --compare benchmarks/results/<baseline commit>.json
+
+Every benchmark is reported as the best time per item (image, patch or PanNuke sample) over `--repeat` runs.
+The data is generated with a fixed seed, so results of different commits on the same machine are comparable;
+`--compare` prints the ratio of every benchmark to a previous results file and flags those slower than
+`--threshold`.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import timeit
+
+import numpy as np
+
+from benchmarks.synthetic import write_consep_like, write_monuseg_like, write_pannuke_like
+from utils.datasets import DATASETS
+from utils.masks import remove_small_border_cells
+from utils.pannuke import save_images_and_masks, split_batch
+from utils.patches import iter_patches
+from utils.pipeline import SIZE_THRESHOLD, extract_patches, load_and_preprocess_image, load_and_process_mask, run_jobs
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def best_time(fn, repeat):
+    "Best wall time of `fn()` over `repeat` calls, in seconds."
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def git_commit():
+    "Short hash of the checked-out commit, suffixed with `-dirty` when the tree has uncommitted changes."
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def hot_functions(data_dir, repeat):
+    """
+    Times the functions on the critical path of one image (one batch for PanNuke).
+
+    Returns:
+        dict: Maps benchmark names to {"seconds": best time per item, "per": item kind, "items": items per call}.
+    """
+    consep, monuseg = DATASETS["ConSep"], DATASETS["MoNuSeg"]
+    mat_path = os.path.join(data_dir, "ConSep", "train", "Labels", "train_0.mat")
+    png_path = os.path.join(data_dir, "MoNuSeg", "train", "masks", "TCGA_0_mask.png")
+    consep_image = load_and_preprocess_image(os.path.join(data_dir, "ConSep", "train", "Images", "train_0.png"))
+    consep_mask = load_and_process_mask(mat_path, consep)
+    monuseg_mask = load_and_process_mask(png_path, monuseg)
+    consep_patches = [patch for _, _, patch in iter_patches(consep_mask, 256, consep.stride)]
+    monuseg_patches = [patch for _, _, patch in iter_patches(monuseg_mask, 256, monuseg.stride)]
+    images, masks = np.load(os.path.join(data_dir, "PanNuke", "raw_data", "Fold 1", "images", "fold1", "images.npy")), \
+        np.load(os.path.join(data_dir, "PanNuke", "raw_data", "Fold 1", "masks", "fold1", "masks.npy"))
+    types = np.load(os.path.join(data_dir, "PanNuke", "raw_data", "Fold 1", "images", "fold1", "types.npy"))
+
+    def consep_mask_patches():
+        return list(extract_patches(consep_mask, True, 256, consep.stride, "mask"))
+
+    def monuseg_mask_patches():
+        return list(extract_patches(monuseg_mask, True, 256, monuseg.stride, "mask",
+                                    connectivity=monuseg.border_connectivity, return_labels=monuseg.border_labels))
+
+    def save_pannuke(out_dir):
+        dirs = [os.path.join(out_dir, name) for name in ["images", "masks", "tissues", "Neoplastic", "inflams",
+                                                         "Connective", "Dead", "Epithelial"]]
+        save_images_and_masks(images, masks, types, *dirs, fold=1)
+
+    cases = {
+        "load_and_process_mask/consep": (lambda: load_and_process_mask(mat_path, consep), "image", 1),
+        "load_and_process_mask/consep_erosion": (lambda: load_and_process_mask(mat_path, consep, erosion=True), "image", 1),
+        "load_and_process_mask/monuseg": (lambda: load_and_process_mask(png_path, monuseg), "image", 1),
+        "load_and_process_mask/monuseg_erosion": (lambda: load_and_process_mask(png_path, monuseg, erosion=True), "image", 1),
+        "extract_patches/consep_image": (lambda: list(extract_patches(consep_image, True, 256, consep.stride, "image")),
+                                         "image", 1),
+        "extract_patches/consep_mask": (consep_mask_patches, "image", 1),
+        "extract_patches/monuseg_mask": (monuseg_mask_patches, "image", 1),
+        "remove_small_border_cells/consep": (
+            lambda: [remove_small_border_cells(p, SIZE_THRESHOLD) for p in consep_patches], "patch", len(consep_patches)),
+        "remove_small_border_cells/monuseg": (
+            lambda: [remove_small_border_cells(p, SIZE_THRESHOLD, connectivity=1, return_labels=False)
+                     for p in monuseg_patches], "patch", len(monuseg_patches)),
+        "split_batch/pannuke": (lambda: split_batch(images, masks), "sample", len(images)),
+    }
+    try:
+        from utils.data import preprocess_mask
+    except Exception as e:  # utils.data needs the training dependencies (torch, albumentations, fastcore)
+        print(f"Skipping preprocess_mask: utils.data cannot be imported ({e!r})")
+    else:
+        cases["preprocess_mask/consep_patch"] = (
+            lambda: [preprocess_mask(instlabels=p) for p in consep_patches[:16]], "patch", min(16, len(consep_patches)))
+
+    results = {}
+    for name, (fn, per, items) in cases.items():
+        results[name] = {"seconds": best_time(fn, repeat) / items, "per": per, "items": items}
+    with tempfile.TemporaryDirectory() as out_dir:
+        results["save_images_and_masks/pannuke"] = {"seconds": best_time(lambda: save_pannuke(out_dir), repeat) / len(images),
+                                                    "per": "sample", "items": len(images)}
+    return results
+
+
+def pipeline_throughput(data_dir, repeat, output_format="npy", workers=1):
+    """
+    Times full runs of the shared pipeline (`run_jobs`, as `preprocess.py` does) on each synthetic dataset, with
+    the label cache off and `force=True` so that every run decodes and writes everything.
+
+    Returns:
+        dict: Maps "pipeline/{dataset}" to the best time per image (sample for PanNuke), the patches and bytes
+              written per second, and the time per stage of the best run.
+    """
+    results = {}
+    for name, subsets in [("ConSep", ["train"]), ("MoNuSeg", ["train"]), ("PanNuke", ["1"])]:
+        runs = []
+        for _ in range(repeat):
+            jobs = DATASETS[name].jobs(data_dir, subsets, output_format=output_format, force=True, label_cache=False,
+                                       batch_size=64)
+            with tempfile.TemporaryDirectory() as tmp:
+                report_path = os.path.join(tmp, "report.json")
+                start = timeit.default_timer()
+                run_jobs(jobs, workers=workers, verbose=False, report_path=report_path)
+                seconds = timeit.default_timer() - start
+                with open(report_path) as f:
+                    runs.append((seconds, json.load(f)))
+        seconds, report = min(runs, key=lambda run: run[0])
+        counts = report["total"]["counts"]
+        items = counts["patches"] if name == "PanNuke" else len(report["tasks"])
+        results[f"pipeline/{name.lower()}"] = {
+            "seconds": seconds / items, "per": "sample" if name == "PanNuke" else "image", "items": items,
+            "patches_per_s": counts["patches"] / seconds, "mb_per_s": counts.get("bytes_written", 0) / 2 ** 20 / seconds,
+            "stages": {stage: round(stage_times["seconds"], 4) for stage, stage_times in report["total"]["stages"].items()}}
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Prints the ratio of every benchmark time to the baseline results and returns the names of those slower
+    by more than `threshold` (e.g. 0.1 = 10%).
+    """
+    regressions = []
+    print(f"\nComparison with {baseline['commit']} ({baseline['date']}), ratio = current / baseline time:")
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            print(f"  {name:<48} new")
+            continue
+        ratio = result["seconds"] / baseline["benchmarks"][name]["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(f"  {name:<48} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main(n_images=4, n_samples=64, repeat=3, pipeline_repeat=1, output_format="npy", workers=1, output=None,
+         baseline=None, threshold=0.1, data_dir=None, seed=0):
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = data_dir or tmp
+        if not os.path.exists(os.path.join(data_dir, "ConSep")):
+            print(f"Generating {n_images} ConSep and MoNuSeg images and a {n_samples}-sample PanNuke fold in {data_dir}...")
+            write_consep_like(os.path.join(data_dir, "ConSep"), n_images, rng=rng)
+            write_monuseg_like(os.path.join(data_dir, "MoNuSeg"), n_images, rng=rng)
+            write_pannuke_like(os.path.join(data_dir, "PanNuke", "raw_data"), n_samples, rng=rng)
+
+        benchmarks = hot_functions(data_dir, repeat)
+        benchmarks.update(pipeline_throughput(data_dir, pipeline_repeat, output_format=output_format, workers=workers))
+
+    results = {"commit": git_commit(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                           "numpy": np.__version__, "cpus": os.cpu_count()},
+               "params": {"n_images": n_images, "n_samples": n_samples, "repeat": repeat,
+                          "pipeline_repeat": pipeline_repeat, "format": output_format, "workers": workers, "seed": seed},
+               "benchmarks": benchmarks}
+    for name, result in benchmarks.items():
+        line = f"{name:<50} {result['seconds'] * 1e3:10.2f} ms/{result['per']}"
+        if "patches_per_s" in result:
+            line += f"  ({result['patches_per_s']:.0f} patches/s, {result['mb_per_s']:.0f} MB/s)"
+        print(line)
+
+    output = output or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold=threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {threshold:.0%}.")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--n_images', type=int, default=4, help='Number of synthetic 1000x1000 ConSep and MoNuSeg images')
+    parser.add_argument('--n_samples', type=int, default=64, help='Number of samples of the synthetic PanNuke fold')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions of the hot functions (best is reported)')
+    parser.add_argument('--pipeline_repeat', type=int, default=1, help='Timing repetitions of the whole-pipeline runs')
+    parser.add_argument('--format', type=str, default='npy', choices=['npy', 'memmap', 'zarr'], help='Output format of the pipeline runs')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of the pipeline runs')
+    parser.add_argument('--quick', action='store_true', help='Smaller run: 2 images, 16 PanNuke samples, 1 repetition')
+    parser.add_argument('--output', type=str, default=None, help='Results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', type=str, default=None, help='Results file of a previous commit to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown flagged by --compare')
+    parser.add_argument('--data_dir', type=str, default=None, help='Generate the synthetic data here, or reuse it if present, instead of a temporary folder')
+    args = parser.parse_args()
+    if args.quick:
+        args.n_images, args.n_samples, args.repeat = 2, 16, 1
+    main(n_images=args.n_images, n_samples=args.n_samples, repeat=args.repeat, pipeline_repeat=args.pipeline_repeat,
+         output_format=args.format, workers=args.workers, output=args.output, baseline=args.compare,
+         threshold=args.threshold, data_dir=args.data_dir)
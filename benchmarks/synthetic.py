@@ -0,0 +1,128 @@
+"""
+Synthetic H&E-like datasets for the benchmarks, generated offline with the shapes, dtypes, file formats and
+cell densities of the real releases:
+
+- ConSep/CPM17: 1000x1000 RGBA .png images and HoVer-Net style .mat labels (float64 `inst_map`, `type_map`,
+  `inst_type`, `inst_centroid`), about 600 nuclei per image (24,319 nuclei in 41 images);
+- MoNuSeg: 1000x1000 RGB .tif images and binary 0/255 .png masks, about 700 nuclei per image
+  (21,623 nuclei in 30 images);
+- PanNuke: folds of 256x256 samples, float64 `images.npy` (n, 256, 256, 3), `masks.npy` (n, 256, 256, 6) with
+  instance ids in 5 class channels and a background channel, and `types.npy`, about 24 nuclei per sample.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage as ndi
+from scipy.io import savemat
+from skimage.draw import ellipse
+
+# Nuclei per image (per sample for PanNuke) and range of their semi-axes in pixels
+CONSEP_CELLS, MONUSEG_CELLS, PANNUKE_CELLS = 600, 700, 24
+CELL_RADII = (3, 12)
+# Approximate RGB colours of eosin-stained tissue, hematoxylin-stained nuclei and the slide background
+EOSIN, HEMATOXYLIN, BACKGROUND = (225, 160, 200), (95, 60, 145), (240, 235, 240)
+TISSUES = ["Breast", "Colon", "Lung", "Kidney", "Prostate"]
+
+
+def synthetic_instance_map(rng, size, n_cells, radii=CELL_RADII):
+    "Random touching elliptical cells, some cut by the image border, stored as float64 like loadmat output."
+    inst_map = np.zeros((size, size), dtype=np.float64)
+    for i in range(1, n_cells + 1):
+        rr, cc = ellipse(rng.integers(0, size), rng.integers(0, size), rng.integers(*radii), rng.integers(*radii),
+                         shape=(size, size), rotation=rng.uniform(0, np.pi))
+        inst_map[rr, cc] = i
+    # Cells fully covered by later ones are gone: renumber the remaining ones 1..n
+    ids, inverse = np.unique(inst_map, return_inverse=True)
+    return inverse.reshape(inst_map.shape).astype(np.float64) if ids[0] == 0 else inverse.reshape(inst_map.shape) + 1.0
+
+
+def synthetic_he_image(rng, instance_map):
+    "An RGB uint8 H&E-like rendering of an instance map: textured pink stroma, purple nuclei with darker rims."
+    nuclei = instance_map > 0
+    tissue = ndi.gaussian_filter(rng.random(instance_map.shape), 8) > 0.48
+    rims = nuclei & ~ndi.binary_erosion(nuclei)
+    image = np.empty((*instance_map.shape, 3), dtype=np.float64)
+    for channel in range(3):
+        layer = np.where(tissue, EOSIN[channel], BACKGROUND[channel]).astype(np.float64)
+        layer[nuclei] = HEMATOXYLIN[channel]
+        layer[rims] = HEMATOXYLIN[channel] * 0.7
+        image[..., channel] = ndi.gaussian_filter(layer, 1) + rng.normal(0, 8, instance_map.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def write_consep_like(root, n_images, size=1000, n_cells=CONSEP_CELLS, rng=None, subset="train"):
+    """
+    Writes `n_images` ConSep/CPM17-like images and labels to `{root}/{subset}/Images` and `.../Labels`.
+
+    Returns:
+        list: The written instance maps.
+    """
+    rng = rng or np.random.default_rng(0)
+    image_dir, label_dir = os.path.join(root, subset, "Images"), os.path.join(root, subset, "Labels")
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+    maps = []
+    for i in range(n_images):
+        inst_map = synthetic_instance_map(rng, size, n_cells)
+        ids = np.arange(1, int(inst_map.max()) + 1)
+        inst_type = rng.integers(1, 5, len(ids))
+        lut = np.concatenate([[0], inst_type]).astype(np.float64)
+        centroids = np.array(ndi.center_of_mass(inst_map > 0, inst_map, ids))[:, ::-1].reshape(-1, 2)
+        savemat(os.path.join(label_dir, f"{subset}_{i}.mat"),
+                {"inst_map": inst_map, "type_map": lut[inst_map.astype(np.int64)],
+                 "inst_type": inst_type[:, None].astype(np.float64), "inst_centroid": centroids})
+        # ConSep images are RGBA PNGs
+        rgba = np.dstack([synthetic_he_image(rng, inst_map), np.full((size, size), 255, np.uint8)])
+        Image.fromarray(rgba).save(os.path.join(image_dir, f"{subset}_{i}.png"))
+        maps.append(inst_map)
+    return maps
+
+
+def write_monuseg_like(root, n_images, size=1000, n_cells=MONUSEG_CELLS, rng=None, subset="train"):
+    """
+    Writes `n_images` MoNuSeg-like .tif images and binary .png masks to `{root}/{subset}/images` and `.../masks`.
+
+    Returns:
+        list: The instance maps the masks were drawn from.
+    """
+    rng = rng or np.random.default_rng(0)
+    image_dir, mask_dir = os.path.join(root, subset, "images"), os.path.join(root, subset, "masks")
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(mask_dir, exist_ok=True)
+    maps = []
+    for i in range(n_images):
+        inst_map = synthetic_instance_map(rng, size, n_cells)
+        Image.fromarray(synthetic_he_image(rng, inst_map)).save(os.path.join(image_dir, f"TCGA_{i}.tif"))
+        Image.fromarray(np.where(inst_map > 0, 255, 0).astype(np.uint8)).save(os.path.join(mask_dir, f"TCGA_{i}_mask.png"))
+        maps.append(inst_map)
+    return maps
+
+
+def synthetic_pannuke_fold(rng, n_samples, n_cells=PANNUKE_CELLS):
+    "PanNuke-like float64 images (n, 256, 256, 3) and masks (n, 256, 256, 6): instance ids in 5 class channels."
+    images = np.empty((n_samples, 256, 256, 3), dtype=np.float64)
+    masks = np.zeros((n_samples, 256, 256, 6), dtype=np.float64)
+    for i in range(n_samples):
+        inst_map = synthetic_instance_map(rng, 256, n_cells)
+        images[i] = synthetic_he_image(rng, inst_map)
+        classes = rng.integers(0, 5, int(inst_map.max()) + 1)
+        channel = classes[inst_map.astype(np.int64)]
+        for c in range(5):
+            masks[i, ..., c] = np.where((inst_map > 0) & (channel == c), inst_map, 0)
+        masks[i, ..., 5] = inst_map == 0
+    return images, masks
+
+
+def write_pannuke_like(raw_dir, n_samples, fold=1, rng=None):
+    "Writes a PanNuke-like fold in the layout of the original release under `raw_dir` (`Fold {fold}/...`)."
+    rng = rng or np.random.default_rng(0)
+    images, masks = synthetic_pannuke_fold(rng, n_samples)
+    image_dir = os.path.join(raw_dir, f"Fold {fold}", "images", f"fold{fold}")
+    mask_dir = os.path.join(raw_dir, f"Fold {fold}", "masks", f"fold{fold}")
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(mask_dir, exist_ok=True)
+    np.save(os.path.join(image_dir, "images.npy"), images)
+    np.save(os.path.join(image_dir, "types.npy"), rng.choice(TISSUES, n_samples))
+    np.save(os.path.join(mask_dir, "masks.npy"), masks)
+    return images, masks
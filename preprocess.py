@@ -0,0 +1,90 @@
+from utils.datasets import DATASETS, get_dataset
+from utils.pannuke import LABEL_ENCODINGS
+from utils.pipeline import run_jobs
+
+
+def parse_spec(spec):
+    """
+    Splits a dataset argument of the form `NAME` or `NAME:SUBSET[,SUBSET...]` into its adapter and subsets.
+
+    Parameters:
+        spec (str): e.g. "ConSep", "MoNuSeg:train" or "PanNuke:1,3".
+
+    Returns:
+        tuple: The registered dataset adapter and the list of subsets (None for the dataset's defaults).
+    """
+    name, _, subsets = spec.partition(":")
+    adapter = get_dataset(name)
+    subsets = subsets.split(",") if subsets else None
+    unknown = sorted(set(subsets or []) - set(adapter.subsets))
+    if unknown:
+        raise ValueError(f"Unknown subset(s) {unknown} of {adapter.name}, expected some of {adapter.subsets}")
+    return adapter, subsets
+
+
+def main(specs, base_dir="./", workers=1, readers=0, queue_size=4, report_path=None, profile_dir=None, **options):
+    """
+    Preprocesses several datasets and subsets in one run, with every task sharing one pool of worker processes.
+
+    Parameters:
+        specs (list): Dataset arguments, see `parse_spec`.
+        base_dir (str): Folder holding one folder per dataset (ConSep, CPM17, MoNuSeg, PanNuke).
+        workers (int): Number of worker processes (0 = one per CPU core).
+        readers (int): Number of threads decoding images ahead of the workers, see `run_jobs`.
+        queue_size (int): Number of images decoded ahead of the workers.
+        report_path (str, optional): Save the stage times and counters of every task and of the run to this .json or .csv file.
+        profile_dir (str, optional): Profile every task with cProfile into this folder.
+        **options: Options passed to the `jobs` method of every dataset adapter (output format, compact,
+                   force, resume, erosion, window_size, stride, label_cache, types,
+                   writers, batch_size, encoding).
+
+    Returns:
+        dict: Maps every job label (e.g. "ConSep/train", "PanNuke") to the results of its tasks.
+    """
+    jobs = []
+    for spec in specs:
+        adapter, subsets = parse_spec(spec)
+        jobs.extend(adapter.jobs(base_dir, subsets, **options))
+    return run_jobs(jobs, workers=workers, readers=readers, queue_size=queue_size, report_path=report_path,
+                    profile_dir=profile_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Preprocess one or more datasets for patch extraction.")
+    parser.add_argument("datasets", nargs="+", help=f"Datasets to process, as NAME or NAME:SUBSET[,SUBSET...] with NAME in {sorted(DATASETS)} "
+                                                    "(e.g. ConSep MoNuSeg:train PanNuke:1,2); all subsets of a dataset by default")
+    parser.add_argument("--base_dir", type=str, default="./", help="Folder holding one folder per dataset")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes shared by all datasets, one image (PanNuke fold) per task (0 = one per CPU core)")
+    parser.add_argument("--readers", type=int, default=0, help="Threads decoding images ahead of the workers (0 = each worker reads its own images)")
+    parser.add_argument("--queue_size", type=int, default=4, help="Number of images decoded ahead of the workers with --readers")
+    parser.add_argument("--writers", type=int, default=0, help="ConSep/CPM17/MoNuSeg: threads per worker writing patches while the next ones are computed (0 = write inline)")
+    parser.add_argument("--report", type=str, default=None, help="Save the time per stage and the counters of every image (PanNuke fold) and of the run to this .json or .csv file")
+    parser.add_argument("--profile", type=str, default=None, help="Profile every image (PanNuke fold) with cProfile into this folder, merged into total.prof")
+    parser.add_argument("--format", type=str, default="npy", choices=["npy", "memmap", "zarr"], help="Write one .npy file per patch, or one memory-mapped/Zarr store per subset")
+    parser.add_argument("--compact", action="store_true", help="Store images as uint8 and masks in the smallest sufficient integer dtype")
+    parser.add_argument("--force", action="store_true", help="Rebuild everything, ignoring the build manifests of previous runs")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run, keeping what its journals list as completed")
+    parser.add_argument("--no_label_cache", action="store_true", help="Decode every .mat mask on every run instead of memory-mapping the decoded arrays cached by previous runs")
+    parser.add_argument("--types", action="store_true", help="ConSep: also save the type patch and the nuclei (centroid and type) of every patch, from the same pass")
+    parser.add_argument("--erosion", action="store_true", help="Erode every cell of the masks by one pixel before tiling")
+    parser.add_argument("--window_size", type=int, default=None, help="Patch size (default: 256 for every dataset)")
+    parser.add_argument("--stride", type=int, default=None, help="Patch stride (default: 64 for ConSep and CPM17, 128 for MoNuSeg)")
+    parser.add_argument("--batch_size", type=int, default=256, help="PanNuke: number of samples loaded into memory at a time")
+    parser.add_argument("--encoding", type=str, default="channels", choices=LABEL_ENCODINGS, help="PanNuke: save one mask per class, or one instance map plus one class map per sample")
+    args = parser.parse_args()
+    for spec in args.datasets:
+        try:
+            parse_spec(spec)
+        except (KeyError, ValueError) as e:
+            parser.error(str(e).strip('"'))
+
+    main(args.datasets, base_dir=args.base_dir, workers=args.workers, readers=args.readers, queue_size=args.queue_size,
+         report_path=args.report, profile_dir=args.profile, writers=args.writers, output_format=args.format, compact=args.compact,
+         force=args.force, resume=args.resume, erosion=args.erosion,
+         window_size=args.window_size, stride=args.stride, label_cache=not args.no_label_cache, types=args.types,
+         batch_size=args.batch_size, encoding=args.encoding)
+
+# How to run: python preprocess.py ConSep CPM17 MoNuSeg PanNuke --workers 16
+# How to run: python preprocess.py ConSep:train MoNuSeg:test --format zarr --compact
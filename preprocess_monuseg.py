@@ -1,101 +1,41 @@
 import os
-import numpy as np
-from PIL import Image
-from scipy.io import loadmat
-from skimage.morphology import erosion, disk
-from skimage import measure
 
-def instance_map_to_channels(instances):
-    """
-    Converts an instance map to channel-wise binary masks.
-    """
-    unique_instances = np.unique(instances)
-    channel_maps = np.zeros((len(unique_instances), *instances.shape), dtype=np.uint8)
-    for idx, instance_id in enumerate(unique_instances):
-        if instance_id == 0:  # Ignore background
-            continue
-        channel_maps[idx] = (instances == instance_id).astype(np.uint8)
-    return channel_maps
+from utils.datasets import DATASETS
+from utils.pipeline import PatchJob, run_jobs
 
-def remove_small_border_cells(patch, size_threshold):
-    """
-    Removes small cells touching the patch borders.
-    """
-    labeled_patch = measure.label(patch, connectivity=1)
-    for region in measure.regionprops(labeled_patch):
-        if region.area < size_threshold:
-            coords = region.coords
-            if np.any(coords[:, 0] == 0) or np.any(coords[:, 1] == 0) or \
-               np.any(coords[:, 0] == patch.shape[0] - 1) or np.any(coords[:, 1] == patch.shape[1] - 1):
-                patch[coords[:, 0], coords[:, 1]] = 0
-    return patch
+# Window size, stride, file pairing and mask handling of the dataset, see `utils.datasets.MoNuSeg`
+DATASET = DATASETS["MoNuSeg"]
 
-def load_and_preprocess_image(img_path):
-    img = Image.open(img_path)
-    img_array = np.array(img) / 255.0  # Normalize image
-    return img_array
+def main(image_directory, mask_directory, output_folder, output_mask_folder, dataset, erosion_flag, remove_cells_borders, workers=1, output_format="npy", compact=False, force=False, resume=False, readers=0, writers=0, report_path=None, profile_dir=None):
+    """Extracts the patches of one subset with the shared pipeline and returns the number of patches written per image."""
+    job = PatchJob(DATASET, image_directory, mask_directory, output_folder, output_mask_folder, dataset, erosion=erosion_flag,
+                   remove_cells_borders=remove_cells_borders,
+                   output_format=output_format, compact=compact, force=force, resume=resume, writers=writers)
+    return run_jobs([job], workers=workers, readers=readers, report_path=report_path, profile_dir=profile_dir)[job.label]
 
-def load_and_process_mask(mask_path):
-    instances = loadmat(mask_path)['inst_map']  # Ensure the key matches your .mat file
-    instance_maps = instance_map_to_channels(instances)
-    for i in range(instance_maps.shape[0]):
-        instance_maps[i] = erosion(instance_maps[i], disk(1))
-    instance_argmax_map = np.argmax(instance_maps, axis=0)
-    return instance_argmax_map
-
-def save_patches(img_patches, mask_patches, output_folder, output_mask_folder, dataset, base_filename):
-    global_patch_index = 0
-
-    for img_patch, mask_patch in zip(img_patches, mask_patches):
-        img_patch_filename = f"{dataset}_{base_filename}_image_{global_patch_index}.npy"
-        mask_patch_filename = img_patch_filename.replace("image", "mask")
-        np.save(os.path.join(output_folder, img_patch_filename), img_patch)
-        np.save(os.path.join(output_mask_folder, mask_patch_filename), mask_patch)
-        global_patch_index += 1
-
-def extract_patches(img, remove_cells_borders, window_size, stride, patch_type):
-    """Extract patches from a given image."""
-    patches = []
-    y = 0
-    while y + window_size <= img.shape[0]:  # ensure within vertical bounds
-        x = 0
-        while x + window_size <= img.shape[1]:  # ensure within horizontal bounds
-            patch = img[y:y + window_size, x:x + window_size]
-            if patch_type == "mask":
-                patch[patch >= 0.5] = 1
-                patch[patch < 0.5] = 0
-                if remove_cells_borders:
-                    patch = remove_small_border_cells(patch, size_threshold=50)
-            patches.append(patch)
-            x += stride
-        y += stride
-    return patches
-
-def main(image_directory, mask_directory, output_folder, output_mask_folder, dataset, erosion_flag, remove_cells_borders):
-    os.makedirs(output_folder, exist_ok=True)
-    os.makedirs(output_mask_folder, exist_ok=True)
-    i = 0
-    for filename in os.listdir(image_directory):
-        if filename.endswith(".tif"):
-            img_path = os.path.join(image_directory, filename)
-            mask_filename = filename.replace(".tif", "_mask.png")
-            mask_path = os.path.join(mask_directory, mask_filename)
-
-            img_array = load_and_preprocess_image(img_path)
-
-            if erosion_flag:
-                instance_argmax_map = load_and_process_mask(mask_path)
-            else:
-                instance_argmax_map = np.array(Image.open(mask_path))
-
-            mask_patches = extract_patches(instance_argmax_map, remove_cells_borders, window_size=256, stride=128, patch_type="mask")
-            img_patches = extract_patches(img_array, remove_cells_borders, window_size=256, stride=128, patch_type="image")
-            save_patches(img_patches, mask_patches, output_folder, output_mask_folder, dataset, filename[:-4])
-            i += 1
-            print(f"Image number {i} processed!")
+def fold_report(report_path, fold):
+    "Report path of one fold, e.g. `run.fold0.json` for `run.json`; None when no report is requested."
+    if report_path is None:
+        return None
+    root, ext = os.path.splitext(report_path)
+    return f"{root}.{fold}{ext}"
 
 # Main script
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process the MoNuSeg train and test sets for patch extraction.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, one image per task (0 = one per CPU core)")
+    parser.add_argument("--readers", type=int, default=0, help="Threads decoding images ahead of the workers (0 = each worker reads its own images)")
+    parser.add_argument("--writers", type=int, default=0, help="Threads per worker writing patches while the next ones are computed (0 = write inline)")
+    parser.add_argument("--report", type=str, default=None, help="Save the time per stage and the counters of every image, per fold, to this .json or .csv file (suffixed with the fold)")
+    parser.add_argument("--profile", type=str, default=None, help="Profile every image with cProfile into one subfolder per fold of this folder, merged into total.prof")
+    parser.add_argument("--format", type=str, default="npy", choices=["npy", "memmap", "zarr"], help="Write one .npy file per patch, or one memory-mapped/Zarr store per subset")
+    parser.add_argument("--compact", action="store_true", help="Store images as uint8 and masks in the smallest sufficient integer dtype")
+    parser.add_argument("--force", action="store_true", help="Rebuild every image, ignoring the build manifest of previous runs")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run, keeping the images its journal lists as completed")
+    args = parser.parse_args()
+
     print("Start processing the train dataset.")
     subset = "train"
     image_directory = f"./MoNuSeg/{subset}/images"
@@ -103,7 +43,7 @@ if __name__ == "__main__":
     output_folder = f"./MoNuSeg/preprocessed/fold0/images"
     output_mask_folder = f"./MoNuSeg/preprocessed/fold0/labels"
     dataset = "MoNuSeg"
-    main(image_directory, mask_directory, output_folder, output_mask_folder, dataset, erosion_flag=False, remove_cells_borders=True)
+    main(image_directory, mask_directory, output_folder, output_mask_folder, dataset, erosion_flag=False, remove_cells_borders=True, workers=args.workers, output_format=args.format, compact=args.compact, force=args.force, resume=args.resume, readers=args.readers, writers=args.writers, report_path=fold_report(args.report, "fold0"), profile_dir=args.profile and os.path.join(args.profile, "fold0"))
 
     print("Start processing the test dataset.")
     subset = "test"
@@ -112,4 +52,4 @@ if __name__ == "__main__":
     output_folder = f"./MoNuSeg/preprocessed/fold1/images"
     output_mask_folder = f"./MoNuSeg/preprocessed/fold1/labels"
     dataset = "MoNuSeg"
-    main(image_directory, mask_directory, output_folder, output_mask_folder, dataset, erosion_flag=False, remove_cells_borders=True)
+    main(image_directory, mask_directory, output_folder, output_mask_folder, dataset, erosion_flag=False, remove_cells_borders=True, workers=args.workers, output_format=args.format, compact=args.compact, force=args.force, resume=args.resume, readers=args.readers, writers=args.writers, report_path=fold_report(args.report, "fold1"), profile_dir=args.profile and os.path.join(args.profile, "fold1"))
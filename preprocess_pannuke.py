@@ -1,89 +1,26 @@
-import numpy as np
-import os
-
-def save_images_and_masks(images, masks, types, images_dir, masks_dir, tissues_dir, Neoplastic_dir, inflams_dir, Connective_dir, Dead_dir, Epithelial_dir, fold):
-    """
-    Save images and masks to separate .npy files.
-
-    Args:
-        images (numpy.ndarray): The images array with shape (n, 256, 256, 3).
-        masks (numpy.ndarray): The masks array with shape (n, 256, 256, 1).
-        types (numpy.ndarray): The types array indicating the type of each image.
-        images_dir (str): Directory to save images.
-        masks_dir (str): Directory to save masks.
-        tissues_dir (str): Directory to save tissues.
-        Neoplastic_dir (str): Directory to save Neoplastic masks.
-        inflams_dir (str): Directory to save inflammatory masks.
-        Connective_dir (str): Directory to save Connective masks.
-        Dead_dir (str): Directory to save Dead masks.
-        Epithelial_dir (str): Directory to save Epithelial masks.
-        fold (int): Fold number to include in the filename.
-
-    Returns:
-        None
-    """
-    # Create directories if they don't exist
-    os.makedirs(images_dir, exist_ok=True)
-    os.makedirs(masks_dir, exist_ok=True)
-    os.makedirs(tissues_dir, exist_ok=True)
-    os.makedirs(Neoplastic_dir, exist_ok=True)
-    os.makedirs(inflams_dir, exist_ok=True)
-    os.makedirs(Connective_dir, exist_ok=True)
-    os.makedirs(Dead_dir, exist_ok=True)
-    os.makedirs(Epithelial_dir, exist_ok=True)
-
-    # Iterate over each index and save the corresponding image and mask
-    for i in range(masks.shape[0]):
-        # Define file paths
-        image_path = os.path.join(images_dir, f'PanNuke_fold{fold}_{types[i]}_image_{i}.npy')
-        mask_path = os.path.join(masks_dir, f'PanNuke_fold{fold}_{types[i]}_mask_{i}.npy')
-        tissue_path = os.path.join(tissues_dir, f'PanNuke_fold{fold}_{types[i]}_tissueType_{i}.npy')
-
-        Neoplastic_path = os.path.join(Neoplastic_dir, f'PanNuke_fold{fold}_{types[i]}_Neoplastic_{i}.npy')
-        inflam_path = os.path.join(inflams_dir, f'PanNuke_fold{fold}_{types[i]}_Inflam_{i}.npy')
-        Connective_path = os.path.join(Connective_dir, f'PanNuke_fold{fold}_{types[i]}_Connective_{i}.npy')
-        Dead_path = os.path.join(Dead_dir, f'PanNuke_fold{fold}_{types[i]}_Dead_{i}.npy')
-        Epithelial_path = os.path.join(Epithelial_dir, f'PanNuke_fold{fold}_{types[i]}_Epithelial_{i}.npy')
-
-        # Create the instances
-        mask = np.max(masks[i, :, :, :5], axis=-1, keepdims=True)
-        tissue = masks[i, :, :, :]
-        Neoplastic = masks[i, :, :, 0]
-        inflammatory = masks[i, :, :, 1]
-        Connective = masks[i, :, :, 2]
-        Dead = masks[i, :, :, 3]
-        Epithelial = masks[i, :, :, 4]
-
-        # Save each image and mask
-        np.save(image_path, images[i] / 255.0)
-        np.save(mask_path, mask)
-        np.save(tissue_path, tissue)
-        np.save(Neoplastic_path, Neoplastic)
-        np.save(inflam_path, inflammatory)
-        np.save(Connective_path, Connective)
-        np.save(Dead_path, Dead)
-        np.save(Epithelial_path, Epithelial)
-
-        # Optional: Print out the file paths of saved files
-        # print(f'Saved image to {image_path}')
-        # print(f'Saved mask to {mask_path}')
+# The PanNuke conversion lives in utils.pannuke; its functions are re-exported here for existing imports
+from utils.pannuke import (CLASS_MAP_DTYPE, CLASS_NAMES, COMPACT_IMAGE_DTYPE, COMPACT_MASK_DTYPE, ENCODED_OUTPUT_FOLDERS,
+                           LABEL_ENCODINGS, OUTPUT_FOLDERS, PanNukeJob, class_view, create_fold_store, decode_labels,
+                           encode_labels, process_fold, save_encoded_labels, save_images_and_masks, save_to_store,
+                           split_batch, write_store_batch)
+from utils.pipeline import run_jobs
 
 # Main script
 if __name__ == "__main__":
-    for fold in [1, 2, 3]:
-        images_dir = f"./PanNuke/preped/fold{fold}/images"
-        masks_dir = f"./PanNuke/preped/fold{fold}/masks"
-        tissues_dir = f"./PanNuke/preped/fold{fold}/tissues"
-        Neoplastic_dir = f"./PanNuke/preped/fold{fold}/Neoplastic"
-        inflams_dir = f"./PanNuke/preped/fold{fold}/inflams"
-        Connective_dir = f"./PanNuke/preped/fold{fold}/Connective"
-        Dead_dir = f"./PanNuke/preped/fold{fold}/Dead"
-        Epithelial_dir = f"./PanNuke/preped/fold{fold}/Epithelial"
-
-        # Read the data
-        masks = np.load(f"./PanNuke/raw_data/Fold {fold}/masks/fold{fold}/masks.npy")
-        types = np.load(f"./PanNuke/raw_data/Fold {fold}/images/fold{fold}/types.npy")
-        images = np.load(f"./PanNuke/raw_data/Fold {fold}/images/fold{fold}/images.npy")
-
-        save_images_and_masks(images, masks, types, images_dir, masks_dir, tissues_dir, Neoplastic_dir, inflams_dir, Connective_dir, Dead_dir, Epithelial_dir, fold)
-        print(f"Fold {fold} processing completed.")
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process the PanNuke folds.")
+    parser.add_argument("--compact", action="store_true", help="Store images as uint8 and masks as uint16 instead of float64")
+    parser.add_argument("--format", type=str, default="npy", choices=["npy", "memmap", "zarr"], help="Write one .npy file per sample and mask, or one memory-mapped/Zarr store per fold")
+    parser.add_argument("--encoding", type=str, default="channels", choices=LABEL_ENCODINGS, help="Save the full masks and one mask per class, or one instance map plus one class map per sample")
+    parser.add_argument("--force", action="store_true", help="Rebuild every fold, ignoring the build manifest of previous runs")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run, keeping the batches its journal lists as completed")
+    parser.add_argument("--batch_size", type=int, default=256, help="Number of samples loaded into memory at a time")
+    parser.add_argument("--report", type=str, default=None, help="Save the time per stage and the counters of every fold and of the run to this .json or .csv file")
+    parser.add_argument("--profile", type=str, default=None, help="Profile every fold with cProfile into this folder, merged into total.prof")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, one fold per task (0 = one per CPU core)")
+    args = parser.parse_args()
+
+    job = PanNukeJob([1, 2, 3], output_format=args.format, compact=args.compact, batch_size=args.batch_size,
+                     encoding=args.encoding, force=args.force, resume=args.resume)
+    run_jobs([job], workers=args.workers, report_path=args.report, profile_dir=args.profile)
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    """SHA-256 of the bytes of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(paths, params):
+    """
+    Content address of one unit of work: the hash of its source files' bytes and of the parameters
+    that affect its outputs. Renaming or touching a source does not change it; editing one byte does.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(file_digest(path).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def manifest_path(output_folder, output_format="npy"):
+    """Location of the build manifest of a subset, next to its images/labels folders (one per output format)."""
+    name = MANIFEST_FILENAME if output_format == "npy" else MANIFEST_FILENAME.replace(".json", f".{output_format}.json")
+    return os.path.join(os.path.dirname(os.path.normpath(output_folder)), name)
+
+
+class BuildCache:
+    """
+    Incremental build cache backed by a JSON manifest.
+
+    For every source (an image, or a PanNuke fold) the manifest records the cache key it was built
+    with, how many patches were written and which output paths (relative to the manifest) they went
+    to. On a re-run, a source whose key is unchanged and whose outputs are all present is skipped;
+    the others are rebuilt, and outputs they no longer produce are deleted.
+
+    Parameters:
+        path (str): Path of the manifest file.
+        params (dict): Parameters affecting every output (window size, stride, erosion, dtypes, format...).
+        force (bool): Ignore the existing manifest and treat every source as stale.
+    """
+    def __init__(self, path, params, force=False):
+        self.path = path
+        self.root = os.path.dirname(path)
+        self.params = params
+        self.keys = {}
+        self.entries = {}
+        if not force and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f).get("entries", {})
+
+    def key(self, source, paths):
+        "Computes (once) the cache key of `source` from the files it is built from."
+        if source not in self.keys:
+            self.keys[source] = cache_key(paths, self.params)
+        return self.keys[source]
+
+    def is_fresh(self, source, paths):
+        "Whether `source` was built with the same key and all its recorded outputs still exist."
+        key = self.key(source, paths)
+        entry = self.entries.get(source)
+        if entry is None or entry["key"] != key:
+            return False
+        return all(os.path.exists(os.path.join(self.root, p)) for p in entry["outputs"])
+
+    def stale(self, sources):
+        """
+        Returns the sources that need to be (re)built.
+
+        Parameters:
+            sources (dict): Maps every source name to the list of files it is built from.
+
+        Returns:
+            list: Source names, in the order of `sources`.
+        """
+        return [source for source, paths in sources.items() if not self.is_fresh(source, paths)]
+
+    def record(self, source, patches, outputs):
+        "Records a successful build of `source`; outputs of its previous build that were not rewritten are deleted."
+        outputs = [os.path.relpath(p, self.root) for p in outputs]
+        previous = self.entries.get(source, {}).get("outputs", [])
+        for p in set(previous) - set(outputs):
+            path = os.path.join(self.root, p)
+            if os.path.isfile(path):
+                os.remove(path)
+        self.entries[source] = {"key": self.keys[source], "patches": patches, "outputs": outputs}
+
+    def forget(self, source):
+        "Drops the entry of `source`, e.g. before its outputs are overwritten."
+        self.entries.pop(source, None)
+
+    def save(self):
+        "Writes the manifest, replacing the previous one only once it is complete."
+        os.makedirs(self.root or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"params": self.params, "entries": self.entries}, f, indent=1, default=str)
+        os.replace(tmp_path, self.path)
@@ -1,10 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_data.ipynb (unless otherwise specified).
 
-__all__ = ['show', 'preprocess_mask', 'DeformationField', 'tiles_in_rectangles', 'BaseDataset', 'RandomTileDataset',
-           'TileDataset']
+__all__ = ['show', 'preprocess_mask', 'DeformationField', 'tiles_in_rectangles', 'PatchStoreMapping', 'alias_table',
+           'CenterSampler', 'ChannelStats', 'BaseDataset', 'RandomTileDataset', 'batch_dataloader', 'TileDataset']
 
 # Cell
-import os, zarr, cv2, imageio, shutil, random
+import os, zarr, cv2, imageio, shutil, random, hashlib, json, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 
@@ -25,6 +27,8 @@ from torch.utils.data import Dataset, DataLoader
 from fastcore.all import *
 from fastprogress import progress_bar
 
+from utils.cache import cache_key
+
 # from .utils import clean_show
 
 # Cell
@@ -160,7 +164,15 @@ def preprocess_mask(clabels=None, instlabels=None, remove_connectivity=True, num
 # Cell
 # adapted from Falk, Thorsten, et al. "U-Net: deep learning for cell counting, detection, and morphometry." Nature methods 16.1 (2019): 67-70.
 class DeformationField:
-    "Creates a deformation field for data augmentation"
+    """
+    Creates a deformation field for data augmentation
+
+    Scaling, flips and rotations are composed into a 2x3 affine `matrix` mapping output pixels (row, col, 1) to
+    source coordinates, and `apply` warps with a single `cv2.warpAffine`. The coordinate arrays of the field are
+    only built when `deformationField` is read, from index grids cached per shape. Assigning `deformationField`
+    an explicit field, e.g. an elastic deformation, makes `apply` interpolate it with `cv2.remap`.
+    Non-square shapes give the actual tile; the former coordinate grids were transposed for them.
+    """
     def __init__(self, shape=(540, 540), scale=1, scale_range=(0,0), p_scale=1.):
         self.shape = shape
         self.default_scale = self.scale = scale
@@ -168,16 +180,33 @@ class DeformationField:
         if random.random()<p_scale and sum(scale_range)!=0:
             self.scale = random.uniform(*np.array(scale_range)*scale)
 
-        grid_range = [np.linspace(-(d*self.scale)/2, ((d*self.scale)/2)-1, d) for d in shape]
-        self.deformationField = np.meshgrid(*grid_range)[::-1]
+        # Row and column coordinates of np.linspace(-(d*scale)/2, ((d*scale)/2)-1, d) for each dimension d
+        step = [((d*self.scale)-1)/(d-1) if d > 1 else 0. for d in shape]
+        self.matrix = np.array([[step[0], 0., -(shape[0]*self.scale)/2],
+                                [0., step[1], -(shape[1]*self.scale)/2]])
+        self._field = None
+
+    @property
+    def deformationField(self):
+        "Source coordinates (rows, cols) of every output pixel"
+        if self._field is not None: return self._field
+        rows, cols = _index_grid(tuple(self.shape))
+        return [self.matrix[d,0]*rows + self.matrix[d,1]*cols + self.matrix[d,2] for d in range(2)]
+
+    @deformationField.setter
+    def deformationField(self, field):
+        self._field = list(field)
 
     def rotate(self, theta=0):
         "Rotate deformation field"
-        self.deformationField = [
-                self.deformationField[0] * np.cos(theta)
-                + self.deformationField[1] * np.sin(theta),
-                -self.deformationField[0] * np.sin(theta)
-                + self.deformationField[1] * np.cos(theta),
+        if self._field is None:
+            self.matrix = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]]) @ self.matrix
+            return
+        self._field = [
+                self._field[0] * np.cos(theta)
+                + self._field[1] * np.sin(theta),
+                -self._field[0] * np.sin(theta)
+                + self._field[1] * np.cos(theta),
             ]
 
     def add_random_rotation(self, rotation_range_deg, p=0.5):
@@ -193,7 +222,8 @@ class DeformationField:
         "Mirror deformation fild at dims"
         for d in range(len(self.shape)):
             if dims[d]:
-                self.deformationField[d] = -self.deformationField[d]
+                if self._field is None: self.matrix[d] = -self.matrix[d]
+                else: self._field[d] = -self._field[d]
 
     def add_random_flip(self, p=0.5):
         "Add random flip"
@@ -206,33 +236,74 @@ class DeformationField:
         deform = [d[sliceDef] for d in self.deformationField]
         return [d + offs for (d, offs) in zip(deform, offset)]
 
-
-    def apply(self, data, offset=(0, 0), pad=(0, 0), order=1):
-        "Apply deformation field to image using interpolation"
-
-        outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
-        coords = [np.squeeze(d).astype('float32').reshape(*outshape) for d in self.get(offset, pad)]
-
-        # Get slices to avoid loading all data (.zarr files)
-        sl = []
-        for i in range(len(coords)):
-            cmin, cmax = int(coords[i].min()), int(coords[i].max())
-            dmax = data.shape[i]
+    def _source_slices(self, bounds, data_shape):
+        "Slices of the data covering the coordinate ranges `bounds` (with room for reflection), and their start"
+        sl, starts = [], []
+        for (cmin, cmax), dmax in zip(bounds, data_shape):
+            cmin, cmax = int(cmin), int(cmax)
+            start = cmin
             if cmin<0:
                 cmax = max(-cmin, cmax)
-                cmin = 0
+                cmin = start = 0
             elif cmax>dmax:
-                cmin = min(cmin, 2*dmax-cmax)
+                cmin = start = min(cmin, 2*dmax-cmax)
                 cmax = dmax
-                coords[i] -= cmin
-            else: coords[i] -= cmin
             sl.append(slice(cmin, cmax))
+            starts.append(start)
+        return tuple(sl), starts
 
+    def apply(self, data, offset=(0, 0), pad=(0, 0), order=1):
+        "Apply deformation field to image using interpolation"
 
-        remap_fn = A.augmentations.functional._maybe_process_in_chunks(
-            cv2.remap, map1=coords[1],map2=coords[0], interpolation=order, borderMode=cv2.BORDER_REFLECT
+        outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
+        if self._field is not None:
+            coords = [np.squeeze(d).astype('float32').reshape(*outshape) for d in self.get(offset, pad)]
+            sl, starts = self._source_slices([(c.min(), c.max()) for c in coords], data.shape)
+            remap_fn = A.augmentations.functional._maybe_process_in_chunks(
+                cv2.remap, map1=coords[1]-starts[1], map2=coords[0]-starts[0], interpolation=order, borderMode=cv2.BORDER_REFLECT
+            )
+            return remap_fn(data[sl])
+
+        sl, matrix = self._affine_warp(data.shape, outshape, offset, pad)
+        warp_fn = A.augmentations.functional._maybe_process_in_chunks(
+            cv2.warpAffine, M=matrix, dsize=outshape[::-1], flags=order | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REFLECT
         )
-        return remap_fn(data[tuple(sl)])
+        return warp_fn(data[sl])
+
+    def _affine_warp(self, data_shape, outshape, offset, pad):
+        "Slices of the data read by the affine warp, and the `cv2.warpAffine` matrix mapping output to sliced source pixels"
+        # Affine map of the output pixels: shifted by the padding crop, translated by the offset
+        matrix = self.matrix.copy()
+        crop = np.array([int(p / 2) if p > 0 else 0 for p in pad])
+        matrix[:, 2] += matrix[:, :2] @ crop + np.asarray(offset, dtype=np.float64)
+        corners = matrix @ np.array([[0, 0, outshape[0]-1, outshape[0]-1], [0, outshape[1]-1, 0, outshape[1]-1], [1, 1, 1, 1]])
+        corners = corners.astype('float32')
+        sl, starts = self._source_slices([(c.min(), c.max()) for c in corners], data_shape)
+        matrix[:, 2] -= starts
+        # warpAffine maps (x, y) = (col, row) of the output to (col, row) of the source
+        return sl, matrix[::-1][:, [1, 0, 2]]
+
+    def apply_many(self, datas, offset=(0, 0), pad=(0, 0), order=1):
+        """
+        Applies the deformation to several arrays of the same height and width, e.g. an image and its mask, computing
+        the warp matrix and source slices once. The arrays are warped one by one: stacking their channels into one
+        array for a single warp is slower, as OpenCV's interleaved layout costs a copy in and out.
+        """
+        if self._field is not None or len({d.shape[:2] for d in datas}) > 1:
+            return [self.apply(d, offset, pad, order) for d in datas]
+        outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
+        sl, matrix = self._affine_warp(datas[0].shape, outshape, offset, pad)
+        warp_fn = A.augmentations.functional._maybe_process_in_chunks(
+            cv2.warpAffine, M=matrix, dsize=outshape[::-1], flags=order | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REFLECT
+        )
+        return [warp_fn(d[sl]) for d in datas]
+
+@lru_cache(maxsize=8)
+def _index_grid(shape):
+    "Read-only row and column index arrays of a 2D grid"
+    rows, cols = np.indices(shape, dtype=np.float64)
+    rows.flags.writeable = cols.flags.writeable = False
+    return rows, cols
 
 # Cell
 def _read_img(path, **kwargs):
@@ -278,24 +349,212 @@ def tiles_in_rectangles(H, W, h, w):
 
     return n_H*n_W
 
+# Cell
+class PatchStoreMapping:
+    "Read-only mapping from patch names to the patches of a patch store array, optionally transformed on access"
+    def __init__(self, array, positions, fn=None):
+        self.array, self.positions, self.fn = array, positions, fn
+
+    def __getitem__(self, name):
+        x = self.array[self.positions[name]]
+        return self.fn(x) if self.fn is not None else x
+
+    def __contains__(self, name): return name in self.positions
+    def __len__(self): return len(self.positions)
+    def __iter__(self): return iter(self.positions)
+
+# Cell
+def alias_table(cdf):
+    "Probability and alias tables (Vose) of the distribution given by the cumulated PDF `cdf`, for O(1) sampling"
+    pdf = np.diff(np.asarray(cdf, dtype=np.float64), prepend=0.)
+    pdf = np.clip(pdf, 0, None)
+    n = len(pdf)
+    prob, alias = pdf*n/pdf.sum(), np.arange(n)
+    small, large = np.flatnonzero(prob < 1), np.flatnonzero(prob >= 1)
+    while len(small) and len(large):
+        # Every small bucket is filled up by the large bucket whose excess interval contains the start of its
+        # deficit interval; large buckets that gave away more than their excess become small in the next round
+        deficit = 1 - prob[small]
+        start = np.cumsum(deficit) - deficit
+        donor = np.searchsorted(np.cumsum(prob[large] - 1), start, side='right')
+        filled = donor < len(large)
+        alias[small[filled]] = large[donor[filled]]
+        prob[large] -= np.bincount(donor[filled], weights=deficit[filled], minlength=len(large))
+        if filled.all():
+            small, large = large[prob[large] < 1], large[prob[large] >= 1]
+        else:
+            small = np.concatenate([small[~filled], large[prob[large] < 1]])
+            large = large[prob[large] >= 1]
+            if not filled.any(): break
+    # Leftovers are only off by rounding errors
+    prob[small], prob[large] = 1., 1.
+    return prob, alias
+
+# Cell
+class CenterSampler:
+    """
+    Draws tile centers from the cumulated PDFs of `BaseDataset._create_cdf`, one or a whole batch at a time.
+
+    `method='search'` finds the center by binary search on the CDF (O(log n) per draw), giving the same center
+    as a linear scan `np.argmax(cdf > u)` for the same `u`. `method='alias'` builds an alias table once per
+    CDF and then draws in O(1). CDFs (or alias tables) passed with a `key` are kept in an LRU cache of
+    `cache_size` entries, so they are read from the zarr store (or computed from a patch store mask) only once.
+    An entry takes 4 bytes per CDF value (1 MB with the default `pdf_reshape=512` of a square image), or 16 bytes as
+    alias tables (4 MB), and every `DataLoader` worker fills its own cache: up to `cache_size` entries per worker.
+
+    Random numbers come from a `np.random.Generator` created on first use in every process: in a
+    `DataLoader` worker it is seeded with the seed torch gives the worker (distinct per worker and epoch,
+    reproducible with `torch.manual_seed`), elsewhere with `seed`.
+    """
+    def __init__(self, method='search', seed=None, cache_size=8):
+        if method not in ('search', 'alias'): raise ValueError(f"Unknown sampling method {method!r}, use 'search' or 'alias'")
+        store_attr('method, seed, cache_size')
+        self._rng, self._pid, self._cache = None, None, {}
+
+    @property
+    def rng(self):
+        if self._rng is None or self._pid != os.getpid():
+            info = torch.utils.data.get_worker_info()
+            self._rng = np.random.default_rng(info.seed if info is not None else self.seed)
+            self._pid = os.getpid()
+        return self._rng
+
+    def table(self, cdf, key=None):
+        "Sampling table of `cdf` (an array or a function returning it): the CDF itself, or its alias tables"
+        if key is not None and key in self._cache:
+            self._cache[key] = self._cache.pop(key)
+            return self._cache[key]
+        cdf = np.ravel(cdf() if callable(cdf) else cdf[:])
+        table = alias_table(cdf) if self.method == 'alias' else cdf
+        if key is not None and self.cache_size > 0:
+            if len(self._cache) >= self.cache_size: self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = table
+        return table
+
+    def indices(self, cdf, n=1, key=None):
+        "Draws `n` flat indices into the CDF"
+        table = self.table(cdf, key=key)
+        if self.method == 'alias':
+            prob, alias = table
+            idx = self.rng.integers(len(prob), size=n)
+            return np.where(self.rng.random(n) < prob[idx], idx, alias[idx])
+        # Comparing in the dtype of the CDF, as `cdf > u` does
+        u = self.rng.random(n).astype(table.dtype)
+        idx = np.searchsorted(table, u, side='right')
+        # `u` beyond the last (rounded) CDF value: the last index with probability mass
+        return np.where(idx < len(table), idx, np.searchsorted(table, table[-1], side='left'))
+
+    def centers(self, cdf, orig_shape, reshape=512, n=1, key=None):
+        "Draws `n` centers (rows of an (n, 2) array) in the coordinates of an image of shape `orig_shape`"
+        reshape_y = int((orig_shape[1]/orig_shape[0])*reshape)
+        cx, cy = np.unravel_index(self.indices(cdf, n=n, key=key), (reshape, reshape_y))
+        return np.stack([(cx*orig_shape[0]/reshape).astype(int), (cy*orig_shape[1]/reshape_y).astype(int)], axis=1)
+
+# Cell
+class ChannelStats:
+    """
+    Streaming per-channel pixel statistics: count `n`, `mean` and `m2` (sum of squared deviations from the mean).
+
+    Partial statistics of images, chunks or workers are combined with `merge` (Chan et al.'s parallel update), so
+    the mean and std of a dataset are exact over all of its pixels, whatever the order and grouping. uint8 images
+    are reduced in a single pass to per-channel histograms, with exact integer sums and no float copy of the image.
+    """
+    def __init__(self, n=0, mean=0., m2=0.):
+        self.n, self.mean, self.m2 = int(n), np.asarray(mean, dtype=np.float64), np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def from_image(cls, img):
+        "Statistics of the pixels of `img`, of shape (..., channels)"
+        img = np.asarray(img)
+        pixels = img.reshape(-1, img.shape[-1])
+        n = len(pixels)
+        if n == 0: return cls()
+        if img.dtype != np.uint8:
+            mean = pixels.mean(0, dtype=np.float64)
+            return cls(n, mean, ((pixels-mean)**2).sum(0))
+        counts = _channel_histograms(pixels)
+        sums, squares = counts @ np.arange(256), counts @ np.arange(256)**2
+        # m2 = squares - sums**2/n, exactly in Python integers before the division
+        m2 = [(n*int(q) - int(p)**2)/n for p, q in zip(sums, squares)]
+        return cls(n, sums/n, m2)
+
+    def update(self, img):
+        "Adds the pixels of `img`"
+        return self.merge(ChannelStats.from_image(img))
+
+    def merge(self, other):
+        "Adds the pixels summarized by `other`"
+        if other.n == 0: return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*(other.n/n)
+        self.m2 = self.m2 + other.m2 + delta**2*(self.n*other.n/n)
+        self.n = n
+        return self
+
+    def scaled(self, scale):
+        "Statistics of the pixels multiplied by `scale`"
+        return ChannelStats(self.n, self.mean*scale, self.m2*scale**2)
+
+    @property
+    def std(self): return np.sqrt(self.m2/self.n)
+
+    def as_dict(self): return {'n': self.n, 'mean': self.mean.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, d): return cls(d['n'], d['mean'], d['m2'])
+
+def _channel_histograms(pixels, max_rows=2**24-1):
+    "Per-channel value counts (channels, 256) of uint8 `pixels` (n, channels), in chunks exactly counted by `cv2.calcHist`"
+    counts = np.zeros((pixels.shape[1], 256), dtype=np.int64)
+    for start in range(0, len(pixels), max_rows):
+        chunk = np.ascontiguousarray(pixels[start:start+max_rows])[:, None]
+        for c in range(pixels.shape[1]):
+            counts[c] += cv2.calcHist([chunk], [c], None, [256], [0, 256]).ravel().astype(np.int64)
+    return counts
+
+# Cell
+def _file_stamps(paths):
+    "Size and modification time of every file, to skip hashing unchanged files"
+    return [[os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths]
+
+def _default_preproc_dir(files):
+    "Persistent preprocessing store of a set of files, in the user cache folder and named after their resolved paths"
+    digest = hashlib.sha256('\n'.join(sorted(str(Path(f).resolve()) for f in files)).encode()).hexdigest()[:16]
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'nuclei_preproc', f'{digest}.zarr')
+
+# Dataset being preprocessed, inherited by the forked preprocessing workers
+_preproc_dataset = None
+
+def _preproc_arrays_worker(file):
+    return _preproc_dataset._preproc_arrays(file)
+
 # Cell
 class BaseDataset(Dataset):
     def __init__(self, files, label_fn=None, instance_labels = False, num_classes=2, ignore={},remove_connectivity=True,
                  stats=None,normalize=True, use_zarr_data=True,
-                 tile_shape=(512,512), padding=(0,0),preproc_dir=None, verbose=1, scale=1, pdf_reshape=512, use_preprocessed_labels=False, **kwargs):
-        store_attr('files, label_fn, instance_labels, num_classes, ignore, tile_shape, remove_connectivity, padding, preproc_dir, stats, normalize, scale, pdf_reshape, use_preprocessed_labels')
+                 tile_shape=(512,512), padding=(0,0),preproc_dir=None, verbose=1, scale=1, pdf_reshape=512, use_preprocessed_labels=True,
+                 patch_store=None, preproc_workers=1, **kwargs):
+        store_attr('files, label_fn, instance_labels, num_classes, ignore, tile_shape, remove_connectivity, padding, preproc_dir, stats, normalize, scale, pdf_reshape, use_preprocessed_labels, patch_store, preproc_workers')
         self.c = num_classes
         self.use_zarr_data=False
 
+        self.actual_tile_shape = (np.array(self.tile_shape)-np.array(self.padding))
         if self.stats is None:
-            self.mean_sum, self.var_sum = 0., 0.
+            self.channel_stats = ChannelStats()
             self.max_tile_count = 0
-            self.actual_tile_shape = (np.array(self.tile_shape)-np.array(self.padding))
 
-        if label_fn is not None:
-            self.preproc_dir = self.preproc_dir or zarr.storage.TempStore()
+        if patch_store is not None:
+            self._open_patch_store(patch_store, verbose=verbose)
+        elif label_fn is not None:
+            # Persistent by default: later runs reuse the outputs of every unchanged file
+            self.preproc_dir = self.preproc_dir or _default_preproc_dir(files)
             root = zarr.group(store=self.preproc_dir, overwrite= not use_preprocessed_labels)
-            self.data, self.labels, self.pdfs  = root.require_groups('data', 'labels','pdfs')
+            self.data, self.labels, self.pdfs, self.meta = root.require_groups('data', 'labels', 'pdfs', 'meta')
             self._preproc(use_zarr_data=use_zarr_data, verbose=verbose)
 
     def read_img(self, path, **kwargs):
@@ -340,54 +599,176 @@ class BaseDataset(Dataset):
 
         return np.cumsum(pdf/np.sum(pdf))
 
-    def _preproc_file(self, file, use_zarr_data=True):
-        "Preprocesses and saves images, labels (msk), weights, and pdf."
-
-        # Load and save image
-        img = self.read_img(file)
-
-        if self.stats is None:
-            self.mean_sum += img.mean((0,1))
-            self.var_sum += img.var((0,1))
-            self.max_tile_count = max(self.max_tile_count, tiles_in_rectangles(*img.shape[:2], *self.actual_tile_shape))
-        if use_zarr_data: self.data[file.name] = img
-
+    def _source_paths(self, file):
+        "Files the preprocessed outputs of `file` are computed from: the image and its label, with the files of zarr folders"
+        paths = [Path(file)] + ([Path(self.label_fn(file))] if self.label_fn is not None else [])
+        return [p for path in paths for p in (sorted(q for q in path.rglob('*') if q.is_file()) if path.is_dir() else [path])]
+
+    def _cache_params(self, file):
+        "Parameters the preprocessed outputs of `file` depend on, part of its cache key"
+        ign = self.ignore[file.name] if file.name in self.ignore else None
+        return {'num_classes': self.c, 'instance_labels': self.instance_labels, 'remove_connectivity': self.remove_connectivity,
+                'pdf_reshape': self.pdf_reshape, 'tile_shape': list(self.tile_shape), 'padding': list(self.padding),
+                'ignore': None if ign is None else hashlib.sha256(np.ascontiguousarray(ign[:]).tobytes()).hexdigest()}
+
+    def _preproc_arrays(self, file):
+        "Reads `file` and computes its label, pdf, image statistics and cache key (runs in the preprocessing workers)"
+        img = self.read_img(file)[:]
+        paths, params = self._source_paths(file), self._cache_params(file)
+        meta = {'key': cache_key(paths, params), 'params': params, 'stamps': _file_stamps(paths),
+                'channel_stats': ChannelStats.from_image(img).as_dict(),
+                'max_tiles': tiles_in_rectangles(*img.shape[:2], *self.actual_tile_shape)}
+        lbl, pdf = None, None
         if self.label_fn is not None:
-            # Load and save image
-            label_path = self.label_fn(file)
             ign = self.ignore[file.name] if file.name in self.ignore else None
-            lbl = self.read_mask(label_path,  num_classes=self.c, instance_labels=self.instance_labels, remove_connectivity=self.remove_connectivity)
+            lbl = self.read_mask(self.label_fn(file), num_classes=self.c, instance_labels=self.instance_labels, remove_connectivity=self.remove_connectivity)
+            pdf = self._create_cdf(lbl, ignore=ign)
+        return img, lbl, pdf, meta
+
+    def _store_file(self, file, img, lbl, pdf, meta, use_zarr_data=True):
+        "Saves the outputs of `file`; its `meta` entry is written last and marks them as complete"
+        if file.name in self.meta: del self.meta[file.name]
+        if use_zarr_data: self.data[file.name] = img
+        if lbl is not None:
             self.labels[file.name] = lbl
-            self.pdfs[file.name] = self._create_cdf(lbl, ignore=ign)
+            self.pdfs[file.name] = pdf
+        self.meta.zeros(file.name, shape=0, dtype='u1', overwrite=True).attrs.put(meta)
+
+    def _cached_meta(self, file, use_zarr_data=True):
+        """
+        Metadata of the outputs of `file` held by the store, or None when they are missing, incomplete, or were
+        computed from other file contents or parameters. Files whose size and modification time are unchanged
+        are not hashed again.
+        """
+        if file.name not in self.meta: return None
+        meta = self.meta[file.name].attrs.asdict()
+        groups = ([self.data] if use_zarr_data else []) + ([self.labels, self.pdfs] if self.label_fn is not None else [])
+        if meta.get('params') != self._cache_params(file) or not all(file.name in g for g in groups): return None
+        paths = self._source_paths(file)
+        stamps = _file_stamps(paths)
+        if meta['stamps'] != stamps:
+            if cache_key(paths, meta['params']) != meta['key']: return None
+            self.meta[file.name].attrs['stamps'] = stamps
+        return meta
+
+    def _preproc_file(self, file, use_zarr_data=True):
+        "Preprocesses and saves images, labels (msk), weights, and pdf."
+        *arrays, meta = self._preproc_arrays(file)
+        self._store_file(file, *arrays, meta, use_zarr_data=use_zarr_data)
+        return meta
+
+    def _preproc_outputs(self, files):
+        "Yields `(file, outputs of _preproc_arrays)` in order, computed across `preproc_workers` forked processes"
+        workers = self.preproc_workers or os.cpu_count() or 1
+        if workers == 1 or len(files) < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+            for f in files: yield f, self._preproc_arrays(f)
+            return
+        global _preproc_dataset
+        _preproc_dataset = self
+        try:
+            with ProcessPoolExecutor(min(workers, len(files)), mp_context=multiprocessing.get_context('fork')) as pool:
+                yield from zip(files, pool.map(_preproc_arrays_worker, files))
+        finally:
+            _preproc_dataset = None
 
     def _preproc(self, use_zarr_data=True, verbose=0):
-        using_cache = False
         if verbose>0: print('Preprocessing data')
-        for f in progress_bar(self.files, leave=True if verbose>0 else False):
-            if self.use_preprocessed_labels:
-                try:
-                    self.data[f.name]
-                    if self.label_fn is not None:
-                        self.labels[f.name]
-                        self.pdfs[f.name]
-                        if not using_cache:
-                            #if verbose>0: print(f'Using preprocessed data from {self.preproc_dir}')
-                            using_cache = True
-                except:
-                    self._preproc_file(f, use_zarr_data=use_zarr_data)
-            else:
-                self._preproc_file(f, use_zarr_data=use_zarr_data)
+        metas = {}
+        if self.use_preprocessed_labels:
+            for f in self.files:
+                meta = self._cached_meta(f, use_zarr_data=use_zarr_data)
+                if meta is not None: metas[f.name] = meta
+            if metas and verbose>0: print(f'Using preprocessed data of {len(metas)} file(s) from {self.preproc_dir}')
+        stale = [f for f in self.files if f.name not in metas]
+        for f, (*arrays, meta) in progress_bar(self._preproc_outputs(stale), total=len(stale), leave=True if verbose>0 else False):
+            self._store_file(f, *arrays, meta, use_zarr_data=use_zarr_data)
+            metas[f.name] = meta
 
         self.use_zarr_data=use_zarr_data
 
         if self.stats is None:
-            n = len(self.files)
-             #https://stackoverflow.com/questions/60101240/finding-mean-and-standard-deviation-across-image-channels-pytorch/60803379#60803379
-            self.stats = {'channel_means': self.mean_sum/n,
-                          'channel_stds': np.sqrt(self.var_sum/n),
-                          'max_tiles_per_image': self.max_tile_count}
+            # Exact over all pixels: the per-file statistics (also those of cached files) are merged
+            for meta in metas.values():
+                self.channel_stats.merge(ChannelStats.from_dict(meta['channel_stats']))
+                self.max_tile_count = max(self.max_tile_count, meta['max_tiles'])
+            self.stats = self._stats_dict()
             print('Calculated stats', self.stats)
 
+    def _stats_dict(self):
+        return {'channel_means': self.channel_stats.mean,
+                'channel_stds': self.channel_stats.std,
+                'max_tiles_per_image': self.max_tile_count}
+
+    def _patch_store_label(self, msk):
+        "Converts an instance mask patch of a patch store like `_read_msk` does for label files"
+        msk = np.asarray(msk)
+        if msk.ndim == 3: msk = msk[...,0]
+        if self.instance_labels:
+            msk = preprocess_mask(clabels=None, instlabels=msk, remove_connectivity=self.remove_connectivity, num_classes=self.c)
+        elif self.c == 2:
+            msk = msk > 0
+        return msk.astype('uint8')
+
+    def _open_patch_store(self, path, verbose=0):
+        "Uses the patches of a zarr patch store (written with `--format zarr`) as files, images and labels"
+        root = zarr.open_group(str(path), mode='r')
+        positions = {}
+        for s in root.attrs['sources']:
+            for i in range(s['rows']*s['cols']):
+                positions[f"{s['source']}_{i}"] = s['offset'] + i
+        if self.files is not None:
+            positions = {Path(f).name: positions[Path(f).name] for f in self.files}
+        self.files = L(Path(n) for n in positions)
+
+        # Compact (uint8) images are scaled on access; labels and pdfs are derived per patch on access
+        self.image_scale = root.attrs['attrs'].get('scales', {}).get('images')
+        self.data = PatchStoreMapping(root['images'], positions, fn=self._patch_store_image if self.image_scale is not None else None)
+        if 'masks' in root:
+            self.label_fn = self._patch_store_label_fn
+            self.labels = PatchStoreMapping(root['masks'], positions, fn=self._patch_store_label)
+            self.pdfs = PatchStoreMapping(root['masks'], positions, fn=self._patch_store_pdf)
+        self.use_zarr_data = True
+
+        if self.stats is None:
+            images = root['images']
+            idxs = np.array(sorted(positions.values()))
+            self.max_tile_count = tiles_in_rectangles(*images.shape[1:3], *self.actual_tile_shape)
+            self.channel_stats = self._patch_store_stats(path, root, idxs)
+            self.stats = self._stats_dict()
+            if verbose>0: print('Calculated stats', self.stats)
+
+    def _patch_store_stats(self, path, root, idxs):
+        """
+        Channel statistics of the selected patches of a patch store, computed on the stored (raw uint8 when compact)
+        pixels and scaled. They are saved to `{store}.stats.json` and reused while the store and selection are unchanged.
+        """
+        attrs_path = Path(str(path))/'.zattrs'
+        key = cache_key([], {'attrs': root.attrs.asdict(), 'stamps': _file_stamps([attrs_path]) if attrs_path.exists() else None,
+                             'images': [root['images'].shape, str(root['images'].dtype)],
+                             'patches': hashlib.sha256(idxs.astype(np.int64).tobytes()).hexdigest()})
+        stats_path = Path(f"{str(path).rstrip('/')}.stats.json")
+        if stats_path.exists():
+            saved = json.loads(stats_path.read_text())
+            if saved.get('key') == key: return ChannelStats.from_dict(saved['channel_stats'])
+        stats = ChannelStats()
+        for start in range(0, len(idxs), 64):
+            stats.update(root['images'].get_orthogonal_selection(idxs[start:start+64]))
+        if self.image_scale is not None: stats = stats.scaled(self.image_scale)
+        try: stats_path.write_text(json.dumps({'key': key, 'channel_stats': stats.as_dict()}))
+        except OSError: pass
+        return stats
+
+    def _patch_store_image(self, img):
+        "Scales an image patch stored as raw pixels (`--compact`) to float32 in [0, 1]"
+        return img.astype(np.float32) * np.float32(self.image_scale)
+
+    def _patch_store_pdf(self, msk):
+        return self._create_cdf(self._patch_store_label(msk), ignore=None)
+
+    def _patch_store_label_fn(self, file):
+        "Labels of patch store datasets are looked up by file name in `self.labels`"
+        return file
+
     def get_data(self, files=None, max_n=None, mask=False):
         if files is not None:
             files = L(files)
@@ -423,12 +804,19 @@ class BaseDataset(Dataset):
 class RandomTileDataset(BaseDataset):
     """
     Pytorch Dataset that creates random tiles with augmentations from the input images.
+
+    Tile centers are drawn from the PDF of each image by a `CenterSampler` (`sampling='search'` or `'alias'`,
+    seeded with `sampling_seed` outside of `DataLoader` workers).
+
+    Indexing with a list of indices returns a whole batch from `get_batch`, so a `DataLoader` with a batch sampler
+    (see `batch_dataloader`) augments and normalizes its batches at once.
     """
     n_inp = 1
     def __init__(self, *args, sample_mult=None, flip=True, rotation_range_deg=(0, 360), scale_range=(0, 0),
-                 albumentations_tfms=[A.RandomGamma()], min_length=400, **kwargs):
+                 albumentations_tfms=[A.RandomGamma()], min_length=400, sampling='search', sampling_seed=None, **kwargs):
         super().__init__(*args, **kwargs)
         store_attr('sample_mult, flip, rotation_range_deg, scale_range, albumentations_tfms')
+        self.sampler = CenterSampler(sampling, seed=sampling_seed)
 
         # Sample mulutiplier: Number of random samplings from augmented image
         if self.sample_mult is None:
@@ -437,7 +825,8 @@ class RandomTileDataset(BaseDataset):
             self.sample_mult = max(int(self.stats['max_tiles_per_image']/self.scale**2),
                                    min_length//len(self.files))
 
-        tfms = self.albumentations_tfms
+        tfms = list(self.albumentations_tfms)
+        self.aug_tfms = A.Compose(list(self.albumentations_tfms))
         if self.normalize:
             tfms += [
                 A.Normalize(mean=self.stats['channel_means'],
@@ -446,36 +835,42 @@ class RandomTileDataset(BaseDataset):
             ]
         self.tfms =  A.Compose(tfms+[ToTensorV2()])
 
-    def _random_center(self, pdf, orig_shape, reshape=512):
+    def _random_center(self, pdf, orig_shape, reshape=512, key=None):
         'Sample random center using PDF'
-        reshape_y = int((orig_shape[1]/orig_shape[0])*reshape)
-        cx, cy = np.unravel_index(np.argmax(pdf > random.random()), (reshape,reshape_y))
-        cx = int(cx*orig_shape[0]/reshape)
-        cy = int(cy*orig_shape[1]/reshape_y)
-        return cx, cy
+        cx, cy = self.sampler.centers(pdf, orig_shape, reshape=reshape, key=key)[0]
+        return int(cx), int(cy)
+
+    def random_centers(self, name, n):
+        "Draws `n` tile centers of image `name` at once, as an (n, 2) array"
+        return self.sampler.centers(lambda: self.pdfs[name][:], self.labels[name].shape, key=name, n=n)
 
     def __len__(self):
         return len(self.files)*self.sample_mult
 
+    def _deformation_field(self):
+        "Random flip, rotation and scale of one tile"
+        deformationField = DeformationField(self.tile_shape, self.scale, self.scale_range)
+        if self.flip:
+            deformationField.add_random_flip(self.flip)
+
+        if self.rotation_range_deg[1] > self.rotation_range_deg[0]:
+            deformationField.add_random_rotation(self.rotation_range_deg)
+        return deformationField
+
     def __getitem__(self, idx):
-        idx = idx % len(self.files)
         if torch.is_tensor(idx):
             idx = idx.tolist()
+        if isinstance(idx, (list, tuple)):
+            return self.get_batch(idx)
+        idx = idx % len(self.files)
 
         img_path = self.files[idx]
         img = self.read_img(img_path)
 
         msk = self.labels[img_path.name]
-        pdf = self.pdfs[img_path.name]
-        center = self._random_center(pdf[:], msk.shape)
-
-        deformationField = DeformationField(self.tile_shape, self.scale, self.scale_range)
-        if self.flip:
-            deformationField.add_random_flip(self.flip)
-
-        if self.rotation_range_deg[1] > self.rotation_range_deg[0]:
-            deformationField.add_random_rotation(self.rotation_range_deg)
+        center = self._random_center(lambda: self.pdfs[img_path.name][:], msk.shape, key=img_path.name)
 
+        deformationField = self._deformation_field()
         img = deformationField.apply(img, center)
         msk = deformationField.apply(msk, center)
 
@@ -483,6 +878,43 @@ class RandomTileDataset(BaseDataset):
 
         return  aug['image'], aug['mask'].type(torch.int64)
 
+    def get_batch(self, idxs):
+        """
+        Tiles of several indices at once, as an image batch (N, C, H, W) and a mask batch (N, H, W).
+
+        The centers of all tiles of an image are drawn together, image and mask of every tile are warped with the
+        same matrix and source slices, and the batch is normalized with one vectorized operation into a contiguous
+        array instead of per sample, without per-sample tensor conversions and collation.
+        """
+        idxs = [i % len(self.files) for i in idxs]
+        centers = {i: iter(self.random_centers(self.files[i].name, idxs.count(i))) for i in set(idxs)}
+        imgs, msks = [], []
+        for i in idxs:
+            img_path = self.files[i]
+            img, msk = self._deformation_field().apply_many([self.read_img(img_path), self.labels[img_path.name]],
+                                                            tuple(int(c) for c in next(centers[i])))
+            if self.albumentations_tfms:
+                aug = self.aug_tfms(image=img, mask=msk)
+                img, msk = aug['image'], aug['mask']
+            imgs.append(img.reshape(*img.shape[:2], -1))
+            msks.append(msk)
+        imgs = np.stack(imgs).transpose(0, 3, 1, 2)
+        if self.normalize:
+            # As A.Normalize(max_pixel_value=1.0), on the whole (contiguous) batch
+            mean = np.asarray(self.stats['channel_means'], dtype=np.float32)[:, None, None]
+            denominator = np.reciprocal(np.asarray(self.stats['channel_stds'], dtype=np.float32))[:, None, None]
+            batch = np.empty(imgs.shape, dtype=np.float32)
+            np.subtract(imgs, mean, out=batch)
+            batch *= denominator
+        else: batch = np.ascontiguousarray(imgs)
+        return torch.from_numpy(batch), torch.from_numpy(np.stack(msks).astype(np.int64))
+
+# Cell
+def batch_dataloader(dataset, batch_size, shuffle=True, drop_last=False, **kwargs):
+    "`DataLoader` fetching whole batches of `dataset` at once through its `get_batch` (e.g. `RandomTileDataset`)"
+    sampler = torch.utils.data.RandomSampler(dataset) if shuffle else torch.utils.data.SequentialSampler(dataset)
+    return DataLoader(dataset, batch_size=None, sampler=torch.utils.data.BatchSampler(sampler, batch_size, drop_last), **kwargs)
+
 # Cell
 class TileDataset(BaseDataset):
     "Pytorch Dataset that creates random tiles for validation and prediction on new data."
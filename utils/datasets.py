@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from utils.labels import load_label, load_labels
+from utils.masks import NucleusTable
+from utils.pannuke import PanNukeJob
+from utils.pipeline import PatchJob
+
+# Dataset adapters by name, filled by `register_dataset`
+DATASETS = {}
+
+
+def register_dataset(cls):
+    "Class decorator adding an instance of a dataset adapter to `DATASETS` under its `name`."
+    DATASETS[cls.name] = cls()
+    return cls
+
+
+def get_dataset(name):
+    "The registered adapter of a dataset, looked up case-insensitively."
+    for key, adapter in DATASETS.items():
+        if key.lower() == name.lower():
+            return adapter
+    raise KeyError(f"Unknown dataset {name!r}, expected one of {sorted(DATASETS)}")
+
+
+class PatchDataset:
+    """
+    Adapter of a dataset of large images and instance masks that are tiled into patches by `utils.pipeline`.
+
+    Subclasses only describe how the dataset differs from the others: how its files are laid out and
+    paired, how its masks are read, and the defaults of its patch grid and dtypes. Loading, erosion,
+    border cleaning, caching, journaling and writing are shared by every dataset.
+    """
+    name = None
+    # Subsets processed when none are given, and the output folder of each (defaults to the subset name)
+    subsets = ["train", "test"]
+    output_subsets = {}
+    # Layout of a subset: {base_dir}/{name}/{subset}/{image_folder} and .../{mask_folder}
+    image_folder, mask_folder = "Images", "Labels"
+    # A mask is found by replacing the image suffix of the image filename with the mask suffix
+    image_suffix, mask_suffix = ".png", ".mat"
+    # Patch filename of the .npy format; the mask patch filename replaces "image" with "mask"
+    patch_template = "{dataset}_{base}_{index}.npy"
+    window_size, stride = 256, 64
+    mask_dtype, compact_mask_dtype = np.int32, np.uint16
+    # Masks are binary (thresholded at 0.5) instead of instance maps
+    binarize = False
+    # Border cleaning: connectivity of the cells, and whether mask patches become component labels
+    border_connectivity, border_labels = None, True
+    # Whether the erosion channel stack has an empty channel for the background (see `channel_index_map`)
+    background_channel = False
+    # Whether the labels have nuclear types and centroids (see `load_typed_mask`)
+    has_types = True
+
+    def list_images(self, image_directory):
+        "Sorted source image filenames of a subset."
+        return sorted(f for f in os.listdir(image_directory) if f.endswith(self.image_suffix))
+
+    def base_filename(self, filename):
+        "Image filename without its suffix, naming its patches."
+        return filename[:-len(self.image_suffix)]
+
+    def mask_filename(self, filename):
+        "Filename of the mask paired with an image."
+        return filename.replace(self.image_suffix, self.mask_suffix)
+
+    def load_mask(self, mask_path, cache_dir=None):
+        "Reads the instance map of an image, through the decoded label cache in `cache_dir` if given."
+        return load_label(mask_path, "inst_map", cache_dir=cache_dir)  # Ensure the key matches your .mat file
+
+    def load_typed_mask(self, mask_path, cache_dir=None):
+        "Instance map, type map and `NucleusTable` of an image, decoded from its .mat file in one parse."
+        labels = load_labels(mask_path, ["inst_map", "type_map", "inst_centroid", "inst_type"], cache_dir=cache_dir)
+        nuclei = NucleusTable(labels["inst_map"], labels["inst_centroid"], labels["inst_type"])
+        return labels["inst_map"], labels["type_map"], nuclei
+
+    def patch_filenames(self, dataset, base_filename, index):
+        "Names of the .npy files of patch `index` of an image, in the images and masks folders."
+        img_patch_filename = self.patch_template.format(dataset=dataset, base=base_filename, index=index)
+        mask_patch_filename = img_patch_filename.replace("image", "mask")
+        return img_patch_filename, mask_patch_filename
+
+    def directories(self, base_dir, subset):
+        "Source image and mask folders and output image and mask folders of a subset."
+        root = os.path.join(base_dir, self.name)
+        output_root = os.path.join(root, "preprocessed", self.output_subsets.get(subset, subset))
+        return (os.path.join(root, subset, self.image_folder), os.path.join(root, subset, self.mask_folder),
+                os.path.join(output_root, "images"), os.path.join(output_root, "labels"))
+
+    def jobs(self, base_dir, subsets=None, output_format="npy", compact=False, force=False, resume=False,
+             erosion=False, window_size=None, stride=None, label_cache=True, types=False,
+             writers=0, **options):
+        """
+        One `PatchJob` per subset of the dataset found under `base_dir`.
+
+        `types` is ignored for datasets without nuclear types, and `**options` are options of other
+        datasets (e.g. PanNuke's `batch_size`), ignored here.
+        """
+        return [PatchJob(self, *self.directories(base_dir, subset), erosion=erosion, remove_cells_borders=True,
+                         output_format=output_format, compact=compact, force=force, resume=resume, window_size=window_size,
+                         stride=stride, label_cache=label_cache, types=types and self.has_types, writers=writers)
+                for subset in subsets or self.subsets]
+
+
+@register_dataset
+class ConSep(PatchDataset):
+    name = "ConSep"
+
+
+@register_dataset
+class CPM17(PatchDataset):
+    name = "CPM17"
+    # The CPM17 release only has instance maps, no type_map
+    has_types = False
+
+
+@register_dataset
+class MoNuSeg(PatchDataset):
+    name = "MoNuSeg"
+    output_subsets = {"train": "fold0", "test": "fold1"}
+    image_folder, mask_folder = "images", "masks"
+    image_suffix, mask_suffix = ".tif", "_mask.png"
+    patch_template = "{dataset}_{base}_image_{index}.npy"
+    stride = 128
+    mask_dtype, compact_mask_dtype = np.uint8, np.uint8
+    binarize = True
+    border_connectivity, border_labels = 1, False
+    background_channel = True
+    has_types = False
+
+    def load_mask(self, mask_path, cache_dir=None):
+        # PNG masks are decoded directly; the binarization step needs a writable copy anyway
+        return np.array(Image.open(mask_path))
+
+
+@register_dataset
+class PanNuke:
+    """Adapter of the PanNuke folds, which are already 256x256 samples and are converted batch by batch by `utils.pannuke`."""
+    name = "PanNuke"
+    subsets = ["1", "2", "3"]
+
+    def jobs(self, base_dir, subsets=None, output_format="npy", compact=False, force=False, resume=False,
+             batch_size=256, encoding="channels", **options):
+        "A single `PanNukeJob` for the given folds."
+        root = os.path.join(base_dir, self.name)
+        return [PanNukeJob([int(fold) for fold in subsets or self.subsets], raw_dir=os.path.join(root, "raw_data"),
+                           output_dir=os.path.join(root, "preped"), output_format=output_format, compact=compact,
+                           batch_size=batch_size, encoding=encoding, force=force, resume=resume)]
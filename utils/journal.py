@@ -0,0 +1,64 @@
+import json
+import os
+
+JOURNAL_FILENAME = "journal.jsonl"
+
+
+def journal_path(output_folder, output_format="npy"):
+    """Location of the progress journal of a subset, next to its images/labels folders (one per output format)."""
+    name = JOURNAL_FILENAME if output_format == "npy" else JOURNAL_FILENAME.replace(".jsonl", f".{output_format}.jsonl")
+    return os.path.join(os.path.dirname(os.path.normpath(output_folder)), name)
+
+
+class RunJournal:
+    """
+    Append-only progress journal of a run, for resuming it after a crash.
+
+    Each completed source (an image, or a batch of a PanNuke fold) is appended as one JSON line and
+    synced to disk as soon as all its outputs are written, so after the process dies the journal
+    lists exactly the sources whose outputs are complete. Lines carry the cache key the source was
+    built with; a resumed run only trusts entries built with the same key.
+
+    Parameters:
+        path (str): Path of the journal file.
+        resume (bool): Keep and read an existing journal. Otherwise it is cleared and a new run starts.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may have been cut off by the crash
+                        continue
+                    self.entries[entry["source"]] = entry
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def done(self, source, key=None):
+        "Whether `source` was completed (with the cache key `key`, if given)."
+        entry = self.entries.get(source)
+        return entry is not None and (key is None or entry.get("key") == key)
+
+    def patches(self, source):
+        "Number of patches (or samples) written for a completed source."
+        return self.entries[source]["patches"]
+
+    def append(self, source, patches, key=None):
+        "Records `source` as completed."
+        entry = {"source": source, "patches": patches, "key": key}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[source] = entry
+
+    def remove(self):
+        "Deletes the journal once the run has completed."
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.entries = {}
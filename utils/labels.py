@@ -0,0 +1,106 @@
+import hashlib
+import os
+
+import numpy as np
+from scipy.io import loadmat
+
+from utils.store import atomic_save
+
+# Default folder of the decoded label cache, next to the image and label folders of a subset
+LABEL_CACHE_FOLDER = ".label_cache"
+
+
+def load_mat_variable(mat_path, name="inst_map"):
+    """Decodes a single variable of a MAT file; the others (`type_map`, `inst_type`, `inst_centroid`...) are skipped."""
+    return loadmat(mat_path, variable_names=[name])[name]
+
+
+def load_mat_variables(mat_path, names):
+    """
+    Decodes the given variables of a MAT file in a single parse, as a dict; the other variables are skipped.
+    Raises a ValueError naming the file and the variables it does not contain.
+    """
+    mat = loadmat(mat_path, variable_names=list(names))
+    missing = [name for name in names if name not in mat]
+    if missing:
+        raise ValueError(f"{mat_path} has no variable(s) {missing}; its labels may not have nuclear types")
+    return {name: mat[name] for name in names}
+
+
+def label_cache_dir(output_folder):
+    """
+    Default label cache folder of a subset, next to its build manifest in the output tree rather than in the
+    (possibly read-only) dataset, e.g. `ConSep/preprocessed/train/.label_cache` for `ConSep/preprocessed/train/images`.
+    """
+    return os.path.join(os.path.dirname(os.path.normpath(output_folder)), LABEL_CACHE_FOLDER)
+
+
+class LabelCache:
+    """
+    Persistent cache of variables decoded from MAT label files, stored as one .npy file per file and variable.
+
+    The first load of a variable parses the MAT file (that variable only) and saves the decoded array;
+    later loads memory-map the .npy file instead, so they cost a header read plus the pages actually
+    touched. A cached array is used only while its MAT file keeps the modification time it was decoded
+    from (the cache file is given the same mtime), so edited labels are decoded again.
+
+    Parameters:
+        cache_dir (str): Folder of the cache files, created on first use.
+        mmap_mode (str, optional): `np.load` mode of cached arrays; "r" gives read-only memory maps,
+                                   None loads them into memory.
+    """
+    def __init__(self, cache_dir, mmap_mode='r'):
+        self.cache_dir = cache_dir
+        self.mmap_mode = mmap_mode
+
+    def path(self, mat_path, name="inst_map"):
+        "Cache file of variable `name` of a MAT file; the hash of its absolute path keeps same-named files apart."
+        digest = hashlib.sha1(f"{os.path.abspath(mat_path)}:{name}".encode()).hexdigest()[:16]
+        base = os.path.splitext(os.path.basename(mat_path))[0]
+        return os.path.join(self.cache_dir, f"{base}.{name}.{digest}.npy")
+
+    def is_fresh(self, mat_path, name="inst_map"):
+        "Whether the cache holds variable `name` of the current version of a MAT file."
+        path = self.path(mat_path, name)
+        return os.path.exists(path) and os.stat(path).st_mtime_ns == os.stat(mat_path).st_mtime_ns
+
+    def load(self, mat_path, name="inst_map"):
+        "Variable `name` of a MAT file, memory-mapped from the cache if fresh, otherwise decoded and cached."
+        return self.load_many(mat_path, [name])[name]
+
+    def load_many(self, mat_path, names):
+        "Several variables of a MAT file as a dict; the ones missing from the cache are decoded in a single parse."
+        arrays = {name: np.load(self.path(mat_path, name), mmap_mode=self.mmap_mode)
+                  for name in names if self.is_fresh(mat_path, name)}
+        stale = [name for name in names if name not in arrays]
+        if stale:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            mtime = os.stat(mat_path).st_mtime_ns
+            for name, array in load_mat_variables(mat_path, stale).items():
+                path = self.path(mat_path, name)
+                atomic_save(path, array)
+                os.utime(path, ns=(os.stat(path).st_atime_ns, mtime))
+                arrays[name] = array
+        return {name: arrays[name] for name in names}
+
+
+def load_label(mat_path, name="inst_map", cache_dir=None):
+    """
+    Loads one variable of a MAT label file, through a `LabelCache` in `cache_dir` when it is given.
+
+    Parameters:
+        mat_path (str): Path of the .mat file.
+        name (str): Variable to decode, e.g. "inst_map" or "type_map".
+        cache_dir (str, optional): Label cache folder; None decodes the MAT file without caching.
+
+    Returns:
+        numpy.ndarray: The decoded array (a read-only memory map when read from the cache).
+    """
+    return load_labels(mat_path, [name], cache_dir=cache_dir)[name]
+
+
+def load_labels(mat_path, names, cache_dir=None):
+    """Loads several variables of a MAT label file with one parse at most, as a dict; see `load_label`."""
+    if cache_dir is None:
+        return load_mat_variables(mat_path, names)
+    return LabelCache(cache_dir).load_many(mat_path, names)
@@ -0,0 +1,154 @@
+import numpy as np
+from skimage import measure
+from skimage.morphology import disk
+
+from utils.staging import count
+
+
+def border_labels(labels):
+    """
+    Returns a boolean lookup table marking the labels that touch the image border.
+
+    Parameters:
+        labels (numpy.ndarray): 2D integer label image.
+
+    Returns:
+        numpy.ndarray: Array of length `labels.max() + 1`; entry `i` is True if label `i` occurs in
+                       the first/last row or column. The background entry 0 is always False.
+    """
+    n_labels = int(labels.max()) + 1 if labels.size else 1
+    touches = np.zeros(n_labels, dtype=bool)
+    touches[labels[0, :]] = True
+    touches[labels[-1, :]] = True
+    touches[labels[:, 0]] = True
+    touches[labels[:, -1]] = True
+    touches[0] = False
+    return touches
+
+
+def remove_small_border_cells(mask, size_threshold, connectivity=None, return_labels=True):
+    """
+    Removes cells that are both on the borders of the image and smaller than a given size threshold.
+
+    The mask is labelled once; border-touching labels are read from the four edge rows/columns,
+    areas come from a single `np.bincount` and all offending labels are removed with one
+    lookup-table remap, so the cost does not grow with the number of removed cells.
+
+    Parameters:
+        mask (numpy.ndarray): 2D binary or instance mask where cells are marked (non-zero).
+        size_threshold (int): The minimum size; cells smaller than this and on the border are removed.
+        connectivity (int, optional): Connectivity passed to `skimage.measure.label`
+                                      (1 = 4-connected, None/2 = 8-connected).
+        return_labels (bool): If True, return the connected-component labels of the cleaned mask
+                              (ConSep/CPM17 behaviour). If False, return a copy of `mask` with the
+                              removed cells set to 0, keeping its values and dtype (MoNuSeg behaviour).
+
+    Returns:
+        numpy.ndarray: The cleaned label image or mask.
+    """
+    labels = measure.label(mask, connectivity=connectivity)
+    areas = np.bincount(labels.ravel())
+    remove = border_labels(labels)
+    remove &= areas < size_threshold
+    count("cells_removed", int(np.count_nonzero(remove[1:])))
+
+    if return_labels:
+        lut = np.arange(len(areas), dtype=labels.dtype)
+        lut[remove] = 0
+        return lut[labels]
+    return np.where(remove[labels], 0, mask).astype(mask.dtype, copy=False)
+
+
+def erode_instances(instance_map, footprint=None):
+    """
+    Erodes every instance of a label image at once, without splitting it into one channel per instance.
+
+    A pixel of instance `i` survives when every pixel under the footprint centred on it also belongs to
+    `i`. This is what `skimage.morphology.erosion` gives on the binary mask of each instance separately
+    (including its "reflect" border handling), but it takes one comparison per footprint offset on the
+    whole label image instead of one full-image erosion per instance.
+
+    Parameters:
+        instance_map (numpy.ndarray): 2D label image, 0 for the background.
+        footprint (numpy.ndarray, optional): Structuring element with odd sides; defaults to `disk(1)`.
+
+    Returns:
+        numpy.ndarray: Label image of the same dtype where eroded-away pixels are set to 0.
+    """
+    footprint = disk(1) if footprint is None else np.asarray(footprint)
+    ry, rx = footprint.shape[0] // 2, footprint.shape[1] // 2
+    # "symmetric" padding repeats the edge pixel, like scipy's "reflect" mode used by skimage
+    padded = np.pad(instance_map, ((ry, ry), (rx, rx)), mode='symmetric')
+    height, width = instance_map.shape
+    keep = instance_map != 0
+    for dy, dx in zip(*np.nonzero(footprint)):
+        if dy == ry and dx == rx:
+            continue
+        keep &= padded[dy:dy + height, dx:dx + width] == instance_map
+    return np.where(keep, instance_map, 0).astype(instance_map.dtype, copy=False)
+
+
+def channel_index_map(labels, instance_map, background_channel=False):
+    """
+    Maps instance ids to the index of their channel in a stack of one binary channel per instance (sorted ids).
+
+    This is the `np.argmax` over that stack: pixels of `labels` (e.g. the output of `erode_instances`)
+    get the index of their instance among the sorted ids of `instance_map`, and background pixels get 0.
+
+    Parameters:
+        labels (numpy.ndarray): Label image whose ids all occur in `instance_map`.
+        instance_map (numpy.ndarray): Label image the channel stack was built from.
+        background_channel (bool): Whether the stack starts with an (empty) channel for id 0, as for
+                                   MoNuSeg. Without it the first instance maps to 0 as well,
+                                   like for ConSep and CPM17.
+
+    Returns:
+        numpy.ndarray: Integer image of channel indices.
+    """
+    ids = np.unique(instance_map)
+    if not background_channel:
+        ids = ids[ids != 0]
+    return np.where(labels != 0, np.searchsorted(ids, labels), 0)
+
+
+class NucleusTable:
+    """
+    Centroids and types of the nuclei of an instance map, for listing the nuclei of each patch.
+
+    The rows of `centroids` and `types` follow the sorted non-zero ids of `instance_map`, as in the
+    `inst_centroid` and `inst_type` variables of the HoVer-Net style .mat labels of ConSep and CPM17.
+
+    Parameters:
+        instance_map (numpy.ndarray): 2D label image, 0 for the background.
+        centroids (numpy.ndarray): (n, 2) centroids as (x, y), one per instance.
+        types (numpy.ndarray): n nuclear types, one per instance.
+    """
+    def __init__(self, instance_map, centroids, types):
+        ids = np.unique(instance_map)
+        self.ids = ids[ids != 0]
+        self.centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+        self.types = np.asarray(types).reshape(-1)
+        if not len(self.ids) == len(self.centroids) == len(self.types):
+            raise ValueError(f"Expected one centroid and type per instance ({len(self.ids)}), "
+                             f"got {len(self.centroids)} centroids and {len(self.types)} types")
+
+    def patch_nuclei(self, instance_patch, kept, y, x, window_size):
+        """
+        Nuclei of the patch whose top-left corner is (y, x).
+
+        Parameters:
+            instance_patch (numpy.ndarray): The patch of `instance_map`.
+            kept (numpy.ndarray): Boolean patch of the pixels kept in the output mask patch, so that
+                                  nuclei removed by border cleaning or erosion are left out.
+            y, x (int): Top-left corner of the patch in the image.
+            window_size (int): Patch size.
+
+        Returns:
+            numpy.ndarray: (k, 3) float64 rows of (x, y, type) with the centroid relative to the patch, for the
+                           nuclei with pixels in `kept` whose centroid lies inside the patch.
+        """
+        present = np.unique(instance_patch[kept])
+        rows = np.searchsorted(self.ids, present[present != 0])
+        cx, cy = (self.centroids[rows] - (x, y)).T
+        inside = (cx >= 0) & (cx < window_size) & (cy >= 0) & (cy < window_size)
+        return np.column_stack([cx[inside], cy[inside], self.types[rows][inside]])
@@ -0,0 +1,453 @@
+import numpy as np
+import os
+import shutil
+from functools import partial
+
+from utils.cache import BuildCache, manifest_path
+from utils.journal import RunJournal, journal_path
+from utils.staging import count, timed, timed_iter
+from utils.store import (STORE_FORMATS, UINT8_IMAGE_SCALE, atomic_save, clear_metadata, create_store, open_store,
+                         remove_partial_writes, safe_cast, write_metadata)
+from utils.streaming import iter_npy_batches, npy_shape, peak_memory_mb
+
+# Order of the nuclei class channels in PanNuke's masks.npy; channel 5 is the background
+CLASS_NAMES = ["Neoplastic", "Inflam", "Connective", "Dead", "Epithelial"]
+
+# Output folders of the .npy format, in the argument order of `save_images_and_masks`
+OUTPUT_FOLDERS = ["images", "masks", "tissues", "Neoplastic", "inflams", "Connective", "Dead", "Epithelial"]
+
+# Output folders of the .npy format with `--encoding instance_class`, see `save_encoded_labels`
+ENCODED_OUTPUT_FOLDERS = ["images", "masks", "classes"]
+
+# Name of the outputs in each folder's filenames, PanNuke_fold{fold}_{tissue}_{name}_{index}.npy
+OUTPUT_FILE_NAMES = {"images": "image", "masks": "mask", "tissues": "tissueType", "Neoplastic": "Neoplastic",
+                     "inflams": "Inflam", "Connective": "Connective", "Dead": "Dead", "Epithelial": "Epithelial",
+                     "classes": "classes"}
+
+# Compact mode (--compact) keeps raw uint8 pixels and uint16 instance ids
+COMPACT_IMAGE_DTYPE, COMPACT_MASK_DTYPE = np.uint8, np.uint16
+
+# Label encodings: one file/array per class channel, or one instance map plus one class map per sample
+LABEL_ENCODINGS = ["channels", "instance_class"]
+CLASS_MAP_DTYPE = np.uint8
+
+def encode_labels(masks):
+    """
+    Encode PanNuke masks as one instance map and one class map.
+
+    Args:
+        masks (numpy.ndarray): Masks with shape (..., 256, 256, 6), instance ids in the class channels.
+
+    Returns:
+        tuple: The instance map (..., 256, 256, 1) as uint16, equal to the merged `masks` output, and the
+               class map (..., 256, 256) as uint8, holding `CLASS_NAMES.index(name) + 1` on the nuclei of
+               each class and 0 on the background.
+    """
+    nuclei = masks[..., :len(CLASS_NAMES)]
+    present = nuclei > 0
+    if np.any(np.count_nonzero(present, axis=-1) > 1):
+        raise ValueError("Class channels overlap; the masks cannot be encoded as a single class map")
+    instances = safe_cast(np.max(nuclei, axis=-1, keepdims=True), COMPACT_MASK_DTYPE)
+    classes = np.where(present.any(axis=-1), present.argmax(axis=-1) + 1, 0).astype(CLASS_MAP_DTYPE)
+    return instances, classes
+
+def class_view(instances, classes, name):
+    """
+    Materialize the instance mask of one nuclei class from an encoded sample, e.g. the former `Neoplastic` file.
+
+    Args:
+        instances (numpy.ndarray): Instance map (..., 256, 256, 1) from `encode_labels`.
+        classes (numpy.ndarray): Class map (..., 256, 256) from `encode_labels`.
+        name (str): One of `CLASS_NAMES`.
+
+    Returns:
+        numpy.ndarray: Array (..., 256, 256) with the instance ids of the nuclei of that class and 0 elsewhere.
+    """
+    return np.where(classes == CLASS_NAMES.index(name) + 1, instances[..., 0], 0)
+
+def decode_labels(instances, classes, dtype=np.float64):
+    """
+    Rebuild the full (..., 256, 256, 6) masks (the former `tissueType` files) from an encoded sample.
+
+    The background channel is rebuilt as 1 where there is no nucleus, as in the original release.
+    """
+    tissues = np.zeros(classes.shape + (len(CLASS_NAMES) + 1,), dtype=dtype)
+    for c, name in enumerate(CLASS_NAMES):
+        tissues[..., c] = class_view(instances, classes, name)
+    tissues[..., -1] = instances[..., 0] == 0
+    return tissues
+
+def split_batch(images, masks, compact=False, split_classes=True, encoding="channels"):
+    """
+    Compute every output of a block of samples at once: the scaled images, the merged instance masks,
+    the full masks (tissues) and one contiguous array per nuclei class.
+
+    Args:
+        images (numpy.ndarray): The images of the block with shape (b, 256, 256, 3).
+        masks (numpy.ndarray): The masks of the block with shape (b, 256, 256, 6).
+        compact (bool): Keep images as uint8 and masks as uint16 instead of float64.
+        split_classes (bool): Also split the per-class masks (not needed by the patch stores).
+        encoding (str): "channels", or "instance_class" to return the `encode_labels` maps instead.
+
+    Returns:
+        dict: "images" (b, 256, 256, 3), "masks" (b, 256, 256, 1), and either "tissues" (b, 256, 256, 6)
+              plus, with `split_classes=True`, one (b, 256, 256) array per name in `CLASS_NAMES`, or
+              "classes" (b, 256, 256) with `encoding="instance_class"`.
+    """
+    outputs = {"images": safe_cast(images, COMPACT_IMAGE_DTYPE) if compact else images / 255.0}
+    if encoding == "instance_class":
+        outputs["masks"], outputs["classes"] = encode_labels(masks)
+        return outputs
+
+    tissues = safe_cast(masks, COMPACT_MASK_DTYPE) if compact else masks
+    outputs["masks"] = np.max(tissues[..., :5], axis=-1, keepdims=True)
+    outputs["tissues"] = tissues
+    if split_classes:
+        # One transposing copy gives every class channel as a contiguous (b, H, W) block
+        outputs.update(zip(CLASS_NAMES, np.ascontiguousarray(np.moveaxis(tissues[..., :5], -1, 0))))
+    return outputs
+
+def save_images_and_masks(images, masks, types, images_dir, masks_dir, tissues_dir, Neoplastic_dir, inflams_dir, Connective_dir, Dead_dir, Epithelial_dir, fold, compact=False, start=0):
+    """
+    Save images and masks to separate .npy files.
+
+    Args:
+        images (numpy.ndarray): The images array with shape (n, 256, 256, 3).
+        masks (numpy.ndarray): The masks array with shape (n, 256, 256, 1).
+        types (numpy.ndarray): The types array indicating the type of each image.
+        images_dir (str): Directory to save images.
+        masks_dir (str): Directory to save masks.
+        tissues_dir (str): Directory to save tissues.
+        Neoplastic_dir (str): Directory to save Neoplastic masks.
+        inflams_dir (str): Directory to save inflammatory masks.
+        Connective_dir (str): Directory to save Connective masks.
+        Dead_dir (str): Directory to save Dead masks.
+        Epithelial_dir (str): Directory to save Epithelial masks.
+        fold (int): Fold number to include in the filename.
+        compact (bool): Save images as raw uint8 pixels (scaled by 1/255 at load time, as recorded
+                        in the images folder's metadata) and masks as uint16 instead of float64.
+        start (int): Index of the first sample within the fold, used in the filenames when the fold
+                     is saved in batches.
+
+    Returns:
+        None
+    """
+    # Create directories if they don't exist
+    os.makedirs(images_dir, exist_ok=True)
+    os.makedirs(masks_dir, exist_ok=True)
+    os.makedirs(tissues_dir, exist_ok=True)
+    os.makedirs(Neoplastic_dir, exist_ok=True)
+    os.makedirs(inflams_dir, exist_ok=True)
+    os.makedirs(Connective_dir, exist_ok=True)
+    os.makedirs(Dead_dir, exist_ok=True)
+    os.makedirs(Epithelial_dir, exist_ok=True)
+    if compact:
+        write_metadata(images_dir, {"dtype": np.dtype(COMPACT_IMAGE_DTYPE).name, "scale": UINT8_IMAGE_SCALE})
+    else:
+        clear_metadata(images_dir)
+
+    # Split the whole block at once, then save the corresponding image and masks of each index
+    outputs = split_batch(images, masks, compact=compact)
+    for i in range(masks.shape[0]):
+        # Define file paths
+        k = start + i
+        image_path = os.path.join(images_dir, f'PanNuke_fold{fold}_{types[i]}_image_{k}.npy')
+        mask_path = os.path.join(masks_dir, f'PanNuke_fold{fold}_{types[i]}_mask_{k}.npy')
+        tissue_path = os.path.join(tissues_dir, f'PanNuke_fold{fold}_{types[i]}_tissueType_{k}.npy')
+
+        Neoplastic_path = os.path.join(Neoplastic_dir, f'PanNuke_fold{fold}_{types[i]}_Neoplastic_{k}.npy')
+        inflam_path = os.path.join(inflams_dir, f'PanNuke_fold{fold}_{types[i]}_Inflam_{k}.npy')
+        Connective_path = os.path.join(Connective_dir, f'PanNuke_fold{fold}_{types[i]}_Connective_{k}.npy')
+        Dead_path = os.path.join(Dead_dir, f'PanNuke_fold{fold}_{types[i]}_Dead_{k}.npy')
+        Epithelial_path = os.path.join(Epithelial_dir, f'PanNuke_fold{fold}_{types[i]}_Epithelial_{k}.npy')
+
+        # Save each image and mask
+        atomic_save(image_path, outputs["images"][i])
+        atomic_save(mask_path, outputs["masks"][i])
+        atomic_save(tissue_path, outputs["tissues"][i])
+        atomic_save(Neoplastic_path, outputs["Neoplastic"][i])
+        atomic_save(inflam_path, outputs["Inflam"][i])
+        atomic_save(Connective_path, outputs["Connective"][i])
+        atomic_save(Dead_path, outputs["Dead"][i])
+        atomic_save(Epithelial_path, outputs["Epithelial"][i])
+
+        # Optional: Print out the file paths of saved files
+        # print(f'Saved image to {image_path}')
+        # print(f'Saved mask to {mask_path}')
+
+def save_encoded_labels(images, masks, types, images_dir, masks_dir, classes_dir, fold, compact=False, start=0):
+    """
+    Save images and masks to separate .npy files, with the labels encoded by `encode_labels`.
+
+    Instead of the `tissueType` file and the five per-class files, only the instance map (the usual
+    `mask` file, as uint16) and a uint8 class map are written; `class_view` and `decode_labels`
+    rebuild the other outputs on load.
+
+    Args:
+        images (numpy.ndarray): The images array with shape (n, 256, 256, 3).
+        masks (numpy.ndarray): The masks array with shape (n, 256, 256, 6).
+        types (numpy.ndarray): The types array indicating the type of each image.
+        images_dir (str): Directory to save images.
+        masks_dir (str): Directory to save instance maps.
+        classes_dir (str): Directory to save class maps.
+        fold (int): Fold number to include in the filename.
+        compact (bool): Save images as raw uint8 pixels instead of float64.
+        start (int): Index of the first sample within the fold.
+
+    Returns:
+        None
+    """
+    for folder in [images_dir, masks_dir, classes_dir]:
+        os.makedirs(folder, exist_ok=True)
+    if compact:
+        write_metadata(images_dir, {"dtype": np.dtype(COMPACT_IMAGE_DTYPE).name, "scale": UINT8_IMAGE_SCALE})
+    else:
+        clear_metadata(images_dir)
+
+    outputs = split_batch(images, masks, compact=compact, encoding="instance_class")
+    for i in range(masks.shape[0]):
+        k = start + i
+        atomic_save(os.path.join(images_dir, f'PanNuke_fold{fold}_{types[i]}_image_{k}.npy'), outputs["images"][i])
+        atomic_save(os.path.join(masks_dir, f'PanNuke_fold{fold}_{types[i]}_mask_{k}.npy'), outputs["masks"][i])
+        atomic_save(os.path.join(classes_dir, f'PanNuke_fold{fold}_{types[i]}_classes_{k}.npy'), outputs["classes"][i])
+
+def create_fold_store(n, image_shape, mask_shape, mask_dtype, types, store_dir, fold, output_format="memmap", compact=False, encoding="channels"):
+    """
+    Preallocate the patch store of a fold, to be filled batch by batch with `write_store_batch`.
+
+    Args:
+        n (int): Number of samples in the fold.
+        image_shape (tuple): Shape of one image, e.g. (256, 256, 3).
+        mask_shape (tuple): Shape of one mask, e.g. (256, 256, 6).
+        mask_dtype (numpy.dtype): dtype of the raw masks, kept unless `compact` is set.
+        types (numpy.ndarray): The types array indicating the type of each image.
+        store_dir (str): Directory of the store.
+        fold (int): Fold number to include in the source names.
+        output_format (str): "memmap" or "zarr".
+        compact (bool): Store images as uint8 (scale recorded in the store's `scales` attribute) and masks as uint16.
+        encoding (str): "channels" stores the full masks as `tissues`; "instance_class" stores a uint8
+                        `classes` array instead (see `encode_labels`), with uint16 `masks`.
+
+    Returns:
+        PatchStore or ZarrPatchStore: The store, opened for writing.
+    """
+    height, width = mask_shape[:2]
+    layout = [(f'PanNuke_fold{fold}_{types[i]}_{i}', 1, 1) for i in range(n)]
+    image_dtype, mask_dtype = (COMPACT_IMAGE_DTYPE, COMPACT_MASK_DTYPE) if compact else (np.float64, mask_dtype)
+    arrays = {"images": ((height, width, image_shape[-1]), image_dtype)}
+    if encoding == "instance_class":
+        arrays["masks"] = ((height, width, 1), COMPACT_MASK_DTYPE)
+        arrays["classes"] = ((height, width), CLASS_MAP_DTYPE)
+    else:
+        arrays["masks"] = ((height, width, 1), mask_dtype)
+        arrays["tissues"] = ((height, width, mask_shape[-1]), mask_dtype)
+    return create_store(output_format, store_dir, layout, arrays,
+                        attrs={"dataset": "PanNuke", "fold": fold, "classes": CLASS_NAMES,
+                               "types": [str(t) for t in types], "label_encoding": encoding,
+                               "scales": {"images": UINT8_IMAGE_SCALE} if compact else {}})
+
+def write_store_batch(store, images, masks, start=0, compact=False):
+    """
+    Write a batch of consecutive samples, starting at sample `start` of the fold, into a fold store.
+
+    Args:
+        store (PatchStore or ZarrPatchStore): Store created by `create_fold_store`.
+        images (numpy.ndarray): The images of the batch with shape (b, 256, 256, 3).
+        masks (numpy.ndarray): The masks of the batch with shape (b, 256, 256, 6).
+        start (int): Index of the first sample of the batch within the fold.
+        compact (bool): Whether the store was created with `compact=True`.
+
+    Returns:
+        None
+    """
+    batch = slice(start, start + len(masks))
+    outputs = split_batch(images, masks, compact=compact, split_classes=False,
+                          encoding=store.attrs.get("label_encoding", "channels"))
+    for name, array in outputs.items():
+        store[name][batch] = array
+        count("bytes_written", array.nbytes)
+
+def save_to_store(images, masks, types, store_dir, fold, chunk_size=256, output_format="memmap", compact=False, encoding="channels"):
+    """
+    Save images and masks of a fold into a consolidated memory-mapped or Zarr patch store.
+
+    Instead of eight .npy files per sample, the store holds three arrays: `images` (n, 256, 256, 3),
+    `masks` (n, 256, 256, 1) and `tissues` (n, 256, 256, 6). The per-class masks are not stored
+    separately; `store["tissues"][..., CLASS_NAMES.index(name)]` selects them (a zero-copy view for memmap).
+
+    Args:
+        images (numpy.ndarray): The images array with shape (n, 256, 256, 3).
+        masks (numpy.ndarray): The masks array with shape (n, 256, 256, 6).
+        types (numpy.ndarray): The types array indicating the type of each image.
+        store_dir (str): Directory of the store.
+        fold (int): Fold number to include in the source names.
+        chunk_size (int): Number of samples converted at a time.
+        output_format (str): "memmap" or "zarr".
+        compact (bool): Store images as uint8 (scale recorded in the store's `scales` attribute) and masks as uint16.
+        encoding (str): "channels" or "instance_class", see `create_fold_store`.
+
+    Returns:
+        PatchStore or ZarrPatchStore: The written store.
+    """
+    store = create_fold_store(masks.shape[0], images.shape[1:], masks.shape[1:], masks.dtype, types, store_dir, fold,
+                              output_format=output_format, compact=compact, encoding=encoding)
+    for start in range(0, masks.shape[0], chunk_size):
+        write_store_batch(store, images[start:start + chunk_size], masks[start:start + chunk_size], start=start, compact=compact)
+    store.flush()
+    return store
+
+def process_fold(fold, raw_dir="./PanNuke/raw_data", output_dir="./PanNuke/preped", output_format="npy", compact=False, batch_size=256, encoding="channels", journal=None, key=None):
+    """
+    Stream one PanNuke fold from its raw .npy files into the selected output, `batch_size` samples at a time.
+
+    The raw images and masks are memory-mapped instead of loaded (the masks of a fold alone are several GB
+    as float64), so peak memory is bounded by the batch size and does not grow with the fold size.
+
+    Args:
+        fold (int): Fold number.
+        raw_dir (str): Folder holding the "Fold {fold}" folders of the original release.
+        output_dir (str): Folder receiving the "fold{fold}" output folder.
+        output_format (str): "npy", "memmap" or "zarr".
+        compact (bool): Store images as uint8 and masks as uint16 instead of float64.
+        batch_size (int): Number of samples held in memory at a time.
+        encoding (str): "channels" or "instance_class" (one instance map plus one class map per sample).
+        journal (RunJournal, optional): Progress journal; every written batch is appended to it, and batches
+                                        it already lists as completed (with the same key) are skipped.
+        key (str, optional): Cache key of the fold, identifying the inputs and options in the journal.
+
+    Returns:
+        int: Number of samples in the fold.
+    """
+    images_path = f"{raw_dir}/Fold {fold}/images/fold{fold}/images.npy"
+    masks_path = f"{raw_dir}/Fold {fold}/masks/fold{fold}/masks.npy"
+    types = np.load(f"{raw_dir}/Fold {fold}/images/fold{fold}/types.npy")
+    fold_dir = f"{output_dir}/fold{fold}"
+    (n, *image_shape), _ = npy_shape(images_path)
+
+    # Batches are journaled per start index; the batch size is part of the key so that resumed batches line up
+    batch_key = f"{key}:{batch_size}"
+    done = {start for start in range(0, n, batch_size)
+            if journal is not None and journal.done(f"fold{fold}:{start}", batch_key)}
+
+    store = None
+    if output_format in STORE_FORMATS:
+        store_dir = f"{fold_dir}/store.zarr" if output_format == "zarr" else f"{fold_dir}/store"
+        if done and os.path.exists(store_dir):
+            store = open_store(store_dir, mode="r+")
+        else:
+            done = set()
+            (_, *mask_shape), mask_dtype = npy_shape(masks_path)
+            store = create_fold_store(n, image_shape, mask_shape, mask_dtype, types, store_dir, fold,
+                                      output_format=output_format, compact=compact, encoding=encoding)
+    else:
+        for name in OUTPUT_FOLDERS + ENCODED_OUTPUT_FOLDERS:
+            remove_partial_writes(f"{fold_dir}/{name}")
+    if done:
+        print(f"Fold {fold}: resuming, {len(done)} batch(es) were completed by the interrupted run.")
+
+    batches = zip(iter_npy_batches(images_path, batch_size, skip=done), iter_npy_batches(masks_path, batch_size, skip=done))
+    # Reading a batch copies it out of the memory-mapped raw files; splitting the labels counts as writing it
+    for (start, images), (_, masks) in timed_iter(batches, "decode"):
+        with timed("write"):
+            if store is not None:
+                write_store_batch(store, images, masks, start=start, compact=compact)
+                # Unmap the written pages so that they do not accumulate in the resident set
+                store.close()
+            elif encoding == "instance_class":
+                save_encoded_labels(images, masks, types[start:start + len(masks)],
+                                    *(f"{fold_dir}/{name}" for name in ENCODED_OUTPUT_FOLDERS), fold, compact=compact, start=start)
+            else:
+                save_images_and_masks(images, masks, types[start:start + len(masks)],
+                                      *(f"{fold_dir}/{name}" for name in OUTPUT_FOLDERS), fold, compact=compact, start=start)
+        count("patches", len(masks))
+        if journal is not None:
+            journal.append(f"fold{fold}:{start}", len(masks), key=batch_key)
+    return n
+
+def fold_sources(fold, raw_dir="./PanNuke/raw_data"):
+    """Raw files of a fold, from which its cache key is computed."""
+    raw = f"{raw_dir}/Fold {fold}"
+    return [f"{raw}/images/fold{fold}/images.npy", f"{raw}/masks/fold{fold}/masks.npy", f"{raw}/images/fold{fold}/types.npy"]
+
+def fold_outputs(fold, types, output_dir="./PanNuke/preped", output_format="npy", encoding="channels"):
+    """
+    Output files (or store) of a fold, as recorded in the build manifest.
+
+    For the .npy format every file written for every sample is listed, so that a deleted file makes
+    the fold stale, and files of another encoding are deleted when the fold is rebuilt.
+
+    Args:
+        fold (int): Fold number.
+        types (numpy.ndarray): Tissue type of every sample of the fold, from its types.npy.
+    """
+    fold_dir = f"{output_dir}/fold{fold}"
+    if output_format == "npy":
+        folders = ENCODED_OUTPUT_FOLDERS if encoding == "instance_class" else OUTPUT_FOLDERS
+        return [f"{fold_dir}/{name}/PanNuke_fold{fold}_{tissue}_{OUTPUT_FILE_NAMES[name]}_{k}.npy"
+                for name in folders for k, tissue in enumerate(types)]
+    return [f"{fold_dir}/store.zarr" if output_format == "zarr" else f"{fold_dir}/store"]
+
+def process_fold_task(source, keys, **kwargs):
+    """Worker entry point of `PanNukeJob`: processes the fold named `source` ("fold{n}") with `process_fold`."""
+    fold = int(source[len("fold"):])
+    n = process_fold(fold, key=keys[source], **kwargs)
+    print(f"Fold {fold} processing completed: {n} samples, peak memory {peak_memory_mb():.0f} MB.")
+    return n
+
+class PanNukeJob:
+    """
+    The PanNuke folds to process, as a job of `utils.pipeline.run_jobs` with one task per fold.
+
+    Folds whose raw files and output options are unchanged since the last build are skipped. Each fold
+    is streamed batch by batch by `process_fold` in the worker that picks it up; its batches are appended
+    to the progress journal as they are written, and the fold is recorded in the build manifest once done.
+
+    Args:
+        folds (list): Fold numbers.
+        raw_dir (str): Folder holding the "Fold {fold}" folders of the original release.
+        output_dir (str): Folder receiving the "fold{fold}" output folders.
+        output_format (str): "npy", "memmap" or "zarr".
+        compact (bool): Store images as uint8 and masks as uint16 instead of float64.
+        batch_size (int): Number of samples held in memory at a time.
+        encoding (str): "channels" or "instance_class".
+        force (bool): Rebuild every fold, ignoring the build manifest.
+        resume (bool): Keep the batches listed as completed in the journal of an interrupted run.
+    """
+    def __init__(self, folds=(1, 2, 3), raw_dir="./PanNuke/raw_data", output_dir="./PanNuke/preped", output_format="npy",
+                 compact=False, batch_size=256, encoding="channels", force=False, resume=False):
+        self.label = "PanNuke"
+        self.raw_dir, self.output_dir, self.output_format, self.encoding = raw_dir, output_dir, output_format, encoding
+
+        # Content-addressed cache: a fold is rebuilt only when its raw files or the output options changed
+        params = {"format": output_format, "compact": compact, "encoding": encoding}
+        self.cache = BuildCache(manifest_path(f"{output_dir}/fold1", output_format), params, force=force)
+        self.journal = RunJournal(journal_path(f"{output_dir}/fold1", output_format), resume=resume)
+        self.tasks = []
+        for fold in folds:
+            if self.cache.is_fresh(f"fold{fold}", fold_sources(fold, raw_dir)):
+                print(f"Fold {fold} is unchanged, skipping it; use --force to rebuild it.")
+            else:
+                self.tasks.append(f"fold{fold}")
+        self.process_fn = partial(process_fold_task, keys=self.cache.keys, raw_dir=raw_dir, output_dir=output_dir,
+                                  output_format=output_format, compact=compact, batch_size=batch_size,
+                                  encoding=encoding, journal=self.journal)
+        # The folds are memory-mapped and read batch by batch by the workers, there is no separate reader stage
+        self.read_fn = None
+
+    def complete(self, source, n):
+        "Called by `run_jobs` for every fold that succeeded."
+        fold = int(source[len("fold"):])
+        types = np.load(fold_sources(fold, self.raw_dir)[2])
+        self.cache.record(source, n, fold_outputs(fold, types, self.output_dir, self.output_format, self.encoding))
+        if self.output_format == "npy":
+            # Folders of the other encoding only hold outdated samples
+            used = ENCODED_OUTPUT_FOLDERS if self.encoding == "instance_class" else OUTPUT_FOLDERS
+            for name in set(OUTPUT_FOLDERS + ENCODED_OUTPUT_FOLDERS) - set(used):
+                shutil.rmtree(f"{self.output_dir}/fold{fold}/{name}", ignore_errors=True)
+        self.cache.save()
+
+    def close(self, completed):
+        "Saves the manifest; the journal is only deleted when every fold succeeded."
+        self.cache.save()
+        if completed:
+            self.journal.remove()
@@ -0,0 +1,165 @@
+import cProfile
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+
+from utils.staging import StageTimes, merge_profiles, prefetch, profile_path, timed, use_times
+
+
+def default_workers():
+    """Number of worker processes to use when `--workers 0` is requested."""
+    return os.cpu_count() or 1
+
+
+def run_images(process_fn, filenames, workers=1, verbose=True, on_result=None, read_fn=None, readers=2, queue_size=4,
+               report=None, profile_dir=None):
+    """
+    Runs `process_fn` once per source image, either serially or across a process pool.
+
+    Every image is an independent task: it is loaded, tiled and saved by the worker that
+    picks it up, and its patches are numbered from 0 under its own base filename, so the
+    files written do not depend on the number of workers or the order of completion.
+
+    With `read_fn`, images are read in a separate stage: `readers` threads of this process
+    decode up to `queue_size` images ahead of the workers, which receive them as
+    `process_fn(filename, inputs=read_fn(filename))` and overlap their compute with the next
+    reads. A `read_fn` returning None leaves the reading to `process_fn(filename)`.
+
+    Parameters:
+        process_fn (callable): Picklable callable taking a filename and returning the number
+                               of patches written for it (e.g. a `functools.partial` of a
+                               module-level function).
+        filenames (list): Source image filenames to process.
+        workers (int): Number of worker processes. 1 runs serially in this process,
+                       0 uses one worker per CPU core.
+        verbose (bool): Print a progress line per image and a summary at the end.
+        on_result (callable, optional): Called in this process as `on_result(filename, result)` for
+                                        every image that succeeded, as soon as it is done.
+        read_fn (callable, optional): Reads the inputs of an image, see above.
+        readers (int): Number of reader threads when `read_fn` is given.
+        queue_size (int): Number of images read ahead when `read_fn` is given; it bounds the
+                          memory held by decoded images waiting for a worker.
+        report (RunReport, optional): Receives the stage times and counters of every image that
+                                      succeeded (see `utils.staging`); their totals are printed
+                                      with the summary.
+        profile_dir (str, optional): Profile every image with cProfile, saving one `.prof` file per
+                                     image and their merge (`total.prof`) in this folder.
+
+    Returns:
+        dict: Mapping from filename to the number of patches written.
+    """
+    filenames = list(filenames)
+    workers = default_workers() if workers == 0 else workers
+    workers = max(1, min(workers, len(filenames) or 1))
+    task_fn = partial(run_timed, process_fn, record_times=report is not None, profile_dir=profile_dir)
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    results, failures = {}, {}
+    start = time.perf_counter()
+
+    def collect(filename, get_result, read_times):
+        try:
+            result = get_result()
+            if report is not None:
+                result, task_times = result
+                report.add(filename, task_times.merge(read_times) if read_times is not None else task_times)
+            results[filename] = result
+        except Exception as e:
+            failures[filename] = e
+
+    def report_progress(filename, done):
+        if on_result is not None and filename in results:
+            on_result(filename, results[filename])
+        if not verbose:
+            return
+        if filename in failures:
+            print(f"[{done}/{len(filenames)}] {filename}: FAILED ({failures[filename]!r})")
+        else:
+            print(f"[{done}/{len(filenames)}] {filename}: {results[filename]} patches")
+
+    if read_fn is None:
+        tasks = ((filename, None, None, None) for filename in filenames)
+    else:
+        tasks = prefetch(read_fn, filenames, readers=readers, queue_size=queue_size)
+
+    if workers == 1:
+        for done, (filename, inputs, error, read_times) in enumerate(tasks, start=1):
+            if error is not None:
+                failures[filename] = error
+            else:
+                collect(filename, partial(task_fn, filename, inputs), read_times)
+            report_progress(filename, done)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures, done = {}, 0
+
+            def drain(return_when):
+                nonlocal done
+                finished, _ = wait(futures, return_when=return_when)
+                for future in finished:
+                    filename, read_times = futures.pop(future)
+                    collect(filename, future.result, read_times)
+                    done += 1
+                    report_progress(filename, done)
+
+            for filename, inputs, error, read_times in tasks:
+                if error is not None:
+                    failures[filename] = error
+                    done += 1
+                    report_progress(filename, done)
+                    continue
+                futures[executor.submit(task_fn, filename, inputs)] = filename, read_times
+                if read_fn is not None and len(futures) >= workers + queue_size:
+                    # Read images wait in the pool's queue: stop reading ahead until a worker is free
+                    drain(FIRST_COMPLETED)
+            while futures:
+                drain(FIRST_COMPLETED)
+
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print_summary(results, failures, elapsed, workers)
+        if report is not None:
+            print("Time per stage (summed over workers) and counters:")
+            print(report.total.report())
+    if profile_dir is not None:
+        merge_profiles(profile_dir)
+    if failures:
+        raise RuntimeError(f"{len(failures)} image(s) failed: {', '.join(sorted(failures))}")
+    return results
+
+
+def run_timed(process_fn, filename, inputs=None, record_times=False, profile_dir=None):
+    """
+    Worker entry point of `run_images`: calls `process_fn` on an image, passing it its `inputs` when they
+    were read by the reader stage. With `record_times`, returns `(result, StageTimes)`, where whatever the task
+    does outside a nested stage (e.g. "read" or "write") counts as "compute". With `profile_dir`, the call is
+    profiled and its stats saved to `profile_path(profile_dir, filename)`.
+    """
+    call = partial(process_fn, filename) if inputs is None else partial(process_fn, filename, inputs=inputs)
+    if profile_dir is not None:
+        profiler = cProfile.Profile()
+        call = partial(profiler.runcall, call)
+    try:
+        if not record_times:
+            return call()
+        with use_times(StageTimes()) as times, timed("compute"):
+            result = call()
+        return result, times
+    finally:
+        if profile_dir is not None:
+            profiler.dump_stats(profile_path(profile_dir, filename))
+
+
+def print_summary(results, failures, elapsed, workers):
+    """Prints the end-of-run report of a `run_images` call."""
+    n_images = len(results)
+    n_patches = sum(results.values())
+    rate = n_images / elapsed if elapsed > 0 else float("inf")
+    print(f"Processed {n_images} image(s) into {n_patches} patches with {workers} worker(s) "
+          f"in {elapsed:.1f}s ({rate:.2f} images/s).")
+    if failures:
+        print(f"{len(failures)} image(s) failed:")
+        for filename, error in sorted(failures.items()):
+            print(f"  {filename}: {error!r}")
@@ -0,0 +1,53 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+
+
+def grid_shape(image_shape, window_size, stride):
+    """Number of patch rows and columns that fit into an image of the given shape."""
+    rows = (image_shape[0] - window_size) // stride + 1 if image_shape[0] >= window_size else 0
+    cols = (image_shape[1] - window_size) // stride + 1 if image_shape[1] >= window_size else 0
+    return rows, cols
+
+
+def image_grid_shape(img_path, window_size, stride):
+    """Patch grid shape of an image file, read from its header without decoding the pixels."""
+    with Image.open(img_path) as img:
+        width, height = img.size
+    return grid_shape((height, width), window_size, stride)
+
+
+def patch_grid(img, window_size, stride):
+    """
+    Returns the patch grid of an image as a zero-copy strided view.
+
+    Parameters:
+        img (numpy.ndarray): Image of shape (H, W) or (H, W, C).
+        window_size (int): Height and width of the square patches.
+        stride (int): Step between neighbouring patches.
+
+    Returns:
+        numpy.ndarray: Read-only view of shape (rows, cols, window_size, window_size[, C]) where
+                       `grid[r, c]` is `img[r*stride:r*stride+window_size, c*stride:c*stride+window_size]`.
+                       Only patches that fit entirely inside the image are included.
+    """
+    rows, cols = grid_shape(img.shape, window_size, stride)
+    if rows == 0 or cols == 0:
+        return np.empty((rows, cols, window_size, window_size) + img.shape[2:], dtype=img.dtype)
+    grid = sliding_window_view(img, (window_size, window_size), axis=(0, 1))[::stride, ::stride]
+    # sliding_window_view appends the window axes after the channel axis
+    if img.ndim == 3:
+        grid = np.moveaxis(grid, 2, -1)
+    return grid
+
+
+def iter_patches(img, window_size, stride):
+    """
+    Lazily yields `(row, col, patch)` for every patch of an image, row by row.
+
+    Patches are views into `patch_grid`, so only the patch currently being processed is ever
+    materialised by the caller. The patch index used in output filenames is `row * cols + col`.
+    """
+    grid = patch_grid(img, window_size, stride)
+    for row, col in np.ndindex(*grid.shape[:2]):
+        yield row, col, grid[row, col]
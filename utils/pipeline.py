@@ -0,0 +1,425 @@
+import os
+from functools import partial
+from itertools import tee
+from operator import itemgetter
+
+import numpy as np
+from PIL import Image
+from skimage.morphology import disk
+
+from utils.cache import BuildCache, manifest_path
+from utils.journal import RunJournal, journal_path
+from utils.labels import label_cache_dir
+from utils.masks import channel_index_map, erode_instances, remove_small_border_cells
+from utils.parallel import run_images
+from utils.patches import image_grid_shape, iter_patches
+from utils.staging import InlineWriter, RunReport, count, timed, writer_pool
+from utils.store import (STORE_FORMATS, UINT8_IMAGE_SCALE, atomic_save, clear_metadata, create_store, open_store,
+                         remove_partial_writes, safe_cast, store_path, write_metadata)
+
+# Images of the patch datasets are stored as float64 in [0, 1] unless compact mode keeps their raw uint8 pixels
+IMAGE_DTYPE, COMPACT_IMAGE_DTYPE = np.float64, np.uint8
+# Border cells smaller than this many pixels are removed from the mask patches
+SIZE_THRESHOLD = 50
+# Nuclear type patches (types=True) and the folders of the type patches and per-patch nuclei, next to the labels folder
+TYPE_DTYPE = np.uint8
+TYPES_FOLDER, CENTROIDS_FOLDER = "types", "centroids"
+
+
+def load_and_preprocess_image(img_path, normalize=True):
+    """Loads an RGB image (the alpha channel of RGBA images is dropped), scaled to [0, 1] when `normalize` is set."""
+    img_array = np.array(Image.open(img_path))
+    if img_array.ndim == 3 and img_array.shape[2] == 4:  # Handle RGBA images
+        img_array = img_array[:, :, :3]
+    if normalize:
+        img_array = img_array / 255.0  # Normalize image
+    return img_array
+
+
+def load_and_process_mask(mask_path, dataset_adapter, erosion=False, label_cache=None):
+    """
+    Loads the instance map of an image with its dataset adapter, optionally eroded.
+
+    Parameters:
+        mask_path (str): Path of the mask file.
+        dataset_adapter (PatchDataset): Adapter of the dataset (see `utils.datasets`).
+        erosion (bool): Erode every instance with `disk(1)` and replace the instance ids by their channel
+                        index, as `np.argmax` over a stack of eroded one-cell binary channels would.
+        label_cache (str, optional): Folder of the decoded label cache (see `utils.labels.LabelCache`).
+
+    Returns:
+        numpy.ndarray: The instance map, binarized for datasets with binary masks (MoNuSeg).
+    """
+    return process_mask(dataset_adapter.load_mask(mask_path, cache_dir=label_cache), dataset_adapter, erosion=erosion)
+
+
+def process_mask(instances, dataset_adapter, erosion=False):
+    "Erosion and binarization steps of `load_and_process_mask`, applied to an already decoded instance map."
+    if erosion:
+        # Same result as eroding a binary channel per instance with disk(1) and
+        # taking the argmax over the channels, without building the (num_cells, H, W) stack
+        with timed("erosion"):
+            eroded = erode_instances(instances, disk(1))
+            instances = channel_index_map(eroded, instances, background_channel=dataset_adapter.background_channel)
+    if dataset_adapter.binarize:
+        # Binarize the whole mask once; the patches handed out by extract_patches are read-only views
+        instances[instances >= 0.5] = 1
+        instances[instances < 0.5] = 0
+    return instances
+
+
+def extract_patches(img, remove_cells_borders, window_size, stride, patch_type, connectivity=None, return_labels=True):
+    """
+    Lazily yields the patches of a given image, row by row, as views into its strided patch grid.
+    Mask patches are cleaned of small border cells with
+    `remove_small_border_cells(connectivity=connectivity, return_labels=return_labels)`.
+    """
+    for row, col, patch in iter_patches(img, window_size, stride):
+        if patch_type == "mask" and remove_cells_borders:
+            with timed("border_cleanup"):
+                patch = remove_small_border_cells(patch, size_threshold=SIZE_THRESHOLD, connectivity=connectivity,
+                                                  return_labels=return_labels)
+        yield patch
+
+
+def typed_patches(mask_patches, instance_map, type_map, nuclei, window_size, stride, patch_nuclei):
+    """
+    Lazily yields `(mask_patch, type_patch)` for the cleaned mask patches of an image and appends the nuclei
+    of each patch to the list `patch_nuclei`, so that the instance, type and centroid outputs of an image
+    come from a single tiling pass.
+
+    Type patches are the `type_map` patches restricted to the pixels kept in the mask patch, and the nuclei
+    of a patch are those listed by `NucleusTable.patch_nuclei` for these pixels.
+    """
+    grids = zip(iter_patches(instance_map, window_size, stride), iter_patches(type_map, window_size, stride))
+    for mask_patch, ((row, col, instance_patch), (_, _, type_patch)) in zip(mask_patches, grids):
+        kept = mask_patch != 0
+        patch_nuclei.append(nuclei.patch_nuclei(instance_patch, kept, row * stride, col * stride, window_size))
+        yield mask_patch, safe_cast(np.where(kept, type_patch, 0), TYPE_DTYPE)
+
+
+def nuclei_table(patch_nuclei):
+    "Stacks the nuclei of the patches of an image into one (n, 4) table of (patch number, x, y, type) rows."
+    rows = [np.column_stack([np.full(len(nuclei), i), nuclei]) for i, nuclei in enumerate(patch_nuclei)]
+    return np.concatenate(rows) if rows else np.zeros((0, 4))
+
+
+def label_folders(output_mask_folder):
+    "Folders of the type patches and per-patch nuclei of a subset, next to its labels folder."
+    parent = os.path.dirname(os.path.normpath(output_mask_folder))
+    return os.path.join(parent, TYPES_FOLDER), os.path.join(parent, CENTROIDS_FOLDER)
+
+
+def save_patches(img_patches, mask_patches, output_folder, output_mask_folder, dataset, base_filename, dataset_adapter,
+                 type_patches=None, writer=None):
+    """Saves each image/mask patch pair to its own .npy files and returns how many pairs were written.
+    Type patches, when given, are saved under the mask patch filename in the types folder.
+    The files are written by `writer` (see `utils.staging.writer_pool`) when it is given."""
+    global_patch_index = 0
+    types_folder = label_folders(output_mask_folder)[0]
+    writer = writer or InlineWriter()
+
+    for img_patch, mask_patch in zip(img_patches, mask_patches):
+        img_patch_filename, mask_patch_filename = dataset_adapter.patch_filenames(dataset, base_filename, global_patch_index)
+        writer.submit(atomic_save, os.path.join(output_folder, img_patch_filename), img_patch)
+        writer.submit(atomic_save, os.path.join(output_mask_folder, mask_patch_filename), mask_patch)
+        if type_patches is not None:
+            writer.submit(atomic_save, os.path.join(types_folder, mask_patch_filename), next(type_patches))
+        global_patch_index += 1
+    return global_patch_index
+
+
+def read_image(filename, dataset_adapter, image_directory, mask_directory, label_cache=None, types=False):
+    """
+    Reader stage of `process_image`: decodes an image and its labels, without processing them.
+
+    The image keeps its raw uint8 pixels, 8x smaller than the normalized float64 image when it is sent
+    from a reader thread to a worker process; `process_image` normalizes it.
+
+    Returns:
+        dict: "image" and "instances" arrays, plus "type_map" and "nuclei" (a `NucleusTable`) with `types=True`.
+    """
+    img_path = os.path.join(image_directory, filename)
+    mask_path = os.path.join(mask_directory, dataset_adapter.mask_filename(filename))
+    with timed("decode"):
+        inputs = {"image": load_and_preprocess_image(img_path, normalize=False)}
+    with timed("label_load"):
+        if types:
+            # The instance map, type map and nuclei are decoded together
+            inputs["instances"], inputs["type_map"], inputs["nuclei"] = dataset_adapter.load_typed_mask(mask_path, cache_dir=label_cache)
+        else:
+            inputs["instances"] = dataset_adapter.load_mask(mask_path, cache_dir=label_cache)
+    return inputs
+
+
+def process_image(filename, dataset_adapter, image_directory, mask_directory, output_folder, output_mask_folder, dataset,
+                  erosion, remove_cells_borders, window_size, stride, store=None, compact=False,
+                  label_cache=None, types=False, inputs=None, write_threads=0):
+    """Extracts and saves the patches of a single image and returns how many were written.
+    Patches go to `store` when it is given, otherwise to one .npy file each.
+    With `types=True`, the type patch and the nuclei (centroids and types) of every mask patch are saved along with it.
+    `inputs` are the arrays decoded by `read_image` when reading is a separate stage; with `write_threads`, the
+    patches are written by a pool of writer threads of this process while the next ones are computed."""
+    base_filename = dataset_adapter.base_filename(filename)
+    if inputs is None:
+        with timed("read"):
+            inputs = read_image(filename, dataset_adapter, image_directory, mask_directory, label_cache=label_cache,
+                                types=types)
+    img_array = inputs["image"]
+    if not compact:
+        with timed("decode"):
+            img_array = img_array / 255.0  # Normalize image
+    instance_argmax_map = process_mask(inputs["instances"], dataset_adapter, erosion=erosion)
+
+    mask_patches = extract_patches(instance_argmax_map, remove_cells_borders, window_size=window_size, stride=stride,
+                                   patch_type="mask", connectivity=dataset_adapter.border_connectivity,
+                                   return_labels=dataset_adapter.border_labels)
+    type_patches, patch_nuclei = None, []
+    if types:
+        # Both branches are consumed in lockstep, so the tee buffers at most one patch
+        branches = tee(typed_patches(mask_patches, inputs["instances"], inputs["type_map"], inputs["nuclei"], window_size,
+                                     stride, patch_nuclei))
+        mask_patches, type_patches = (map(itemgetter(i), branch) for i, branch in enumerate(branches))
+    img_patches = extract_patches(img_array, remove_cells_borders, window_size=window_size, stride=stride, patch_type="image")
+    if compact:
+        mask_patches = (safe_cast(patch, dataset_adapter.compact_mask_dtype) for patch in mask_patches)
+    # The patches are produced lazily by the writes, so the time not spent cleaning or writing them is tiling
+    with writer_pool(write_threads) as writer, timed("tiling"):
+        if store is not None:
+            patches = {"images": img_patches, "masks": mask_patches}
+            if types:
+                patches["types"] = type_patches
+            n_patches = store.write_patches(base_filename, patches, writer=writer)
+            if types:
+                writer.submit(store.write_table, CENTROIDS_FOLDER, base_filename, nuclei_table(patch_nuclei))
+        else:
+            n_patches = save_patches(img_patches, mask_patches, output_folder, output_mask_folder, dataset, base_filename,
+                                     dataset_adapter, type_patches=type_patches, writer=writer)
+            centroids_folder = label_folders(output_mask_folder)[1]
+            for index, nuclei_rows in enumerate(patch_nuclei):
+                mask_patch_filename = dataset_adapter.patch_filenames(dataset, base_filename, index)[1]
+                writer.submit(atomic_save, os.path.join(centroids_folder, mask_patch_filename), nuclei_rows)
+    count("patches", n_patches)
+    return n_patches
+
+
+class PatchJob:
+    """
+    One subset of a patch dataset (ConSep, CPM17, MoNuSeg), ready to be run with `run_jobs`.
+
+    Creating the job checks the build manifest and the progress journal of the subset, prepares its
+    output folders or patch store, and leaves in `tasks` the source images that still have to be
+    processed. Every completed image is recorded in the manifest and the journal by `complete`, in the
+    process running the pool, and `close` saves the manifest at the end of the run.
+
+    Parameters:
+        dataset_adapter (PatchDataset): Adapter describing the dataset (see `utils.datasets`).
+        image_directory (str): Folder of the source images.
+        mask_directory (str): Folder of the source masks.
+        output_folder (str): Folder receiving the image patches (or, for stores, next to which the store is written).
+        output_mask_folder (str): Folder receiving the mask patches.
+        dataset (str): Name used in the patch filenames and store attributes; defaults to the adapter's name.
+        erosion (bool): Erode the instances of every mask, see `load_and_process_mask`.
+        remove_cells_borders (bool): Remove small cells cut by the border of each mask patch.
+        output_format (str): "npy", "memmap" or "zarr".
+        compact (bool): Store images as uint8 and masks in the adapter's compact mask dtype.
+        force (bool): Rebuild every image, ignoring the build manifest.
+        resume (bool): Keep the images listed as completed in the journal of an interrupted run.
+        window_size (int, optional): Patch size; defaults to the adapter's.
+        stride (int, optional): Patch stride; defaults to the adapter's.
+        label_cache (bool or str): Keep decoded masks in a persistent cache, in `label_cache_dir(output_folder)`
+                                   when True or in the given folder; False decodes every mask on every run.
+        types (bool): Also save a type patch and the nuclei (x, y, type) of every patch, for datasets whose labels
+                      have nuclear types (ConSep). With .npy outputs they go to the `types` and `centroids`
+                      folders next to the labels folder, under the mask patch filename; stores get a `types`
+                      array and a `centroids` table per source image, of (patch number, x, y, type) rows.
+        writers (int): Number of writer threads per worker process writing the patches while the next ones
+                       are computed; 0 writes them in the worker's own thread.
+    """
+    def __init__(self, dataset_adapter, image_directory, mask_directory, output_folder, output_mask_folder, dataset=None,
+                 erosion=False, remove_cells_borders=True, output_format="npy", compact=False,
+                 force=False, resume=False, window_size=None, stride=None, label_cache=True, types=False, writers=0):
+        self.adapter = dataset_adapter
+        self.output_folder, self.output_mask_folder = output_folder, output_mask_folder
+        self.output_format = output_format
+        self.types = types
+        if types and not dataset_adapter.has_types:
+            raise ValueError(f"{dataset_adapter.name} labels have no nuclear types")
+        self.dataset = dataset = dataset or dataset_adapter.name
+        subset = os.path.basename(os.path.dirname(os.path.normpath(output_folder)))
+        self.label = f"{dataset}/{subset}"
+        window_size = window_size or dataset_adapter.window_size
+        stride = stride or dataset_adapter.stride
+
+        filenames = dataset_adapter.list_images(image_directory)
+        if label_cache is True:
+            label_cache = label_cache_dir(output_folder)
+
+        # In compact mode images are stored as uint8 and scaled to [0, 1] at load time
+        image_dtype = COMPACT_IMAGE_DTYPE if compact else IMAGE_DTYPE
+        mask_dtype = dataset_adapter.compact_mask_dtype if compact else dataset_adapter.mask_dtype
+        scales = {"images": UINT8_IMAGE_SCALE} if compact else {}
+
+        # Content-addressed cache: only images whose source bytes or parameters changed are rebuilt
+        params = {"dataset": dataset, "window_size": window_size, "stride": stride, "erosion": erosion,
+                  "remove_cells_borders": remove_cells_borders, "size_threshold": SIZE_THRESHOLD, "format": output_format,
+                  "image_dtype": np.dtype(image_dtype).name, "mask_dtype": np.dtype(mask_dtype).name}
+        if types:
+            params["types"] = True
+        if output_format in STORE_FORMATS:
+            # The store layout depends on the whole set of source images
+            params["source_files"] = filenames
+        self.cache = BuildCache(manifest_path(output_folder, output_format), params, force=force)
+        todo = self.cache.stale({f: [os.path.join(image_directory, f), os.path.join(mask_directory, dataset_adapter.mask_filename(f))]
+                                 for f in filenames})
+
+        # Progress journal: with resume=True, images completed by an interrupted run with the same key are kept
+        self.journal = RunJournal(journal_path(output_folder, output_format), resume=resume)
+        resumed = [f for f in todo if self.journal.done(f, self.cache.keys[f])]
+        todo = [f for f in todo if f not in resumed]
+
+        self.store = None
+        if output_format in STORE_FORMATS:
+            path = store_path(output_folder, output_format)
+            if len(todo) < len(filenames) and os.path.exists(path):
+                self.store = open_store(path, mode="r+")
+                # A stale image whose patch grid changed no longer fits its rows: rebuild the whole store
+                grids = {s["source"]: (s["rows"], s["cols"]) for s in self.store.index["sources"]}
+                if any(image_grid_shape(os.path.join(image_directory, f), window_size, stride)
+                       != grids.get(dataset_adapter.base_filename(f)) for f in todo):
+                    self.store = None
+            if self.store is None:
+                # One store per dataset/subset next to the images/labels folders, preallocated from the image headers
+                todo, resumed = filenames, []
+                layout = [(dataset_adapter.base_filename(f), *image_grid_shape(os.path.join(image_directory, f), window_size, stride))
+                          for f in filenames]
+                arrays = {"images": ((window_size, window_size, 3), image_dtype),
+                          "masks": ((window_size, window_size), mask_dtype)}
+                if types:
+                    arrays["types"] = ((window_size, window_size), TYPE_DTYPE)
+                self.store = create_store(output_format, path, layout, arrays,
+                                          attrs={"dataset": dataset, "subset": subset, "window_size": window_size,
+                                                 "stride": stride, "source_files": filenames, "scales": scales})
+        else:
+            os.makedirs(output_folder, exist_ok=True)
+            os.makedirs(output_mask_folder, exist_ok=True)
+            remove_partial_writes(output_folder)
+            remove_partial_writes(output_mask_folder)
+            if types:
+                for folder in label_folders(output_mask_folder):
+                    os.makedirs(folder, exist_ok=True)
+                    remove_partial_writes(folder)
+            if compact:
+                write_metadata(output_folder, {"dtype": np.dtype(image_dtype).name, "scale": UINT8_IMAGE_SCALE})
+            else:
+                clear_metadata(output_folder)
+
+        self.process_fn = partial(process_image, dataset_adapter=dataset_adapter, image_directory=image_directory,
+                                  mask_directory=mask_directory, output_folder=output_folder,
+                                  output_mask_folder=output_mask_folder, dataset=dataset, erosion=erosion,
+                                  remove_cells_borders=remove_cells_borders, window_size=window_size, stride=stride,
+                                  store=self.store, compact=compact,
+                                  label_cache=label_cache or None, types=types, write_threads=writers)
+        # Reader stage of `run_jobs(readers=...)`: decodes the images and labels for the workers
+        self.read_fn = partial(read_image, dataset_adapter=dataset_adapter, image_directory=image_directory,
+                               mask_directory=mask_directory, label_cache=label_cache or None, types=types)
+        self.tasks = todo
+
+        for filename in resumed:
+            self.record(filename, self.journal.patches(filename))
+        if resumed:
+            print(f"{self.label}: resuming, {len(resumed)} image(s) were completed by the interrupted run.")
+        if len(todo) + len(resumed) < len(filenames):
+            print(f"{self.label}: skipping {len(filenames) - len(todo) - len(resumed)} unchanged image(s); use --force to rebuild them.")
+
+    def record(self, filename, n_patches):
+        "Records the outputs of a built image in the manifest."
+        if self.store is not None:
+            outputs = [store_path(self.output_folder, self.output_format)]
+        else:
+            base_filename = self.adapter.base_filename(filename)
+            outputs = [os.path.join(folder, name) for i in range(n_patches)
+                       for folder, name in zip((self.output_folder, self.output_mask_folder),
+                                               self.adapter.patch_filenames(self.dataset, base_filename, i))]
+            if self.types:
+                outputs += [os.path.join(folder, self.adapter.patch_filenames(self.dataset, base_filename, i)[1])
+                            for i in range(n_patches) for folder in label_folders(self.output_mask_folder)]
+        self.cache.record(filename, n_patches, outputs)
+
+    def complete(self, filename, n_patches):
+        "Called by `run_jobs` for every image that succeeded."
+        self.record(filename, n_patches)
+        self.journal.append(filename, n_patches, key=self.cache.keys[filename])
+
+    def close(self, completed):
+        "Saves the manifest; the journal is only deleted when every task of the job succeeded."
+        self.cache.save()
+        if completed:
+            self.journal.remove()
+
+
+def run_task(process_fns, task, inputs=None):
+    "Runs a `run_jobs` task, named `{job label}/{source}`, with the process function of its job."
+    label, source = task.rsplit("/", 1)
+    if inputs is None:
+        return process_fns[label](source)
+    return process_fns[label](source, inputs=inputs)
+
+
+def read_task(read_fns, task):
+    "Reads the inputs of a `run_jobs` task with the `read_fn` of its job; None when its job reads in the workers."
+    label, source = task.rsplit("/", 1)
+    return None if read_fns[label] is None else read_fns[label](source)
+
+
+def run_jobs(jobs, workers=1, verbose=True, readers=0, queue_size=4, report_path=None, profile_dir=None):
+    """
+    Runs the tasks of several jobs (dataset subsets, PanNuke folds) in a single pool of worker processes.
+
+    The tasks of all jobs are submitted to one `run_images` call, so a small subset does not leave the
+    workers idle while waiting for the next one to start. Each result is handed to the `complete` method
+    of its job as soon as it arrives, and every job is closed at the end, even when some tasks failed.
+    With `report_path`, the time spent in each stage (decode, label_load, erosion, border_cleanup, tiling, write
+    and the waits between them) and the counters of `utils.staging.StageTimes` are recorded for every task,
+    printed with the summary and saved.
+
+    Parameters:
+        jobs (list): Jobs with a unique `label`, a list of `tasks`, a picklable `process_fn(task)`, a `read_fn(task)`
+                     (or None) and the `complete(task, result)` and `close(completed)` methods (e.g. `PatchJob`).
+        workers (int): Number of worker processes; 1 runs serially, 0 uses one worker per CPU core.
+        verbose (bool): Print a progress line per task and a summary at the end.
+        readers (int): Number of threads of this process decoding the images ahead of the workers, which then
+                       only tile and write them; 0 lets every worker read its own images.
+        queue_size (int): Number of images decoded ahead of the workers when `readers` is set.
+        report_path (str, optional): Save the stage times and counters of every task and of the whole run to
+                                     this .json or .csv file (see `RunReport.write`), even if some tasks failed.
+        profile_dir (str, optional): Profile every task with cProfile into this folder (see `run_images`).
+
+    Returns:
+        dict: Maps the label of every job to a dict from its tasks to their results.
+    """
+    jobs_by_label = {job.label: job for job in jobs}
+    if len(jobs_by_label) < len(jobs):
+        raise ValueError(f"Job labels must be unique, got {[job.label for job in jobs]}")
+    results = {job.label: {} for job in jobs}
+
+    def complete(task, result):
+        label, source = task.rsplit("/", 1)
+        results[label][source] = result
+        jobs_by_label[label].complete(source, result)
+
+    process_fn = partial(run_task, {job.label: job.process_fn for job in jobs})
+    read_fn = partial(read_task, {job.label: job.read_fn for job in jobs}) if readers else None
+    tasks = [f"{job.label}/{task}" for job in jobs for task in job.tasks]
+    report = RunReport() if report_path is not None else None
+    try:
+        run_images(process_fn, tasks, workers=workers, verbose=verbose, on_result=complete, read_fn=read_fn,
+                   readers=readers, queue_size=queue_size, report=report, profile_dir=profile_dir)
+    finally:
+        for job in jobs:
+            job.close(completed=len(results[job.label]) == len(job.tasks))
+        if report is not None:
+            report.write(report_path)
+            if verbose:
+                print(f"Stage report written to {report_path}.")
+    return results
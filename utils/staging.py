@@ -0,0 +1,335 @@
+import csv
+import glob
+import json
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Stage times of the task running in this thread and the stack of its open `timed` blocks, see `use_times`
+_current = threading.local()
+# Writer pools of this process, created on first use by `writer_pool`
+_writers = {}
+
+
+class StageTimes:
+    """
+    Accumulated wall time and number of calls per pipeline stage, and counters of a task or a run.
+
+    The stages of the patch pipeline are "decode" (image files), "label_load" (masks and .mat labels),
+    "erosion", "border_cleanup", "tiling" and "write", with "read" and "compute" for whatever the
+    reader stage and the workers do outside of them. "read_wait" and "write_wait" are the time the
+    workers spent blocked on the reader stage and on a free write slot or the writes of their image.
+    The counters are "bytes_written" (.npy files, including the label cache, and store rows, counted
+    uncompressed for Zarr), "patches" and "cells_removed" (small border cells removed from the mask
+    patches).
+
+    Instances are thread-safe and picklable, so that the times of a task can be sent back from a
+    worker process and merged with `merge`.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"seconds": dict(self.seconds), "calls": dict(self.calls), "counts": dict(self.counts)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.seconds.update(state["seconds"])
+        self.calls.update(state["calls"])
+        self.counts.update(state["counts"])
+
+    def add(self, stage, seconds, calls=1):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def merge(self, other):
+        for stage, seconds in other.seconds.items():
+            self.add(stage, seconds, other.calls[stage])
+        for name, n in other.counts.items():
+            self.count(name, n)
+        return self
+
+    def as_dict(self):
+        return {"stages": {stage: {"seconds": self.seconds[stage], "calls": self.calls[stage]}
+                           for stage in sorted(self.seconds)},
+                "counts": dict(sorted(self.counts.items()))}
+
+    def as_row(self):
+        "Flat {column: value} view: `{stage}_s` and `{stage}_calls` per stage, then the counters."
+        row = {}
+        for stage in sorted(self.seconds):
+            row[f"{stage}_s"] = round(self.seconds[stage], 6)
+            row[f"{stage}_calls"] = self.calls[stage]
+        row.update(sorted(self.counts.items()))
+        return row
+
+    def report(self, threads=None):
+        """
+        One line per stage with its total time and, for the stages given in `threads` (stage -> number
+        of threads running it), the time per thread. The stage with the most time per thread is the
+        bottleneck; large "read_wait" or "write_wait" times tell that compute was starved by that stage.
+        """
+        threads = threads or {}
+        lines = []
+        for stage in sorted(self.seconds, key=self.seconds.get, reverse=True):
+            line = f"  {stage:<15}{self.seconds[stage]:9.2f}s in {self.calls[stage]} call(s)"
+            if threads.get(stage):
+                line += f", {self.seconds[stage] / threads[stage]:.2f}s per thread ({threads[stage]} thread(s))"
+            lines.append(line)
+        lines += [f"  {name:<15}{n:>14,}" for name, n in sorted(self.counts.items())]
+        return "\n".join(lines)
+
+
+class RunReport:
+    """
+    Stage times and counters of every task of a run (e.g. every source image) and of the whole run,
+    filled by `utils.parallel.run_images` and written as JSON or CSV with `write`.
+    """
+    def __init__(self):
+        self.total = StageTimes()
+        self.tasks = {}
+
+    def add(self, task, times):
+        self.tasks[task] = times
+        self.total.merge(times)
+
+    def as_dict(self):
+        return {"total": self.total.as_dict(), "tasks": {task: times.as_dict() for task, times in self.tasks.items()}}
+
+    def write(self, path):
+        """
+        Saves the report to `path`: a CSV file (by its suffix) has one row per task and a last "total" row, with
+        the columns of `StageTimes.as_row`; otherwise a JSON file with "total" and "tasks" entries.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not path.endswith(".csv"):
+            with open(path, "w") as f:
+                json.dump(self.as_dict(), f, indent=2)
+            return
+        rows = [{"task": task, **times.as_row()} for task, times in self.tasks.items()]
+        rows.append({"task": "total", **self.total.as_row()})
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, restval=0)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def current_times():
+    "Stage times of the task running in this thread, or None outside `use_times`."
+    return getattr(_current, "times", None)
+
+
+@contextmanager
+def use_times(times):
+    "Makes `times` the stage times recorded by `timed` (and by the writer pool) in this thread."
+    previous = current_times(), getattr(_current, "stack", [])
+    _current.times, _current.stack = times, []
+    try:
+        yield times
+    finally:
+        _current.times, _current.stack = previous
+
+
+def count(name, n=1):
+    "Adds `n` to counter `name` of the current stage times, if any; a no-op outside `use_times`."
+    times = current_times()
+    if times is not None:
+        times.count(name, n)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Adds the wall time of the `with` block to `stage` of the current stage times, if any.
+
+    Blocks may be nested: time spent in an inner block counts for the inner stage only, so the
+    stages of a thread add up to its wall time (e.g. "compute" excludes the inline "read" and "write").
+    """
+    times = current_times()
+    if times is None:
+        yield
+        return
+    stack = _current.stack
+    now = time.perf_counter()
+    if stack:
+        outer, started = stack[-1]
+        times.add(outer, now - started, calls=0)
+    stack.append((stage, now))
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        times.add(stage, now - stack.pop()[1])
+        if stack:
+            stack[-1] = (stack[-1][0], now)
+
+
+def timed_iter(iterable, stage):
+    "Yields the items of `iterable`, adding the time spent producing each of them to `stage`."
+    iterator = iter(iterable)
+    while True:
+        with timed(stage):
+            item = next(iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+_DONE = object()
+
+
+class InlineWriter:
+    """Writer with the interface of `WriteBehind` that runs every write immediately, in the calling thread."""
+    def submit(self, fn, *args):
+        with timed("write"):
+            fn(*args)
+
+    def wait(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class WriteBehind:
+    """
+    Writer thread pool with a bounded number of pending writes.
+
+    `submit` returns as soon as a slot is free, so the compute stage keeps tiling while earlier patches
+    are being written; it blocks when `max_pending` writes are queued, which bounds the memory held by
+    pending patches. `wait` blocks until every submitted write is done and re-raises the first write
+    error. Used as a context manager around the writes of one task, it waits for them on exit, so a
+    task is only reported as done once its outputs are written.
+
+    Arrays handed to `submit` must not be modified afterwards.
+
+    Parameters:
+        threads (int): Number of writer threads.
+        max_pending (int): Maximum number of queued or running writes.
+    """
+    def __init__(self, threads=2, max_pending=16):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def _run(self, times, fn, args):
+        try:
+            with use_times(times), timed("write"):
+                fn(*args)
+        finally:
+            self.slots.release()
+
+    def submit(self, fn, *args):
+        "Schedules `fn(*args)` on a writer thread."
+        with timed("write_wait"):
+            self.slots.acquire()
+        try:
+            self.futures.append(self.executor.submit(self._run, current_times(), fn, args))
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def wait(self):
+        "Waits for all submitted writes and raises the first error among them."
+        futures, self.futures = self.futures, []
+        with timed("write_wait"):
+            for future in futures:
+                future.exception()
+        for future in futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.wait()
+        else:
+            # The task failed: drop its pending writes without masking its error
+            futures, self.futures = self.futures, []
+            for future in futures:
+                future.exception()
+
+
+def writer_pool(threads, max_pending=16):
+    """
+    Writer of this process for tasks writing on `threads` threads: an `InlineWriter` for 0, otherwise a
+    `WriteBehind` pool created on first use and shared by the tasks that the process runs.
+    """
+    if not threads:
+        return InlineWriter()
+    key = (threads, max_pending)
+    if key not in _writers:
+        _writers[key] = WriteBehind(threads, max_pending)
+    return _writers[key]
+
+
+def prefetch(read_fn, items, readers=2, queue_size=4):
+    """
+    Reads items ahead on a pool of reader threads and yields `(item, inputs, error, times)` in order.
+
+    At most `queue_size` items are read or waiting to be consumed at a time, so memory is bounded by
+    the queue rather than by the number of items. `error` is the exception raised by `read_fn(item)`,
+    if any, and `times` the `StageTimes` of the item: its "read" stages (`read_fn` may record nested
+    stages such as "decode") and the time the consumer waited for it, as "read_wait".
+    """
+    def read(item, times):
+        with use_times(times), timed("read"):
+            return read_fn(item)
+
+    def submit(item):
+        times = StageTimes()
+        return item, executor.submit(read, item, times), times
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=readers, thread_name_prefix="reader") as executor:
+        pending = deque(submit(item) for item in _take(items, queue_size))
+        while pending:
+            item, future, times = pending.popleft()
+            start = time.perf_counter()
+            error = future.exception()
+            times.add("read_wait", time.perf_counter() - start)
+            yield item, None if error else future.result(), error, times
+            pending.extend(submit(item) for item in _take(items, 1))
+
+
+def _take(items, n):
+    "The next `n` items of an iterator (fewer when it runs out)."
+    return [item for _, item in zip(range(n), items)]
+
+
+def profile_path(profile_dir, task):
+    "cProfile output file of a task in `profile_dir`."
+    return os.path.join(profile_dir, task.replace("/", "_").replace(os.sep, "_") + ".prof")
+
+
+def merge_profiles(profile_dir, top=20):
+    """
+    Merges the per-task cProfile files of `profile_dir` into `total.prof` (readable with `pstats` or
+    snakeviz) and prints its `top` functions by cumulative time.
+    """
+    total_path = os.path.join(profile_dir, "total.prof")
+    paths = sorted(p for p in glob.glob(os.path.join(profile_dir, "*.prof")) if p != total_path)
+    if not paths:
+        return None
+    pstats.Stats(*paths).dump_stats(total_path)
+    print(f"Profile of {len(paths)} task(s) written to {total_path}:")
+    pstats.Stats(total_path).sort_stats("cumulative").print_stats(top)
+    return total_path
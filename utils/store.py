@@ -0,0 +1,358 @@
+import bisect
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from utils.staging import count
+
+INDEX_FILENAME = "index.json"
+METADATA_FILENAME = "preprocess.json"
+STORE_FORMATS = ["memmap", "zarr"]
+TMP_SUFFIX = ".tmp"
+
+# Scale applied at load time to images stored as raw uint8 pixels (compact mode)
+UINT8_IMAGE_SCALE = 1 / 255.0
+
+
+def safe_cast(array, dtype):
+    "Casts `array` to the integer `dtype`, raising a ValueError instead of wrapping values that do not fit."
+    info = np.iinfo(dtype)
+    if array.size and (array.min() < info.min or array.max() > info.max):
+        raise ValueError(f"Values in [{array.min()}, {array.max()}] do not fit into {np.dtype(dtype).name}")
+    return array.astype(dtype, copy=False)
+
+
+def atomic_save(path, array):
+    """
+    `np.save` to a temporary name next to `path`, then renamed over it, so that `path` only ever holds
+    a complete array (or its previous version) even if the process dies mid-write.
+    """
+    tmp_path = f"{path}.{os.getpid()}{TMP_SUFFIX}"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+        count("bytes_written", f.tell())
+    os.replace(tmp_path, path)
+
+
+def remove_partial_writes(folder):
+    "Deletes the temporary files left in `folder` by `atomic_save` calls that were interrupted."
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        if name.endswith(TMP_SUFFIX):
+            os.remove(os.path.join(folder, name))
+
+
+def write_metadata(folder, metadata):
+    "Writes the metadata of a folder of loose .npy patches (e.g. their load-time `scale`) next to them."
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, METADATA_FILENAME), "w") as f:
+        json.dump(metadata, f, indent=1)
+
+
+def clear_metadata(folder):
+    "Removes the metadata written by `write_metadata`, e.g. when a folder is rewritten without compact mode."
+    path = os.path.join(folder, METADATA_FILENAME)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def load_npy_patch(path, normalize=True):
+    """
+    Loads a loose .npy patch, applying the scale recorded for its folder by `write_metadata`.
+
+    Patches written in compact mode hold raw uint8 pixels; with `normalize=True` they are
+    returned as float32 in [0, 1]. Patches without recorded scale are returned unchanged.
+    """
+    patch = np.load(path)
+    metadata_path = os.path.join(os.path.dirname(path), METADATA_FILENAME)
+    if normalize and os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            scale = json.load(f).get("scale")
+        if scale is not None:
+            patch = patch.astype(np.float32) * np.float32(scale)
+    return patch
+
+
+def _build_index(layout, arrays, attrs=None):
+    "Index shared by all store formats: array specs, per-source row offsets and metadata."
+    sources, offset = [], 0
+    for source, rows, cols in layout:
+        sources.append({"source": source, "offset": offset, "rows": int(rows), "cols": int(cols)})
+        offset += rows * cols
+    return {"length": offset,
+            "arrays": {name: {"shape": [int(s) for s in shape], "dtype": np.dtype(dtype).str}
+                       for name, (shape, dtype) in arrays.items()},
+            "sources": sources,
+            "attrs": attrs or {}}
+
+
+def create_patch_store(store_dir, layout, arrays, attrs=None):
+    """
+    Preallocates a consolidated patch store and returns it opened for writing.
+
+    Every array is a single `.npy` file opened with `open_memmap`, holding the patches of all
+    source images of a dataset/subset back to back. A sidecar `index.json` maps each
+    (source image, patch row, patch col) to its row in those arrays.
+
+    Parameters:
+        store_dir (str): Directory of the store; existing arrays in it are overwritten.
+        layout (list): `(source, rows, cols)` per source image, in storage order.
+        arrays (dict): Maps an array name (e.g. "images") to `(patch_shape, dtype)`.
+        attrs (dict, optional): JSON-serialisable metadata saved with the index.
+
+    Returns:
+        PatchStore: The store, opened in "r+" mode.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    index = _build_index(layout, arrays, attrs)
+    for name, (shape, dtype) in arrays.items():
+        array = open_memmap(os.path.join(store_dir, f"{name}.npy"), mode="w+", dtype=dtype, shape=(index["length"], *shape))
+        del array
+    with open(os.path.join(store_dir, INDEX_FILENAME), "w") as f:
+        json.dump(index, f, indent=1)
+    return PatchStore(store_dir, mode="r+")
+
+
+def create_zarr_store(store_path, layout, arrays, attrs=None, compressor="default"):
+    """
+    Creates a chunked, compressed Zarr patch store and returns it opened for writing.
+
+    Same layout as `create_patch_store`, but every array is a Zarr array with one chunk per
+    patch. The index and metadata are kept in the group attributes, and an `origins` array
+    records the (y, x) top-left corner of every patch in its source image.
+
+    Parameters:
+        store_path (str): Path of the `.zarr` directory; an existing store is overwritten.
+        layout (list): `(source, rows, cols)` per source image, in storage order.
+        arrays (dict): Maps an array name (e.g. "images") to `(patch_shape, dtype)`.
+        attrs (dict, optional): JSON-serialisable metadata (e.g. dataset, fold, window_size, stride).
+        compressor: Numcodecs compressor; "default" keeps Zarr's default (Blosc/LZ4).
+
+    Returns:
+        ZarrPatchStore: The store, opened in "r+" mode.
+    """
+    import zarr
+
+    index = _build_index(layout, arrays, attrs)
+    root = zarr.open_group(store_path, mode="w")
+    kwargs = {} if compressor == "default" else {"compressor": compressor}
+    for name, (shape, dtype) in arrays.items():
+        root.zeros(name, shape=(index["length"], *shape), chunks=(1, *shape), dtype=dtype, **kwargs)
+
+    stride = (attrs or {}).get("stride", 0)
+    origins = np.zeros((index["length"], 2), dtype=np.int32)
+    for s in index["sources"]:
+        rows, cols = np.divmod(np.arange(s["rows"] * s["cols"]), s["cols"])
+        origins[s["offset"]:s["offset"] + len(rows)] = np.stack([rows * stride, cols * stride], axis=1)
+    root.array("origins", origins, chunks=(max(len(origins), 1), 2))
+    root.attrs.update(index)
+    return ZarrPatchStore(store_path, mode="r+")
+
+
+def create_store(output_format, store_path, layout, arrays, attrs=None):
+    "Creates a patch store of the given format (one of `STORE_FORMATS`)."
+    if output_format == "memmap":
+        return create_patch_store(store_path, layout, arrays, attrs)
+    if output_format == "zarr":
+        return create_zarr_store(store_path, layout, arrays, attrs)
+    raise ValueError(f"Unknown store format {output_format!r}, expected one of {STORE_FORMATS}")
+
+
+def store_path(output_folder, output_format):
+    "Location of the patch store of a subset, next to its images/labels folders."
+    name = "store.zarr" if output_format == "zarr" else "store"
+    return os.path.join(os.path.dirname(os.path.normpath(output_folder)), name)
+
+
+class _IndexedStore:
+    "Index lookups and patch writing shared by the store formats."
+    def _init_index(self, index):
+        self.index = index
+        self.sources = {s["source"]: s for s in index["sources"]}
+        self._offsets = [s["offset"] for s in index["sources"]]
+        self._arrays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def __len__(self):
+        return self.index["length"]
+
+    @property
+    def attrs(self):
+        return self.index["attrs"]
+
+    @property
+    def names(self):
+        return list(self.index["arrays"])
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self._open(name)
+        return self._arrays[name]
+
+    def position(self, source, row=0, col=0):
+        "Row of the store holding patch (row, col) of `source`."
+        s = self.sources[source]
+        if not (0 <= row < s["rows"] and 0 <= col < s["cols"]):
+            raise IndexError(f"Patch ({row}, {col}) out of range for {source} with a {s['rows']}x{s['cols']} grid")
+        return s["offset"] + row * s["cols"] + col
+
+    def locate(self, i):
+        "Inverse of `position`: returns (source, row, col) of store row `i`."
+        if not 0 <= i < len(self):
+            raise IndexError(f"Index {i} out of range for store of length {len(self)}")
+        s = self.index["sources"][bisect.bisect_right(self._offsets, i) - 1]
+        row, col = divmod(i - s["offset"], s["cols"])
+        return s["source"], row, col
+
+    def get(self, source, row=0, col=0, name="images", normalize=False):
+        """
+        Patch (row, col) of `source` in array `name`. With `normalize=True`, arrays stored with a
+        load-time scale (uint8 images in compact mode) are returned scaled as float32.
+        """
+        patch = self[name][self.position(source, row, col)]
+        scale = self.attrs.get("scales", {}).get(name)
+        if normalize and scale is not None:
+            patch = np.asarray(patch, dtype=np.float32) * np.float32(scale)
+        return patch
+
+    def write_patches(self, source, patches, writer=None):
+        """
+        Writes the patches of one source image, in row-major grid order, and flushes them.
+
+        Parameters:
+            source (str): Source name as given in the layout.
+            patches (dict): Maps array names to iterables of patches; they are consumed in lockstep.
+            writer (optional): Writer of `utils.staging` running the row assignments, e.g. on writer threads.
+
+        Returns:
+            int: Number of patches written.
+
+        Raises a ValueError if the patches do not fill exactly the grid of `source` in the store, e.g. after
+        the image changed size; nothing is written past the rows of `source`.
+        """
+        s = self.sources[source]
+        start, size = s["offset"], s["rows"] * s["cols"]
+        names = list(patches)
+        n = 0
+        for n, items in enumerate(zip(*patches.values()), start=1):
+            if n > size:
+                if writer is not None:
+                    writer.wait()
+                raise ValueError(f"More than {size} patches for {source}, whose grid in the store is "
+                                 f"{s['rows']}x{s['cols']}")
+            for name, patch in zip(names, items):
+                count("bytes_written", np.asarray(patch).nbytes)
+                if writer is None:
+                    self[name][start + n - 1] = patch
+                else:
+                    writer.submit(self[name].__setitem__, start + n - 1, patch)
+        if writer is not None:
+            writer.wait()
+        self.flush(names)
+        if n != size:
+            raise ValueError(f"{n} patches for {source}, whose grid in the store is {s['rows']}x{s['cols']}")
+        return n
+
+    def write_table(self, name, source, table):
+        """
+        Stores a per-source table of variable length next to the patch arrays, e.g. the nuclei of
+        every patch of `source` as rows starting with the patch number.
+        """
+        self._write_table(name, source, np.asarray(table))
+
+    def table(self, name, source):
+        "Reads the table `name` written for `source` by `write_table`."
+        return self._read_table(name, source)
+
+    def flush(self, names=None):
+        pass
+
+    def close(self):
+        "Flushes and releases the opened arrays; they are reopened on next access."
+        if self._arrays:
+            self.flush(list(self._arrays))
+        self._arrays = {}
+
+
+class PatchStore(_IndexedStore):
+    """
+    Reader/writer for a store created by `create_patch_store`.
+
+    Arrays are memory-mapped on first access, so patches returned by `get` or by indexing an
+    array are zero-copy views into the files. The store can be pickled into worker processes;
+    each process maps the arrays again on its own.
+
+    Parameters:
+        store_dir (str): Directory of the store.
+        mode (str): Memory-map mode, "r" for reading or "r+" for writing.
+    """
+    def __init__(self, store_dir, mode="r"):
+        self.store_dir = store_dir
+        self.mode = mode
+        with open(os.path.join(store_dir, INDEX_FILENAME)) as f:
+            self._init_index(json.load(f))
+
+    def _open(self, name):
+        "Memory-mapped array `name` of shape (len(store), *patch_shape)."
+        return np.load(os.path.join(self.store_dir, f"{name}.npy"), mmap_mode=self.mode)
+
+    def _write_table(self, name, source, table):
+        os.makedirs(os.path.join(self.store_dir, name), exist_ok=True)
+        atomic_save(os.path.join(self.store_dir, name, f"{source}.npy"), table)
+
+    def _read_table(self, name, source):
+        return np.load(os.path.join(self.store_dir, name, f"{source}.npy"))
+
+    def flush(self, names=None):
+        for name in names or self.names:
+            self[name].flush()
+
+
+class ZarrPatchStore(_IndexedStore):
+    """
+    Reader/writer for a store created by `create_zarr_store`.
+
+    Indexing an array returns the Zarr array, whose patches are read one chunk at a time.
+    Worker processes reopen the group after unpickling and write disjoint chunks.
+
+    Parameters:
+        store_path (str): Path of the `.zarr` directory.
+        mode (str): "r" for reading or "r+" for writing.
+    """
+    def __init__(self, store_path, mode="r"):
+        import zarr
+
+        self.store_path = store_path
+        self.mode = mode
+        self._init_index(zarr.open_group(store_path, mode=mode).attrs.asdict())
+
+    def _open(self, name):
+        import zarr
+
+        return zarr.open_group(self.store_path, mode=self.mode)[name]
+
+    def _write_table(self, name, source, table):
+        import zarr
+
+        group = zarr.open_group(self.store_path, mode="r+").require_group(name)
+        group.array(source, table, chunks=(max(len(table), 1), *table.shape[1:]), overwrite=True)
+        count("bytes_written", table.nbytes)
+
+    def _read_table(self, name, source):
+        import zarr
+
+        return zarr.open_group(self.store_path, mode="r")[name][source][...]
+
+
+def open_store(path, mode="r"):
+    "Opens a patch store of either format, inferred from its contents."
+    if os.path.exists(os.path.join(path, INDEX_FILENAME)):
+        return PatchStore(path, mode=mode)
+    return ZarrPatchStore(path, mode=mode)
@@ -0,0 +1,46 @@
+import resource
+import sys
+
+import numpy as np
+
+
+def npy_shape(path):
+    """Shape and dtype of a .npy file, read from its header without loading the data."""
+    array = np.load(path, mmap_mode='r')
+    return array.shape, array.dtype
+
+
+def iter_npy_batches(path, batch_size, skip=()):
+    """
+    Lazily yields `(start, batch)` for consecutive blocks of samples of a large .npy file.
+
+    The file is memory-mapped with `np.load(mmap_mode='r')` and only `batch_size` samples are copied
+    into memory at a time. The map is reopened for every batch and released before the next one, so
+    the file pages read for previous batches are not kept in the resident set and peak memory depends
+    on the batch size rather than on the size of the file.
+
+    Parameters:
+        path (str): Path to the .npy file, with samples along the first axis.
+        batch_size (int): Number of samples per batch.
+        skip (collection): Start indices of batches to leave out without reading them (e.g. when resuming).
+
+    Returns:
+        generator: `(start, batch)` pairs where `batch` is an in-memory copy of `array[start:start+batch_size]`.
+    """
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be positive, got {batch_size}")
+    n = npy_shape(path)[0][0]
+    for start in range(0, n, batch_size):
+        if start in skip:
+            continue
+        array = np.load(path, mmap_mode='r')
+        batch = np.array(array[start:start + batch_size])
+        del array
+        yield start, batch
+
+
+def peak_memory_mb():
+    """Peak resident set size of the current process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10